@@ -0,0 +1,79 @@
+"""
+DRF authentication backed by tenant claims in the access token.
+"""
+
+from django.contrib.auth import get_user_model
+from django.utils.functional import LazyObject, empty
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .tokens import (
+    ACCOUNT_TYPE_CLAIM, MEMBERSHIPS_CLAIM, TENANT_VERSION_CLAIM,
+    get_tenant_version, tenant_claims_enabled,
+)
+
+
+class TenantClaimsUser(LazyObject):
+    """
+    Stateless stand-in for the authenticated User.
+
+    id/pk, account_type and the tenant memberships are answered from the
+    token claims. Anything else - including using the object in an ORM
+    filter or as a foreign key value - loads the real User row on first use,
+    so write endpoints keep working unchanged.
+    """
+
+    def __init__(self, validated_token):
+        user_id = validated_token[api_settings.USER_ID_CLAIM]
+        self.__dict__['_claims'] = {
+            'id': user_id,
+            'pk': user_id,
+            'account_type': validated_token[ACCOUNT_TYPE_CLAIM],
+            'tenant_memberships': validated_token[MEMBERSHIPS_CLAIM],
+            'is_active': True,
+            'is_authenticated': True,
+            'is_anonymous': False,
+        }
+        super().__init__()
+
+    def _setup(self):
+        User = get_user_model()
+        try:
+            user = User.objects.get(**{api_settings.USER_ID_FIELD: self.__dict__['_claims']['id']})
+        except User.DoesNotExist:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        self._wrapped = user
+
+    def __bool__(self):
+        return True
+
+    def __getattr__(self, name):
+        claims = self.__dict__['_claims']
+        if self._wrapped is empty and name in claims:
+            return claims[name]
+        return super().__getattr__(name)
+
+
+class TenantClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that skips the User (and CompanyUser) lookups for
+    access tokens minted with tenant claims.
+
+    Tokens without claims, or used while JWT_TENANT_CLAIMS is off, are
+    handled exactly like the stock JWTAuthentication. A claims token whose
+    tenant_version no longer matches the cached counter is rejected so the
+    client refreshes and receives current claims.
+    """
+
+    def get_user(self, validated_token):
+        version = validated_token.get(TENANT_VERSION_CLAIM)
+        if not tenant_claims_enabled() or version is None:
+            return super().get_user(validated_token)
+        current = get_tenant_version(validated_token[api_settings.USER_ID_CLAIM])
+        if current is None:
+            # Counter unavailable (cache down or evicted): verify against the DB.
+            return super().get_user(validated_token)
+        if current != version:
+            raise InvalidToken('Token tenant claims are outdated.')
+        return TenantClaimsUser(validated_token)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from apps.authentication.models import Customer
+from apps.core.search import build_search_vector, search_enabled
+from apps.crm.models import Lead, Deal
+
+
+class Command(BaseCommand):
+    help = 'Rebuild full-text search vectors for leads, deals and customers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not search_enabled():
+            self.stdout.write(self.style.WARNING('Full-text search requires PostgreSQL; nothing to do.'))
+            return
+        batch_size = options['batch_size']
+        querysets = [
+            Lead.objects.all(),
+            Deal.objects.all(),
+            Customer.objects.select_related('user'),
+        ]
+        for queryset in querysets:
+            batch, total = [], 0
+            for obj in queryset.order_by('pk').iterator(chunk_size=batch_size):
+                obj.search_vector = build_search_vector(obj.search_document())
+                batch.append(obj)
+                if len(batch) >= batch_size:
+                    total += queryset.model.objects.bulk_update(batch, ['search_vector'])
+                    batch = []
+            if batch:
+                total += queryset.model.objects.bulk_update(batch, ['search_vector'])
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} {queryset.model._meta.verbose_name_plural} search vectors"))
@@ -1,5 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from apps.core.search import email_document
 from django.utils import timezone
 import uuid
 from datetime import timedelta
@@ -109,10 +112,25 @@ class Customer(models.Model):
     country = models.CharField(max_length=100, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='customer_search_gin'),
+        ]
     
     def __str__(self):
         return f"{self.user.get_full_name()} - Customer"
 
+    def search_document(self):
+        user = self.user
+        return [
+            (user.first_name, 'A'),
+            (user.last_name, 'A'),
+            (email_document(user.email), 'B'),
+            (user.phone, 'D'),
+        ]
+
 class CustomerCompany(models.Model):
     CUSTOMER_STATUS_CHOICES = [
         ('active', 'Active'),
@@ -5,7 +5,8 @@ Phase 3.3 - Customer Profile APIs
 """
 
 from rest_framework.permissions import BasePermission
-from .models import CompanyUser, Customer
+from .models import Customer
+from .tenant import get_tenant_context
 
 
 class IsCompanyUser(BasePermission):
@@ -26,10 +27,7 @@ class IsCompanyUser(BasePermission):
             return False
         
         # User must be a member of at least one active company
-        has_company = CompanyUser.objects.filter(
-            user=request.user,
-            is_active=True
-        ).exists()
+        has_company = bool(get_tenant_context(request))
         
         if not has_company:
             self.message = "You are not a member of any company."
@@ -56,11 +54,7 @@ class IsCompanyCEO(BasePermission):
             return False
         
         # User must be a CEO of at least one active company
-        is_ceo = CompanyUser.objects.filter(
-            user=request.user,
-            role='ceo',
-            is_active=True
-        ).exists()
+        is_ceo = get_tenant_context(request).has_role('ceo')
         
         if not is_ceo:
             self.message = "Only CEOs can perform this action."
@@ -74,12 +68,7 @@ class IsCompanyCEO(BasePermission):
         """
         # For Company objects
         if hasattr(obj, 'team_members'):
-            return CompanyUser.objects.filter(
-                user=request.user,
-                company=obj,
-                role='ceo',
-                is_active=True
-            ).exists()
+            return get_tenant_context(request).has_role('ceo', company_id=obj.pk)
         
         return False
 
@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import CompanyUser, Customer, User
+from apps.core.search import refresh_search_vector
+from .tenant import invalidate_memberships
+from .tokens import bump_tenant_version
+
+
+@receiver(post_save, sender=CompanyUser)
+@receiver(post_delete, sender=CompanyUser)
+def invalidate_membership_cache(sender, instance, **kwargs):
+    # Fires after CompanyUser.save() has applied the role-default flags.
+    # Invalidate now and again on commit so a request racing the open
+    # transaction cannot re-cache the pre-commit rows.
+    user_id = instance.user_id
+    invalidate_memberships(user_id)
+    bump_tenant_version(user_id)
+    transaction.on_commit(lambda: invalidate_memberships(user_id))
+
+
+@receiver(post_save, sender=User)
+def revoke_tenant_claims(sender, instance, created, **kwargs):
+    # account_type / is_active live in the token claims too.
+    if not created:
+        bump_tenant_version(instance.pk)
+
+
+CUSTOMER_SEARCH_USER_FIELDS = {'first_name', 'last_name', 'email', 'phone'}
+
+
+@receiver(post_save, sender=Customer)
+def refresh_customer_search(sender, instance, raw=False, **kwargs):
+    if not raw:
+        refresh_search_vector(instance)
+
+
+@receiver(post_save, sender=User)
+def refresh_customer_search_from_user(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    # Customer search documents are built from the user's name/email/phone
+    if created or raw or instance.account_type != 'customer':
+        return
+    if update_fields is not None and not CUSTOMER_SEARCH_USER_FIELDS & set(update_fields):
+        return
+    customer = Customer.objects.filter(user=instance).first()
+    if customer:
+        customer.user = instance
+        refresh_search_vector(customer)
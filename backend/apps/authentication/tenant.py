@@ -0,0 +1,179 @@
+"""
+Request-scoped tenant context.
+
+Loads every active CompanyUser row for the authenticated user in a single
+query and keeps it on the request, so permission classes, views and
+serializers can answer "which companies / which role / which flags" from
+memory instead of re-querying CompanyUser.
+
+Across requests the rows are cached per user in the shared cache (Redis,
+see CACHES in settings) and invalidated by the CompanyUser signals in
+``apps.authentication.signals``.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import CompanyUser
+
+
+PERMISSION_FLAGS = ('can_invite_users', 'can_manage_deals', 'can_view_reports', 'can_manage_customers')
+MEMBERSHIP_FIELDS = ('company_id', 'role', 'department', 'joined_at') + PERMISSION_FLAGS
+
+MEMBERSHIP_CACHE_KEY = 'tenant:memberships:{user_id}'
+MEMBERSHIP_CACHE_TIMEOUT = getattr(settings, 'TENANT_MEMBERSHIP_CACHE_TIMEOUT', 15 * 60)
+CACHE_HITS_KEY = 'tenant:memberships:stats:hits'
+CACHE_MISSES_KEY = 'tenant:memberships:stats:misses'
+
+
+class Membership:
+    """Read-only snapshot of one active CompanyUser row."""
+
+    __slots__ = MEMBERSHIP_FIELDS
+
+    def __init__(self, **values):
+        for field in MEMBERSHIP_FIELDS:
+            setattr(self, field, values.get(field))
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in MEMBERSHIP_FIELDS}
+
+    def __repr__(self):
+        return f"<Membership company={self.company_id} role={self.role}>"
+
+
+class TenantContext:
+    """All active memberships of one user, ordered by joined_at."""
+
+    def __init__(self, memberships):
+        self.memberships = tuple(memberships)
+        self._by_company = {m.company_id: m for m in self.memberships}
+
+    @classmethod
+    def for_user(cls, user):
+        if not user or not user.is_authenticated or getattr(user, 'account_type', None) != 'company':
+            return cls([])
+        # Users authenticated from tenant-claims tokens carry their memberships.
+        rows = getattr(user, 'tenant_memberships', None)
+        if rows is None:
+            rows = load_memberships(user.pk)
+        return cls(Membership(**row) for row in rows)
+
+    def __bool__(self):
+        return bool(self.memberships)
+
+    @property
+    def company_ids(self):
+        return [m.company_id for m in self.memberships]
+
+    @property
+    def primary(self):
+        """Oldest active membership - the default company for creates."""
+        return self.memberships[0] if self.memberships else None
+
+    def get(self, company_id):
+        try:
+            return self._by_company.get(int(company_id))
+        except (TypeError, ValueError):
+            return None
+
+    def is_member(self, company_id):
+        return self.get(company_id) is not None
+
+    def resolve(self, company_id=None):
+        """Membership for an explicit company_id, else the primary one."""
+        if company_id:
+            return self.get(company_id)
+        return self.primary
+
+    def scope(self, company_id=None):
+        """Company ids a list endpoint should cover for an optional company_id filter."""
+        membership = self.get(company_id) if company_id else None
+        return [membership.company_id] if membership else self.company_ids
+
+    def has_role(self, *roles, company_id=None):
+        if company_id is not None:
+            membership = self.get(company_id)
+            return bool(membership and membership.role in roles)
+        return any(m.role in roles for m in self.memberships)
+
+    def has_flag(self, flag, company_id=None):
+        if company_id is not None:
+            membership = self.get(company_id)
+            return bool(membership and getattr(membership, flag))
+        return any(getattr(m, flag) for m in self.memberships)
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+    except Exception:  # noqa: BLE001
+        pass
+
+
+def load_memberships(user_id):
+    """Active membership rows for ``user_id``, served from cache when possible.
+
+    Cache errors (e.g. Redis unavailable) fall back to the database so
+    authorization never depends on the cache being up.
+    """
+    key = MEMBERSHIP_CACHE_KEY.format(user_id=user_id)
+    try:
+        rows = cache.get(key)
+    except Exception:  # noqa: BLE001
+        rows = None
+    else:
+        _bump(CACHE_HITS_KEY if rows is not None else CACHE_MISSES_KEY)
+    if rows is not None:
+        return rows
+    rows = list(
+        CompanyUser.objects.filter(user_id=user_id, is_active=True)
+        .order_by('joined_at')
+        .values(*MEMBERSHIP_FIELDS)
+    )
+    try:
+        cache.set(key, rows, MEMBERSHIP_CACHE_TIMEOUT)
+    except Exception:  # noqa: BLE001
+        pass
+    return rows
+
+
+def invalidate_memberships(user_id):
+    try:
+        cache.delete(MEMBERSHIP_CACHE_KEY.format(user_id=user_id))
+    except Exception:  # noqa: BLE001
+        pass
+
+
+def membership_cache_stats():
+    try:
+        values = cache.get_many([CACHE_HITS_KEY, CACHE_MISSES_KEY])
+    except Exception:  # noqa: BLE001
+        values = {}
+    hits = values.get(CACHE_HITS_KEY, 0)
+    misses = values.get(CACHE_MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate_percent': round(hits / total * 100, 2) if total else 0,
+    }
+
+
+def get_tenant_context(request):
+    """Return the TenantContext for ``request``, loading it at most once.
+
+    Works for DRF and plain Django requests alike; the context is stored on
+    the underlying HttpRequest so every layer sees the same instance.
+    """
+    http_request = getattr(request, '_request', request)
+    user = getattr(request, 'user', None)
+    context = getattr(http_request, '_tenant_context', None)
+    if context is None or getattr(http_request, '_tenant_context_user_id', None) != getattr(user, 'pk', None):
+        context = TenantContext.for_user(user)
+        http_request._tenant_context = context
+        http_request._tenant_context_user_id = getattr(user, 'pk', None)
+    return context
@@ -1,2 +1,104 @@
-from django.test import TestCase
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.db import connection
+from django.core.cache import cache
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from django.contrib.auth import get_user_model
+from apps.authentication.models import Company, CompanyUser
+from apps.authentication.tenant import load_memberships, membership_cache_stats
+
+
+User = get_user_model()
+
+
+class TenantContextTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='tenant', email='tenant@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='TenantCo', created_by=self.user)
+        CompanyUser.objects.create(user=self.user, company=self.company, role='ceo')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_membership_loaded_once_per_request(self):
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get('/api/leads/')
+        self.assertEqual(res.status_code, 200)
+        membership_queries = [q for q in ctx.captured_queries if 'authentication_companyuser' in q['sql']]
+        self.assertEqual(len(membership_queries), 1)
+
+    def test_company_id_outside_membership_falls_back_to_own_companies(self):
+        other_owner = User.objects.create_user(username='other', email='other@example.com', password='pass123', account_type='company')
+        other = Company.objects.create(company_name='OtherCo', created_by=other_owner)
+        res = self.client.get(f'/api/deals/?company_id={other.id}')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), [])
+
+    def test_non_member_is_rejected(self):
+        outsider = User.objects.create_user(username='outsider', email='outsider@example.com', password='pass123', account_type='company')
+        client = APIClient()
+        client.force_authenticate(outsider)
+        res = client.get('/api/leads/')
+        self.assertEqual(res.status_code, 403)
+
+
+class MembershipCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='cached', email='cached@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='CacheCo', created_by=self.user)
+        self.membership = CompanyUser.objects.create(user=self.user, company=self.company, role='support_staff')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_second_request_skips_membership_query(self):
+        self.client.get('/api/leads/')
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get('/api/leads/')
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse([q for q in ctx.captured_queries if 'authentication_companyuser' in q['sql']])
+        stats = membership_cache_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_membership_change_invalidates_cache(self):
+        self.assertFalse(load_memberships(self.user.id)[0]['can_manage_deals'])
+        self.membership.can_manage_deals = True
+        self.membership.save()
+        self.assertTrue(load_memberships(self.user.id)[0]['can_manage_deals'])
+        self.membership.delete()
+        self.assertEqual(load_memberships(self.user.id), [])
+
+
+@override_settings(JWT_TENANT_CLAIMS=True)
+class TenantClaimsTokenTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='claims@example.com', email='claims@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='ClaimsCo', created_by=self.user)
+        self.membership = CompanyUser.objects.create(user=self.user, company=self.company, role='ceo')
+        self.client = APIClient()
+        res = self.client.post('/api/auth/login/', {'email': 'claims@example.com', 'password': 'pass123'}, format='json')
+        self.tokens = res.json()['tokens']
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.tokens['access']}")
+
+    def test_lead_list_skips_user_and_membership_tables(self):
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get('/api/leads/')
+        self.assertEqual(res.status_code, 200)
+        tables = ('FROM "authentication_user" ', 'FROM "authentication_companyuser" ')
+        self.assertFalse([q for q in ctx.captured_queries if any(t in q['sql'] for t in tables)])
+
+    def test_lead_create_still_works(self):
+        res = self.client.post('/api/leads/', {'first_name': 'Claims', 'last_name': 'Lead', 'email': 'lead@example.com', 'lead_source': 'website'}, format='json')
+        self.assertEqual(res.status_code, 201)
+
+    def test_membership_change_revokes_token(self):
+        self.membership.is_active = False
+        self.membership.save()
+        self.assertEqual(self.client.get('/api/leads/').status_code, 401)
+        self.client.credentials()
+        res = self.client.post('/api/auth/token/refresh/', {'refresh': self.tokens['refresh']}, format='json')
+        self.assertEqual(res.status_code, 200)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {res.json()['access']}")
+        self.assertEqual(self.client.get('/api/leads/').status_code, 403)
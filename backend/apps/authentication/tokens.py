@@ -0,0 +1,103 @@
+"""
+JWT helpers for the optional tenant-claims token mode.
+
+When ``JWT_TENANT_CLAIMS`` is enabled, access tokens carry the user's
+account_type and active memberships (see ``apps.authentication.tenant``)
+plus a tenant version number. ``TenantClaimsJWTAuthentication`` trusts
+those claims only while the version still matches the per-user counter in
+the cache; any membership change, user update or logout bumps the counter
+and forces the client to refresh.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from .tenant import MEMBERSHIP_FIELDS, load_memberships
+
+
+TENANT_VERSION_KEY = 'tenant:token-version:{user_id}'
+ACCOUNT_TYPE_CLAIM = 'account_type'
+MEMBERSHIPS_CLAIM = 'memberships'
+TENANT_VERSION_CLAIM = 'tenant_version'
+
+
+def tenant_claims_enabled():
+    return getattr(settings, 'JWT_TENANT_CLAIMS', False)
+
+
+def get_tenant_version(user_id, create=False):
+    """Current tenant version for ``user_id``, or None when unknown.
+
+    New counters start from the current time in milliseconds, so a counter
+    lost to cache eviction never comes back at a value an old token holds.
+    """
+    key = TENANT_VERSION_KEY.format(user_id=user_id)
+    try:
+        version = cache.get(key)
+        if version is None and create:
+            cache.add(key, int(time.time() * 1000), timeout=None)
+            version = cache.get(key)
+    except Exception:  # noqa: BLE001
+        return None
+    return version
+
+
+def bump_tenant_version(user_id):
+    """Invalidate every access token minted with tenant claims for ``user_id``."""
+    key = TENANT_VERSION_KEY.format(user_id=user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # No counter yet: no claims token can be outstanding.
+        pass
+    except Exception:  # noqa: BLE001
+        pass
+
+
+def add_tenant_claims(access, user):
+    """Embed account type, memberships and the tenant version into ``access``."""
+    version = get_tenant_version(user.pk, create=True)
+    if version is None:
+        return access
+    memberships = []
+    if user.account_type == 'company':
+        for row in load_memberships(user.pk):
+            # Rows are already ordered by joined_at; drop the datetime.
+            memberships.append({field: row[field] for field in MEMBERSHIP_FIELDS if field != 'joined_at'})
+    access[ACCOUNT_TYPE_CLAIM] = user.account_type
+    access[MEMBERSHIPS_CLAIM] = memberships
+    access[TENANT_VERSION_CLAIM] = version
+    return access
+
+
+def issue_tokens(user):
+    """Refresh/access pair for a login response."""
+    refresh = RefreshToken.for_user(user)
+    access = refresh.access_token
+    if tenant_claims_enabled():
+        add_tenant_claims(access, user)
+    return {
+        'refresh': str(refresh),
+        'access': str(access),
+    }
+
+
+class TenantTokenRefreshSerializer(TokenRefreshSerializer):
+    """Token refresh that re-mints tenant claims from current memberships."""
+
+    def validate(self, attrs):
+        data = super().validate(attrs)
+        if tenant_claims_enabled():
+            from django.contrib.auth import get_user_model
+            access = AccessToken(data['access'])
+            user = get_user_model().objects.filter(
+                **{api_settings.USER_ID_FIELD: access[api_settings.USER_ID_CLAIM]}
+            ).first()
+            if user is not None:
+                data['access'] = str(add_tenant_claims(access, user))
+        return data
@@ -1,5 +1,6 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
+from .tokens import TenantTokenRefreshSerializer
 from .views import (
     RegisterCompanyView,
     RegisterCustomerView,
@@ -22,6 +23,7 @@ from .views import (
     CancelInvitationView,
     ValidateInvitationView,
     AcceptInvitationView,
+    MembershipCacheStatsView,
 )
 
 urlpatterns = [
@@ -30,7 +32,7 @@ urlpatterns = [
     path('login/', LoginView.as_view(), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path('me/', MeView.as_view(), name='me'),
-    path('token/refresh/', TokenRefreshView.as_view(), name='token-refresh'),
+    path('token/refresh/', TokenRefreshView.as_view(serializer_class=TenantTokenRefreshSerializer), name='token-refresh'),
     
     # Google OAuth endpoints
     path('google/login/', GoogleLoginView.as_view(), name='google-login'),
@@ -52,4 +54,7 @@ urlpatterns = [
     path('company/invitations/<int:invitation_id>/cancel/', CancelInvitationView.as_view(), name='company-invitation-cancel'),
     path('auth/validate-invitation/<str:token>/', ValidateInvitationView.as_view(), name='validate-invitation'),
     path('auth/accept-invitation/', AcceptInvitationView.as_view(), name='accept-invitation'),
+
+    # Membership cache diagnostics
+    path('cache/membership-stats/', MembershipCacheStatsView.as_view(), name='membership-cache-stats'),
 ]
@@ -12,6 +12,7 @@ from .serializers import (
 )
 from .models import Company, CompanyUser, Customer
 from .google_auth import verify_google_token, get_user_info_from_google
+from .tokens import issue_tokens, bump_tenant_version
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
@@ -74,15 +75,10 @@ class LoginView(APIView):
             user = authenticate(request, username=email, password=password)
             
             if user is not None:
-                # Generate JWT tokens
-                refresh = RefreshToken.for_user(user)
-                
+                # Generate JWT tokens (with tenant claims when enabled)
                 return Response({
                     'user': UserSerializer(user).data,
-                    'tokens': {
-                        'refresh': str(refresh),
-                        'access': str(refresh.access_token),
-                    }
+                    'tokens': issue_tokens(user),
                 }, status=status.HTTP_200_OK)
             else:
                 return Response({
@@ -97,6 +93,8 @@ class LogoutView(APIView):
 
     def post(self, request):
         try:
+            # Outstanding tenant-claims access tokens stop working immediately
+            bump_tenant_version(request.user.pk)
             refresh_token = request.data.get('refresh')
             if refresh_token:
                 token = RefreshToken(refresh_token)
@@ -181,15 +179,10 @@ class GoogleLoginView(APIView):
         try:
             user = User.objects.get(email=email)
             
-            # Generate JWT tokens
-            refresh = RefreshToken.for_user(user)
-            
+            # Generate JWT tokens (with tenant claims when enabled)
             return Response({
                 'user': UserSerializer(user).data,
-                'tokens': {
-                    'refresh': str(refresh),
-                    'access': str(refresh.access_token),
-                }
+                'tokens': issue_tokens(user),
             }, status=status.HTTP_200_OK)
             
         except User.DoesNotExist:
@@ -907,3 +900,20 @@ class AcceptInvitationView(APIView):
             }
         }
         return Response(response_data, status=status.HTTP_200_OK)
+
+
+# Membership cache diagnostics
+
+from rest_framework.permissions import IsAdminUser
+from .tenant import membership_cache_stats
+
+
+class MembershipCacheStatsView(APIView):
+    """
+    GET /api/auth/cache/membership-stats/
+    Hit/miss counters of the cross-request CompanyUser membership cache.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(membership_cache_stats(), status=status.HTTP_200_OK)
@@ -2,7 +2,7 @@
 Permissions for calls app
 """
 from rest_framework.permissions import BasePermission
-from apps.authentication.models import CompanyUser
+from apps.authentication.tenant import get_tenant_context
 
 
 class IsCompanyUser(BasePermission):
@@ -15,7 +15,7 @@ class IsCompanyUser(BasePermission):
         if request.user.account_type != 'company':
             self.message = 'Only company accounts allowed.'
             return False
-        return CompanyUser.objects.filter(user=request.user, is_active=True).exists()
+        return bool(get_tenant_context(request))
 
 
 class CanManagePhoneNumbers(BasePermission):
@@ -27,9 +27,5 @@ class CanManagePhoneNumbers(BasePermission):
             return False
         if request.user.account_type != 'company':
             return False
-        return CompanyUser.objects.filter(
-            user=request.user,
-            role__in=['ceo', 'manager'],
-            is_active=True
-        ).exists()
+        return get_tenant_context(request).has_role('ceo', 'manager')
 
@@ -17,7 +17,9 @@ from .serializers import (
     CallNoteSerializer, UpdateCallSerializer, VoicemailMessageSerializer
 )
 from .permissions import IsCompanyUser, CanManagePhoneNumbers
-from apps.authentication.models import CompanyUser, User
+from apps.authentication.models import User
+from apps.authentication.tenant import get_tenant_context
+from apps.core.pagination import KeysetPagination
 from apps.calls.services.twilio_service import (
     get_available_numbers, purchase_phone_number, make_call as twilio_make_call,
     get_call_status
@@ -35,14 +37,8 @@ class PhoneNumberListView(generics.ListAPIView):
     permission_classes = [IsCompanyUser]
     
     def get_queryset(self):
-        user = self.request.user
-        company_id = self.request.query_params.get('company_id')
-        
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            qs = PhoneNumber.objects.filter(company_id=company_id)
-        else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            qs = PhoneNumber.objects.filter(company_id__in=memberships)
+        tenant = get_tenant_context(self.request)
+        qs = PhoneNumber.objects.filter(company_id__in=tenant.scope(self.request.query_params.get('company_id')))
         
         # Filter by active status
         is_active = self.request.query_params.get('is_active')
@@ -92,29 +88,19 @@ class PurchasePhoneNumberView(APIView):
         company_id = request.data.get('company_id')
         
         # Get company
-        if company_id:
-            try:
-                company = CompanyUser.objects.get(user=user, company_id=company_id, is_active=True).company
-            except CompanyUser.DoesNotExist:
-                return Response(
-                    {"error": "Company not found or access denied"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-        else:
-            # Get user's first company
-            company_user = CompanyUser.objects.filter(user=user, is_active=True).first()
-            if not company_user:
-                return Response(
-                    {"error": "No company found for user"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            company = company_user.company
+        membership = get_tenant_context(request).resolve(company_id)
+        if not membership:
+            return Response(
+                {"error": "Company not found or access denied" if company_id else "No company found for user"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        company_id = membership.company_id
         
         try:
             phone_number = purchase_phone_number(
                 area_code=serializer.validated_data['area_code'],
                 country=serializer.validated_data.get('country', 'US'),
-                company_id=company.id,
+                company_id=company_id,
                 user_id=serializer.validated_data.get('user_id', user.id)
             )
             
@@ -136,8 +122,7 @@ class PhoneNumberDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [IsCompanyUser]
     
     def get_queryset(self):
-        user = self.request.user
-        memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
+        memberships = get_tenant_context(self.request).company_ids
         return PhoneNumber.objects.filter(company_id__in=memberships).select_related('user', 'company')
     
     def destroy(self, request, *args, **kwargs):
@@ -179,8 +164,7 @@ class SetDefaultNumberView(APIView):
             phone_number = PhoneNumber.objects.get(pk=pk)
             
             # Verify user has access to this phone number
-            user = request.user
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
+            memberships = get_tenant_context(request).company_ids
             if phone_number.company_id not in memberships:
                 return Response(
                     {"error": "Phone number not found or access denied"},
@@ -213,16 +197,11 @@ class CallListView(generics.ListAPIView):
     """List all calls for company with filters"""
     serializer_class = CallListSerializer
     permission_classes = [IsCompanyUser]
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
-        user = self.request.user
-        company_id = self.request.query_params.get('company_id')
-        
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            qs = Call.objects.filter(company_id=company_id)
-        else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            qs = Call.objects.filter(company_id__in=memberships)
+        tenant = get_tenant_context(self.request)
+        qs = Call.objects.filter(company_id__in=tenant.scope(self.request.query_params.get('company_id')))
         
         # Filters
         user_filter = self.request.query_params.get('user')
@@ -288,28 +267,19 @@ class MakeCallView(APIView):
         company_id = request.data.get('company_id')
         
         # Get company
-        if company_id:
-            try:
-                company = CompanyUser.objects.get(user=user, company_id=company_id, is_active=True).company
-            except CompanyUser.DoesNotExist:
-                return Response(
-                    {"error": "Company not found or access denied"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-        else:
-            company_user = CompanyUser.objects.filter(user=user, is_active=True).first()
-            if not company_user:
-                return Response(
-                    {"error": "No company found for user"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            company = company_user.company
+        membership = get_tenant_context(request).resolve(company_id)
+        if not membership:
+            return Response(
+                {"error": "Company not found or access denied" if company_id else "No company found for user"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        company_id = membership.company_id
         
         # Get phone number
         try:
             phone_number = PhoneNumber.objects.get(
                 id=serializer.validated_data['from_number_id'],
-                company=company,
+                company_id=company_id,
                 is_active=True
             )
         except PhoneNumber.DoesNotExist:
@@ -323,7 +293,7 @@ class MakeCallView(APIView):
                 from_number=phone_number,
                 to_number=serializer.validated_data['to_number'],
                 user_id=user.id,
-                company_id=company.id,
+                company_id=company_id,
                 lead_id=serializer.validated_data.get('lead_id'),
                 deal_id=serializer.validated_data.get('deal_id'),
                 customer_id=serializer.validated_data.get('customer_id'),
@@ -348,8 +318,7 @@ class CallDetailView(generics.RetrieveUpdateAPIView):
     permission_classes = [IsCompanyUser]
     
     def get_queryset(self):
-        user = self.request.user
-        memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
+        memberships = get_tenant_context(self.request).company_ids
         return Call.objects.filter(company_id__in=memberships).select_related(
             'user', 'phone_number', 'lead', 'deal', 'customer', 'company'
         ).prefetch_related('recordings', 'call_notes')
@@ -380,8 +349,7 @@ class EndCallView(APIView):
             call = Call.objects.get(pk=pk)
             
             # Verify access
-            user = request.user
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
+            memberships = get_tenant_context(request).company_ids
             if call.company_id not in memberships:
                 return Response(
                     {"error": "Call not found or access denied"},
@@ -420,8 +388,7 @@ class CallRecordingView(APIView):
             call = Call.objects.get(pk=pk)
             
             # Verify access
-            user = request.user
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
+            memberships = get_tenant_context(request).company_ids
             if call.company_id not in memberships:
                 return Response(
                     {"error": "Call not found or access denied"},
@@ -463,7 +430,7 @@ class AddCallNoteView(APIView):
             
             # Verify access
             user = request.user
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
+            memberships = get_tenant_context(request).company_ids
             if call.company_id not in memberships:
                 return Response(
                     {"error": "Call not found or access denied"},
@@ -497,32 +464,22 @@ class CallStatsView(APIView):
     permission_classes = [IsCompanyUser]
     
     def get(self, request):
-        user = request.user
         company_id = request.query_params.get('company_id')
         
         # Get company
-        if company_id:
-            try:
-                company = CompanyUser.objects.get(user=user, company_id=company_id, is_active=True).company
-            except CompanyUser.DoesNotExist:
-                return Response(
-                    {"error": "Company not found or access denied"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-        else:
-            company_user = CompanyUser.objects.filter(user=user, is_active=True).first()
-            if not company_user:
-                return Response(
-                    {"error": "No company found for user"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            company = company_user.company
+        membership = get_tenant_context(request).resolve(company_id)
+        if not membership:
+            return Response(
+                {"error": "Company not found or access denied" if company_id else "No company found for user"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        company_id = membership.company_id
         
         # Date range
         start_date = request.query_params.get('start_date')
         end_date = request.query_params.get('end_date')
         
-        qs = Call.objects.filter(company=company)
+        qs = Call.objects.filter(company_id=company_id)
         if start_date:
             qs = qs.filter(created_at__gte=start_date)
         if end_date:
@@ -570,14 +527,8 @@ class VoicemailListView(generics.ListAPIView):
     permission_classes = [IsCompanyUser]
     
     def get_queryset(self):
-        user = self.request.user
-        company_id = self.request.query_params.get('company_id')
-        
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            qs = VoicemailMessage.objects.filter(company_id=company_id)
-        else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            qs = VoicemailMessage.objects.filter(company_id__in=memberships)
+        tenant = get_tenant_context(self.request)
+        qs = VoicemailMessage.objects.filter(company_id__in=tenant.scope(self.request.query_params.get('company_id')))
         
         # Filter by listened status
         is_listened = self.request.query_params.get('is_listened')
@@ -593,8 +544,7 @@ class VoicemailDetailView(generics.RetrieveUpdateAPIView):
     permission_classes = [IsCompanyUser]
     
     def get_queryset(self):
-        user = self.request.user
-        memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
+        memberships = get_tenant_context(self.request).company_ids
         return VoicemailMessage.objects.filter(company_id__in=memberships).select_related(
             'phone_number', 'listened_by', 'company'
         )
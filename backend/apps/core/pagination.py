@@ -0,0 +1,144 @@
+"""
+Keyset (cursor) pagination shared by the list endpoints.
+
+A page is addressed by an opaque cursor holding the last row's
+(sort column, id), so page N is the same index range scan as page 1. The
+sort column is the queryset's first ordering term; id is added as the
+tie-breaker in the same direction and NULL sort values are placed last.
+
+Totals are opt-in: ``count=exact`` runs COUNT(*), ``count=approximate``
+returns the PostgreSQL planner estimate (exact on other databases).
+"""
+
+import base64
+import datetime
+import json
+import uuid
+from decimal import Decimal
+
+from django.db import connections
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+CURSOR_PARAM = 'cursor'
+PAGE_SIZE_PARAM = 'page_size'
+COUNT_PARAM = 'count'
+
+
+def _json_default(value):
+    # Full precision: DjangoJSONEncoder truncates datetimes to milliseconds,
+    # which would skip or repeat rows at page boundaries.
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError(f'Cannot encode {type(value).__name__} in a cursor')
+
+
+def _encode_cursor(value, pk):
+    raw = json.dumps([value, pk], default=_json_default)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return value, int(pk)
+    except Exception as exc:  # noqa: BLE001
+        raise NotFound('Invalid cursor.') from exc
+
+
+def _sort_term(queryset):
+    ordering = list(queryset.query.order_by) or list(queryset.model._meta.ordering)
+    term = ordering[0] if ordering and isinstance(ordering[0], str) else '-id'
+    field = term.lstrip('-')
+    return ('id' if field == 'pk' else field), term.startswith('-')
+
+
+def approximate_count(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def get_page_size(request, default=DEFAULT_PAGE_SIZE):
+    try:
+        page_size = int(request.query_params.get(PAGE_SIZE_PARAM, default))
+    except ValueError:
+        raise ValidationError({PAGE_SIZE_PARAM: 'Must be an integer.'})
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def keyset_paginate(queryset, request, default_page_size=DEFAULT_PAGE_SIZE):
+    """(rows, meta) for one page of ``queryset``; meta holds next_cursor and the opt-in count."""
+    page_size = get_page_size(request, default_page_size)
+    field, descending = _sort_term(queryset)
+    meta = {}
+    count_mode = request.query_params.get(COUNT_PARAM)
+    if count_mode == 'exact':
+        meta['count'] = queryset.count()
+    elif count_mode == 'approximate':
+        meta['count'] = approximate_count(queryset)
+
+    sort = F(field).desc(nulls_last=True) if descending else F(field).asc(nulls_last=True)
+    queryset = queryset.annotate(_keyset_value=F(field)).order_by(sort, '-id' if descending else 'id')
+    cursor = request.query_params.get(CURSOR_PARAM)
+    if cursor:
+        value, pk = _decode_cursor(cursor)
+        after = 'lt' if descending else 'gt'
+        if value is None:
+            # Already inside the trailing NULL block
+            queryset = queryset.filter(**{f'{field}__isnull': True, f'id__{after}': pk})
+        else:
+            queryset = queryset.filter(
+                Q(**{f'{field}__{after}': value})
+                | Q(**{field: value, f'id__{after}': pk})
+                | Q(**{f'{field}__isnull': True})
+            )
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = _encode_cursor(last._keyset_value, last.pk)
+    meta['next_cursor'] = next_cursor
+    return rows, meta
+
+
+def wants_keyset(request):
+    """Hand-rolled list views switch from page numbers to cursors when asked."""
+    return CURSOR_PARAM in request.query_params
+
+
+class KeysetPagination(BasePagination):
+    """DRF pagination class over ``keyset_paginate``: {'results', 'next_cursor'[, 'count']}."""
+
+    page_size = DEFAULT_PAGE_SIZE
+    # When False the view keeps returning a plain list unless the client sends
+    # cursor or page_size, for endpoints whose clients expect arrays.
+    always = True
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.always and not (CURSOR_PARAM in request.query_params or PAGE_SIZE_PARAM in request.query_params):
+            return None
+        rows, self.meta = keyset_paginate(queryset, request, self.page_size)
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({'results': data, **self.meta})
+
+
+class OptionalKeysetPagination(KeysetPagination):
+    always = False
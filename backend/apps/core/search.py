@@ -0,0 +1,73 @@
+"""
+Full-text search shared by the lead, deal and customer lists and by mailbox
+search (apps.emails.services.email_search).
+
+Searchable models (Lead, Deal, Customer) keep a GIN-indexed ``search_vector``
+built from their ``search_document()``; the app signals refresh it on save
+and ``manage.py rebuild_search_vectors`` backfills existing rows.
+``apply_search`` turns a ``search=`` value into a prefix tsquery - every term
+must start a word in the document, so typeahead matches from the first
+keystrokes - and annotates ``search_rank`` for ordering.
+
+On databases other than PostgreSQL searching falls back to OR'ed icontains.
+"""
+
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import F, Q, TextField, Value
+
+
+SEARCH_CONFIG = 'simple'  # names and emails: no stemming or stop words
+_TSQUERY_SPECIAL = re.compile(r"[&|!():*<>'\\\s]+")
+
+
+def search_enabled():
+    return connection.vendor == 'postgresql'
+
+
+def email_document(email):
+    """Email plus its local part and domain, so 'acme' finds 'jane@acme.com'."""
+    if not email:
+        return ''
+    return f"{email} {email.replace('@', ' ')}"
+
+
+def build_search_vector(document):
+    """tsvector expression for ``document``: (text, weight) pairs from search_document()."""
+    vector = None
+    for text, weight in document:
+        part = SearchVector(Value(text or '', output_field=TextField()), weight=weight, config=SEARCH_CONFIG)
+        vector = part if vector is None else vector + part
+    return vector
+
+
+def refresh_search_vector(instance):
+    if not search_enabled():
+        return
+    type(instance).objects.filter(pk=instance.pk).update(
+        search_vector=build_search_vector(instance.search_document())
+    )
+
+
+def prefix_query(text):
+    """AND of prefix terms for free text, or None when nothing searchable remains."""
+    terms = _TSQUERY_SPECIAL.sub(' ', text).split()
+    if not terms:
+        return None
+    return SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config=SEARCH_CONFIG)
+
+
+def apply_search(queryset, text, fallback_fields, vector_field='search_vector'):
+    """Filter ``queryset`` to rows matching ``text`` and annotate ``search_rank``."""
+    if not search_enabled():
+        condition = Q()
+        for field in fallback_fields:
+            condition |= Q(**{f'{field}__icontains': text})
+        return queryset.filter(condition).annotate(search_rank=Value(0.0))
+    query = prefix_query(text)
+    if query is None:
+        # Still annotated, so callers can order by search_rank
+        return queryset.annotate(search_rank=Value(0.0)).none()
+    return queryset.filter(**{vector_field: query}).annotate(search_rank=SearchRank(F(vector_field), query))
@@ -0,0 +1,50 @@
+"""
+Time-in-stage analytics over DealStageTransition.
+"""
+
+import math
+
+from django.db import connection
+from django.db.models import Aggregate, Count, FloatField
+
+from .models import DealStageTransition
+
+
+class Percentile(Aggregate):
+    """PostgreSQL ordered-set percentile_cont(fraction)."""
+    function = 'percentile_cont'
+    template = '%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = FloatField()
+
+    def __init__(self, expression, fraction, **extra):
+        super().__init__(expression, fraction=float(fraction), **extra)
+
+
+def _percentile(sorted_values, fraction):
+    # Linear interpolation, same definition as percentile_cont
+    position = (len(sorted_values) - 1) * fraction
+    low, high = math.floor(position), math.ceil(position)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def stage_durations(pipeline):
+    """Per-stage {count, median, p90} of completed stays, in seconds, keyed by stage id."""
+    transitions = DealStageTransition.objects.filter(
+        pipeline=pipeline, from_stage__isnull=False, duration_seconds__isnull=False,
+    ).order_by()
+    if connection.vendor == 'postgresql':
+        rows = transitions.values('from_stage_id').annotate(
+            count=Count('id'),
+            median=Percentile('duration_seconds', 0.5),
+            p90=Percentile('duration_seconds', 0.9),
+        )
+        return {row['from_stage_id']: row for row in rows}
+    # Other backends lack percentile_cont: aggregate the grouped values here
+    grouped = {}
+    for stage_id, seconds in transitions.values_list('from_stage_id', 'duration_seconds'):
+        grouped.setdefault(stage_id, []).append(seconds)
+    result = {}
+    for stage_id, values in grouped.items():
+        values.sort()
+        result[stage_id] = {'count': len(values), 'median': _percentile(values, 0.5), 'p90': _percentile(values, 0.9)}
+    return result
@@ -0,0 +1,101 @@
+"""
+Kanban board engine for DealsByStageView.
+
+The whole board is one deals query: window functions number the cards of
+each stage and carry the per-stage totals (count, value, weighted value) on
+every row, so the first ``limit`` cards of every column and all column
+totals arrive together and are partitioned by stage_id in memory. Columns
+page independently with an opaque per-stage cursor over (created_at, id),
+matching the board's newest-first ordering. Paging is opt-in: without a
+``limit`` every column is returned whole, for clients that do not follow
+``next_cursor``.
+"""
+
+import base64
+
+from django.db import models
+from django.db.models import Count, F, Q, Sum, Window
+from django.db.models.functions import RowNumber
+from django.utils.dateparse import parse_datetime
+
+from .serializers import DealListSerializer
+
+DEFAULT_COLUMN_LIMIT = 50
+MAX_COLUMN_LIMIT = 200
+
+WEIGHTED_VALUE = models.ExpressionWrapper(
+    F('value') * F('probability') / 100,
+    output_field=models.DecimalField(max_digits=16, decimal_places=4),
+)
+CARD_ORDER = [F('created_at').desc(), F('id').desc()]
+
+
+def encode_cursor(deal):
+    raw = f"{deal.created_at.isoformat()}|{deal.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(created_at, id) for a cursor string; raises ValueError when malformed."""
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        created_at = parse_datetime(created_at)
+        pk = int(pk)
+    except Exception as exc:  # noqa: BLE001
+        raise ValueError('Invalid cursor') from exc
+    if created_at is None:
+        raise ValueError('Invalid cursor')
+    return created_at, pk
+
+
+def _column(stage, cards, totals, limit):
+    has_more = limit is not None and len(cards) > limit
+    cards = cards[:limit]
+    return {
+        'stage': {'id': stage.id, 'name': stage.name, 'order': stage.order, 'probability': stage.probability},
+        'totals': {
+            'count': totals.get('stage_count') or 0,
+            'value': float(totals.get('stage_value') or 0),
+            'weighted_value': round(float(totals.get('stage_weighted') or 0), 2),
+        },
+        'deals': DealListSerializer(cards, many=True).data,
+        'next_cursor': encode_cursor(cards[-1]) if has_more else None,
+    }
+
+
+def build_board(stages, deals, limit=None):
+    """Board payload keyed by stage id, for ``stages`` (ordered) and a deals queryset; ``limit=None`` is unpaged."""
+    stages = list(stages)
+    partition = [F('stage_id')]
+    rows = (
+        deals.filter(stage_id__in=[stage.id for stage in stages])
+        .select_related('assigned_to', 'stage')
+        .annotate(
+            board_rank=Window(RowNumber(), partition_by=partition, order_by=CARD_ORDER),
+            stage_count=Window(Count('id'), partition_by=partition),
+            stage_value=Window(Sum('value'), partition_by=partition),
+            stage_weighted=Window(Sum(WEIGHTED_VALUE), partition_by=partition),
+        )
+        .order_by('stage_id', 'board_rank')
+    )
+    if limit is not None:
+        rows = rows.filter(board_rank__lte=limit + 1)
+    cards, totals = {}, {}
+    for deal in rows:
+        cards.setdefault(deal.stage_id, []).append(deal)
+        totals[deal.stage_id] = {'stage_count': deal.stage_count, 'stage_value': deal.stage_value, 'stage_weighted': deal.stage_weighted}
+    return {
+        str(stage.id): _column(stage, cards.get(stage.id, []), totals.get(stage.id, {}), limit)
+        for stage in stages
+    }
+
+
+def load_column(stage, deals, limit=DEFAULT_COLUMN_LIMIT, cursor=None):
+    """One column's next page of cards after ``cursor``, with its totals."""
+    deals = deals.filter(stage_id=stage.id)
+    totals = deals.aggregate(stage_count=Count('id'), stage_value=Sum('value'), stage_weighted=Sum(WEIGHTED_VALUE))
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        deals = deals.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    cards = list(deals.select_related('assigned_to', 'stage').order_by(*CARD_ORDER)[:limit + 1])
+    return {str(stage.id): _column(stage, cards, totals, limit)}
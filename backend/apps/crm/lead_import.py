@@ -0,0 +1,207 @@
+"""
+Bulk lead import from CSV / XLSX uploads.
+
+The upload is read as a stream of rows (csv.reader, or openpyxl in
+read-only mode) and handled in batches: rows are validated in memory
+against the company's members - loaded with one query up front, to resolve
+assigned_to by id or email - and every batch is written with one
+bulk_create. Rejected rows go to a CSV report with their line number and
+reason. bulk_create skips model signals, so search vectors are set on the
+new rows directly and the company's rollups are rebuilt once at the end,
+also when the import fails partway (see run_import).
+"""
+
+import csv
+import io
+import os
+import tempfile
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.validators import validate_email
+from django.db import transaction
+from django.utils import timezone
+
+from apps.authentication.models import CompanyUser
+from apps.core.search import build_search_vector, search_enabled
+from .models import Lead, LeadImport
+from .rollups import rebuild_company_rollups
+
+BATCH_SIZE = 2000
+FIELDS = ('first_name', 'last_name', 'email', 'phone', 'company_name', 'job_title', 'lead_source', 'estimated_value', 'notes', 'assigned_to')
+REQUIRED = ('first_name', 'last_name', 'email', 'lead_source')
+HEADER_ALIASES = {
+    'source': 'lead_source',
+    'company': 'company_name',
+    'title': 'job_title',
+    'value': 'estimated_value',
+    'assignee': 'assigned_to',
+}
+
+
+class ImportFileError(Exception):
+    """The upload cannot be read at all (format, missing columns)."""
+
+
+def _header(value):
+    name = str(value or '').strip().lower().replace(' ', '_').replace('-', '_')
+    return HEADER_ALIASES.get(name, name)
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        # Spreadsheet cells hold phone numbers and ids as floats
+        value = int(value)
+    return str(value).strip()
+
+
+def iter_rows(fileobj, filename):
+    """Yield (line number, {column: text}) for every non-empty data row."""
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        rows = csv.reader(io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline=''))
+    elif extension in ('.xlsx', '.xlsm'):
+        try:
+            import openpyxl
+        except ImportError:
+            raise ImportFileError('XLSX import requires openpyxl to be installed.')
+        workbook = openpyxl.load_workbook(fileobj, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+    else:
+        raise ImportFileError('Unsupported file type; upload a .csv or .xlsx file.')
+    header = next(rows, None)
+    if not header:
+        raise ImportFileError('The file is empty.')
+    columns = [_header(value) for value in header]
+    missing = [field for field in REQUIRED if field not in columns]
+    if missing:
+        raise ImportFileError(f"Missing required columns: {', '.join(missing)}")
+    for line, values in enumerate(rows, start=2):
+        row = {column: _text(value) for column, value in zip(columns, values) if column in FIELDS}
+        if any(row.values()):
+            yield line, row
+
+
+class LeadRowValidator:
+    """Validates and converts import rows for one company."""
+
+    def __init__(self, company_id):
+        self.members_by_id = {}
+        self.members_by_email = {}
+        for user_id, email in CompanyUser.objects.filter(company_id=company_id, is_active=True).values_list('user_id', 'user__email'):
+            self.members_by_id[user_id] = user_id
+            self.members_by_email[(email or '').lower()] = user_id
+        self.sources = {}
+        for value, label in Lead.LEAD_SOURCE_CHOICES:
+            self.sources[value] = value
+            self.sources[label.lower()] = value
+        self.max_lengths = {field.name: field.max_length for field in Lead._meta.fields if getattr(field, 'max_length', None)}
+
+    def clean(self, row):
+        """(field values for Lead(...), None) or (None, rejection reason)."""
+        missing = [field for field in REQUIRED if not row.get(field)]
+        if missing:
+            return None, f"Missing {', '.join(missing)}"
+        for field, max_length in self.max_lengths.items():
+            if len(row.get(field, '')) > max_length:
+                return None, f"{field} longer than {max_length} characters"
+        try:
+            validate_email(row['email'])
+        except ValidationError:
+            return None, 'Invalid email'
+        source = self.sources.get(row['lead_source'].lower())
+        if not source:
+            return None, f"Unknown lead_source '{row['lead_source']}'"
+        data = {
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'email': row['email'],
+            'phone': row.get('phone') or None,
+            'company_name': row.get('company_name') or None,
+            'job_title': row.get('job_title') or None,
+            'lead_source': source,
+            'notes': row.get('notes') or None,
+            'estimated_value': None,
+            'assigned_to_id': None,
+        }
+        if row.get('estimated_value'):
+            try:
+                data['estimated_value'] = Decimal(row['estimated_value'].replace(',', '')).quantize(Decimal('0.01'))
+            except InvalidOperation:
+                return None, 'Invalid estimated_value'
+            if abs(data['estimated_value']) >= Decimal('1e10'):
+                return None, 'estimated_value out of range'
+        assignee = row.get('assigned_to')
+        if assignee:
+            user_id = self.members_by_email.get(assignee.lower())
+            if user_id is None and assignee.isdigit():
+                user_id = self.members_by_id.get(int(assignee))
+            if user_id is None:
+                return None, f"assigned_to '{assignee}' is not a member of the company"
+            data['assigned_to_id'] = user_id
+        return data, None
+
+
+def _write_batch(leads):
+    if search_enabled():
+        for lead in leads:
+            lead.search_vector = build_search_vector(lead.search_document())
+    with transaction.atomic():
+        Lead.objects.bulk_create(leads, batch_size=1000)
+
+
+def run_import(lead_import):
+    """Process ``lead_import`` end to end, recording progress on the row as it goes.
+
+    Every written batch commits on its own, so an import that raises partway
+    keeps the leads it already created. processed_rows then counts the rows
+    of the upload they came from (always whole batches), the rejected report
+    collected so far is saved, and the company's rollups are rebuilt anyway.
+    Such an import must not be retried as-is, which would create those leads
+    a second time: upload the rows after processed_rows as a new import.
+    """
+    LeadImport.objects.filter(pk=lead_import.pk).update(status='processing', started_at=timezone.now())
+    validator = LeadRowValidator(lead_import.company_id)
+    processed = imported = rejected = 0
+    batch = []
+    try:
+        with tempfile.TemporaryFile(mode='w+', newline='', encoding='utf-8') as report, lead_import.file.open('rb') as upload:
+            writer = csv.writer(report)
+            writer.writerow(('row', 'error') + FIELDS)
+            try:
+                for line, row in iter_rows(upload, lead_import.original_filename):
+                    data, error = validator.clean(row)
+                    if error:
+                        writer.writerow([line, error] + [row.get(field, '') for field in FIELDS])
+                        rejected += 1
+                    else:
+                        batch.append(Lead(company_id=lead_import.company_id, created_by_id=lead_import.created_by_id, **data))
+                    processed += 1
+                    if processed % BATCH_SIZE == 0:
+                        _write_batch(batch)
+                        imported += len(batch)
+                        batch = []
+                        LeadImport.objects.filter(pk=lead_import.pk).update(processed_rows=processed, imported_count=imported, rejected_count=rejected)
+                if batch:
+                    _write_batch(batch)
+                    imported += len(batch)
+                    LeadImport.objects.filter(pk=lead_import.pk).update(processed_rows=processed, imported_count=imported, rejected_count=rejected)
+            finally:
+                if rejected:
+                    report.seek(0)
+                    name = f"rejected_{lead_import.pk}.csv"
+                    lead_import.rejected_file.save(name, File(report, name=name), save=False)
+                    # Stored right away so a failed import still has it
+                    LeadImport.objects.filter(pk=lead_import.pk).update(rejected_file=lead_import.rejected_file.name, rejected_count=rejected)
+    finally:
+        rebuild_company_rollups(lead_import.company_id)
+    lead_import.processed_rows = processed
+    lead_import.imported_count = imported
+    lead_import.rejected_count = rejected
+    lead_import.status = 'completed'
+    lead_import.completed_at = timezone.now()
+    lead_import.save(update_fields=['processed_rows', 'imported_count', 'rejected_count', 'rejected_file', 'status', 'completed_at'])
+    return imported
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from apps.crm.models import Activity, Deal
+
+
+class Command(BaseCommand):
+    help = 'Set stage_entered_at on deals created before it existed, from their latest "Stage changed" activity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        last_change = Activity.objects.filter(
+            deal=OuterRef('pk'), activity_type='note', subject__icontains='Stage changed',
+        ).order_by('-created_at').values('created_at')[:1]
+        # Deals never moved have been in their stage since creation
+        entered_at = Coalesce(Subquery(last_change), F('created_at'))
+        queryset = Deal.objects.filter(stage_entered_at__isnull=True)
+        batch, total = [], 0
+        for deal_id in queryset.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=options['batch_size']):
+            batch.append(deal_id)
+            if len(batch) >= options['batch_size']:
+                total += queryset.filter(pk__in=batch).update(stage_entered_at=entered_at)
+                batch = []
+        if batch:
+            total += queryset.filter(pk__in=batch).update(stage_entered_at=entered_at)
+        self.stdout.write(self.style.SUCCESS(f"Backfilled stage_entered_at on {total} deals"))
@@ -2,6 +2,9 @@ from django.db import models
 from django.utils import timezone
 from django.conf import settings
 from django.db.models import Q
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from apps.core.search import email_document
 
 User = settings.AUTH_USER_MODEL
 
@@ -40,6 +43,9 @@ class Lead(models.Model):
     converted_to_deal = models.ForeignKey('crm.Deal', on_delete=models.SET_NULL, null=True, blank=True, related_name='converted_lead')
     converted_at = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=True)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+    SEARCH_FIELDS = ('first_name', 'last_name', 'email', 'company_name', 'job_title', 'phone')
 
     class Meta:
         indexes = [
@@ -47,12 +53,30 @@ class Lead(models.Model):
             models.Index(fields=['company', 'email']),
             models.Index(fields=['created_at']),
             models.Index(fields=['company', 'is_active']),
+            GinIndex(fields=['search_vector'], name='lead_search_gin'),
         ]
         ordering = ['-created_at']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Snapshot of the loaded row, used to diff rollup contributions on save
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.email})"
 
+    def search_document(self):
+        return [
+            (self.first_name, 'A'),
+            (self.last_name, 'A'),
+            (email_document(self.email), 'B'),
+            (self.company_name, 'C'),
+            (self.job_title, 'C'),
+            (self.phone, 'D'),
+        ]
+
 class Pipeline(models.Model):
     company = models.ForeignKey('authentication.Company', on_delete=models.CASCADE, related_name='pipelines')
     name = models.CharField(max_length=255)
@@ -133,7 +157,11 @@ class Deal(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     won_at = models.DateTimeField(null=True, blank=True)
     lost_at = models.DateTimeField(null=True, blank=True)
+    stage_entered_at = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=True)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+    SEARCH_FIELDS = ('title', 'contact_name', 'contact_email', 'contact_phone', 'company_name')
 
     class Meta:
         indexes = [
@@ -142,30 +170,96 @@ class Deal(models.Model):
             models.Index(fields=['company', 'expected_close_date']),
             models.Index(fields=['created_at']),
             models.Index(fields=['company', 'is_active']),
+            GinIndex(fields=['search_vector'], name='deal_search_gin'),
         ]
         ordering = ['-created_at']
 
-    def save(self, *args, **kwargs):
-        # Sync probability with stage probability on create or stage change
-        if self.stage:
-            if self.pk is None:
-                self.probability = self.stage.probability
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Snapshot of the loaded row, used to diff rollup contributions on save
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def _loaded_value(self, attname):
+        """Value of ``attname`` as last loaded from / saved to the database."""
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is not None and attname in loaded:
+            return loaded[attname]
+        return Deal.objects.filter(pk=self.pk).values_list(attname, flat=True).first()
+
+    def save(self, *args, changed_by=None, **kwargs):
+        now = timezone.now()
+        creating = self._state.adding
+        previous_stage_id = None
+        stage_changed = False
+        if self.stage_id:
+            if creating:
+                stage_changed = True
             else:
-                try:
-                    previous = Deal.objects.get(pk=self.pk)
-                    if previous.stage_id != self.stage_id:
-                        self.probability = self.stage.probability
-                except Deal.DoesNotExist:
-                    self.probability = self.stage.probability
+                previous_stage_id = self._loaded_value('stage_id')
+                stage_changed = previous_stage_id != self.stage_id
+        previous_entered_at = self._loaded_value('stage_entered_at') if stage_changed and previous_stage_id else None
+        # Sync probability with stage probability on create or stage change
+        if stage_changed:
+            self.probability = self.stage.probability
+            self.stage_entered_at = now
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'probability', 'stage_entered_at'}
         if self.status == 'won' and self.won_at is None:
-            self.won_at = timezone.now()
+            self.won_at = now
         if self.status == 'lost' and self.lost_at is None:
-            self.lost_at = timezone.now()
+            self.lost_at = now
         super().save(*args, **kwargs)
+        if stage_changed:
+            DealStageTransition.objects.create(
+                deal=self,
+                company_id=self.company_id,
+                pipeline_id=self.pipeline_id,
+                from_stage_id=previous_stage_id,
+                to_stage_id=self.stage_id,
+                changed_by_id=changed_by.pk if changed_by else (self.created_by_id if creating else None),
+                entered_at=now,
+                duration_seconds=int((now - previous_entered_at).total_seconds()) if previous_entered_at else None,
+            )
+            if not hasattr(self, '_loaded_values'):
+                self._loaded_values = {}
+            self._loaded_values.update(stage_id=self.stage_id, stage_entered_at=now)
 
     def __str__(self):
         return f"{self.title} ({self.company.company_name})"
 
+    def search_document(self):
+        return [
+            (self.title, 'A'),
+            (self.contact_name, 'A'),
+            (self.company_name, 'B'),
+            (email_document(self.contact_email), 'B'),
+            (self.contact_phone, 'D'),
+        ]
+
+class DealStageTransition(models.Model):
+    """One stage change of a deal; duration_seconds is the time spent in from_stage."""
+    deal = models.ForeignKey('crm.Deal', on_delete=models.CASCADE, related_name='stage_transitions')
+    company = models.ForeignKey('authentication.Company', on_delete=models.CASCADE, related_name='deal_stage_transitions')
+    pipeline = models.ForeignKey('crm.Pipeline', on_delete=models.CASCADE, related_name='stage_transitions')
+    from_stage = models.ForeignKey('crm.DealStage', on_delete=models.SET_NULL, null=True, blank=True, related_name='transitions_out')
+    to_stage = models.ForeignKey('crm.DealStage', on_delete=models.CASCADE, related_name='transitions_in')
+    changed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='deal_stage_transitions')
+    entered_at = models.DateTimeField()
+    duration_seconds = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deal', 'entered_at']),
+            models.Index(fields=['pipeline', 'from_stage']),
+        ]
+        ordering = ['-entered_at']
+
+    def __str__(self):
+        return f"{self.deal_id}: {self.from_stage_id} -> {self.to_stage_id}"
+
 class Activity(models.Model):
     ACTIVITY_TYPE_CHOICES = [
         ('note', 'Note'),
@@ -196,3 +290,88 @@ class Activity(models.Model):
     def __str__(self):
         target = self.lead or self.deal
         return f"{self.activity_type} - {self.subject} ({target})"
+
+
+# ---------------- Analytics rollups -----------------
+# One row per company, creation day and dimension combination. Maintained
+# incrementally by apps.crm.rollups and rebuilt nightly; assigned_to_id is a
+# plain column so deleted users never collapse rows into each other.
+
+class LeadDailyRollup(models.Model):
+    company = models.ForeignKey('authentication.Company', on_delete=models.CASCADE, related_name='lead_rollups')
+    day = models.DateField()
+    status = models.CharField(max_length=32)
+    lead_source = models.CharField(max_length=32)
+    assigned_to_id = models.IntegerField(null=True, blank=True)
+    lead_count = models.IntegerField(default=0)
+    converted_count = models.IntegerField(default=0)
+    conversion_seconds = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'day', 'status', 'lead_source', 'assigned_to_id'], condition=Q(assigned_to_id__isnull=False), name='unique_lead_rollup_row'),
+            models.UniqueConstraint(fields=['company', 'day', 'status', 'lead_source'], condition=Q(assigned_to_id__isnull=True), name='unique_lead_rollup_row_unassigned'),
+        ]
+        indexes = [
+            models.Index(fields=['company', 'day']),
+        ]
+
+    def __str__(self):
+        return f"{self.company_id} {self.day} {self.status}/{self.lead_source}: {self.lead_count}"
+
+class DealDailyRollup(models.Model):
+    company = models.ForeignKey('authentication.Company', on_delete=models.CASCADE, related_name='deal_rollups')
+    day = models.DateField()
+    stage = models.ForeignKey('crm.DealStage', on_delete=models.CASCADE, related_name='+')
+    status = models.CharField(max_length=16)
+    assigned_to_id = models.IntegerField(null=True, blank=True)
+    deal_count = models.IntegerField(default=0)
+    valued_count = models.IntegerField(default=0)  # deals with a value; the denominator of average_deal_size
+    value_sum = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    closed_count = models.IntegerField(default=0)
+    close_seconds = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'day', 'stage', 'status', 'assigned_to_id'], condition=Q(assigned_to_id__isnull=False), name='unique_deal_rollup_row'),
+            models.UniqueConstraint(fields=['company', 'day', 'stage', 'status'], condition=Q(assigned_to_id__isnull=True), name='unique_deal_rollup_row_unassigned'),
+        ]
+        indexes = [
+            models.Index(fields=['company', 'day']),
+        ]
+
+    def __str__(self):
+        return f"{self.company_id} {self.day} stage={self.stage_id}/{self.status}: {self.deal_count}"
+
+
+class LeadImport(models.Model):
+    """A bulk lead upload processed by apps.crm.tasks.import_leads_task."""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+
+    company = models.ForeignKey('authentication.Company', on_delete=models.CASCADE, related_name='lead_imports')
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='lead_imports')
+    file = models.FileField(upload_to='lead_imports/')
+    original_filename = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='pending')
+    processed_rows = models.PositiveIntegerField(default=0)
+    imported_count = models.PositiveIntegerField(default=0)
+    rejected_count = models.PositiveIntegerField(default=0)
+    rejected_file = models.FileField(upload_to='lead_imports/rejected/', null=True, blank=True)
+    error_message = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['company', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.original_filename} ({self.status})"
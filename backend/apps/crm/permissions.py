@@ -1,5 +1,5 @@
 from rest_framework.permissions import BasePermission
-from apps.authentication.models import CompanyUser
+from apps.authentication.tenant import get_tenant_context
 from .models import Lead
 
 class IsCompanyUser(BasePermission):
@@ -11,7 +11,7 @@ class IsCompanyUser(BasePermission):
         if request.user.account_type != 'company':
             self.message = 'Only company accounts allowed.'
             return False
-        return CompanyUser.objects.filter(user=request.user, is_active=True).exists()
+        return bool(get_tenant_context(request))
 
 class CanManageLeads(BasePermission):
     message = 'Insufficient permissions to manage leads.'
@@ -19,7 +19,7 @@ class CanManageLeads(BasePermission):
     def has_permission(self, request, view):
         if not request.user or not request.user.is_authenticated:
             return False
-        return CompanyUser.objects.filter(user=request.user, is_active=True, can_manage_deals=True).exists()
+        return get_tenant_context(request).has_flag('can_manage_deals')
 
 class IsLeadOwnerOrManager(BasePermission):
     message = 'You must be lead owner, assignee or manager.'
@@ -30,7 +30,7 @@ class IsLeadOwnerOrManager(BasePermission):
         if obj.created_by_id == request.user.id or (obj.assigned_to_id == request.user.id if obj.assigned_to_id else False):
             return True
         # Manager permission
-        return CompanyUser.objects.filter(user=request.user, company=obj.company, is_active=True, can_manage_deals=True).exists()
+        return get_tenant_context(request).has_flag('can_manage_deals', company_id=obj.company_id)
 
 class PipelineManagePermission(BasePermission):
     message = 'Only company CEO or Manager can manage pipelines.'
@@ -40,7 +40,7 @@ class PipelineManagePermission(BasePermission):
             return False
         if request.user.account_type != 'company':
             return False
-        return CompanyUser.objects.filter(user=request.user, role__in=['ceo','manager'], is_active=True).exists()
+        return get_tenant_context(request).has_role('ceo', 'manager')
 
 class IsDealOwnerOrManager(BasePermission):
     message = 'You must be deal owner, assignee or manager.'
@@ -52,4 +52,4 @@ class IsDealOwnerOrManager(BasePermission):
             return True
         if getattr(obj, 'assigned_to_id', None) == request.user.id:
             return True
-        return CompanyUser.objects.filter(user=request.user, company=obj.company, is_active=True, can_manage_deals=True).exists()
+        return get_tenant_context(request).has_flag('can_manage_deals', company_id=obj.company_id)
@@ -0,0 +1,260 @@
+"""
+Daily analytics rollups for leads and deals.
+
+Every active Lead/Deal contributes to exactly one LeadDailyRollup /
+DealDailyRollup row, keyed by company, creation day and the dimensions the
+stats endpoints group by. The crm signals move that contribution whenever a
+record is saved or deleted; ``rebuild_company_rollups`` recomputes a company
+from scratch (nightly Celery beat job) to absorb writes that bypass signals,
+such as queryset.update() or SET_NULL cascades.
+"""
+
+import datetime
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import Lead, Deal, LeadDailyRollup, DealDailyRollup
+
+
+def _day(value):
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+
+def lead_contribution(values):
+    """(key, measures) for a lead's field values, or None when it is not counted."""
+    if not values['is_active']:
+        return None
+    created_at = values['created_at']
+    converted_at = values['converted_at']
+    converted = values['status'] == 'converted' and converted_at is not None
+    key = (values['company_id'], _day(created_at), values['status'], values['lead_source'], values['assigned_to_id'])
+    measures = {
+        'lead_count': 1,
+        'converted_count': 1 if converted else 0,
+        'conversion_seconds': int((converted_at - created_at).total_seconds()) if converted else 0,
+    }
+    return key, measures
+
+
+def deal_contribution(values):
+    """(key, measures) for a deal's field values, or None when it is not counted."""
+    if not values['is_active']:
+        return None
+    created_at = values['created_at']
+    close_date = values['actual_close_date']
+    close_seconds = 0
+    if close_date is not None:
+        # Same arithmetic DealStatsView has always used: close date at midnight
+        # minus the naive creation timestamp.
+        closed_at = datetime.datetime.combine(close_date, datetime.time.min)
+        close_seconds = int((closed_at - created_at.replace(tzinfo=None)).total_seconds())
+    key = (values['company_id'], _day(created_at), values['stage_id'], values['status'], values['assigned_to_id'])
+    measures = {
+        'deal_count': 1,
+        'valued_count': 1 if values['value'] is not None else 0,
+        'value_sum': values['value'] or 0,
+        'closed_count': 1 if close_date is not None else 0,
+        'close_seconds': close_seconds,
+    }
+    return key, measures
+
+
+class RollupSpec:
+    def __init__(self, source, rollup, fields, key_fields, contribution):
+        self.source = source
+        self.rollup = rollup
+        self.fields = fields
+        self.key_fields = key_fields
+        self.contribution = contribution
+
+
+LEAD_ROLLUP = RollupSpec(
+    Lead, LeadDailyRollup,
+    fields=('company_id', 'created_at', 'status', 'lead_source', 'assigned_to_id', 'converted_at', 'is_active'),
+    key_fields=('company_id', 'day', 'status', 'lead_source', 'assigned_to_id'),
+    contribution=lead_contribution,
+)
+DEAL_ROLLUP = RollupSpec(
+    Deal, DealDailyRollup,
+    fields=('company_id', 'created_at', 'stage_id', 'status', 'assigned_to_id', 'value', 'actual_close_date', 'is_active'),
+    key_fields=('company_id', 'day', 'stage_id', 'status', 'assigned_to_id'),
+    contribution=deal_contribution,
+)
+SPECS = {Lead: LEAD_ROLLUP, Deal: DEAL_ROLLUP}
+
+
+def _apply(spec, key, measures, sign):
+    lookup = dict(zip(spec.key_fields, key))
+    changes = {field: F(field) + sign * value for field, value in measures.items()}
+    if spec.rollup.objects.filter(**lookup).update(**changes):
+        return
+    if sign < 0:
+        # Nothing to subtract from; the nightly rebuild reconciles.
+        return
+    try:
+        with transaction.atomic():
+            spec.rollup.objects.create(**lookup, **measures)
+    except IntegrityError:
+        # Lost a race creating the row; it exists now.
+        spec.rollup.objects.filter(**lookup).update(**changes)
+
+
+def _previous_values(spec, instance):
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    if all(field in loaded for field in spec.fields):
+        return {field: loaded[field] for field in spec.fields}
+    # Deferred fields or an instance built by hand: read the stored row.
+    return spec.source.objects.filter(pk=instance.pk).values(*spec.fields).first()
+
+
+def capture_previous(instance, update_fields=None):
+    """pre_save hook: remember the contribution the stored row currently makes."""
+    spec = SPECS[type(instance)]
+    previous = None
+    if not instance._state.adding and instance.pk is not None:
+        values = _previous_values(spec, instance)
+        previous = spec.contribution(values) if values else None
+    instance._rollup_previous = previous
+
+
+def record_save(instance, update_fields=None):
+    """post_save hook: move the instance's contribution to its current row."""
+    spec = SPECS[type(instance)]
+    previous = getattr(instance, '_rollup_previous', None)
+    if update_fields is not None:
+        touched = {instance._meta.get_field(name).attname for name in update_fields}
+        if not touched & set(spec.fields):
+            return
+    values = {field: getattr(instance, field) for field in spec.fields}
+    current = spec.contribution(values)
+    if previous != current:
+        if previous:
+            _apply(spec, *previous, sign=-1)
+        if current:
+            _apply(spec, *current, sign=1)
+    instance._rollup_previous = None
+    if not hasattr(instance, '_loaded_values'):
+        instance._loaded_values = {}
+    instance._loaded_values.update(values)
+
+
+def record_delete(instance):
+    """post_delete hook: withdraw the instance's contribution."""
+    spec = SPECS[type(instance)]
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    values = {field: loaded.get(field, getattr(instance, field)) for field in spec.fields}
+    contribution = spec.contribution(values)
+    if contribution:
+        _apply(spec, *contribution, sign=-1)
+
+
+def rebuild_company_rollups(company_id):
+    """Recompute both rollup tables for one company from the source rows.
+
+    Uses the same contribution functions as the incremental path, streaming
+    the source rows, and swaps the company's rollup rows in one transaction.
+    """
+    for spec in (LEAD_ROLLUP, DEAL_ROLLUP):
+        totals = {}
+        rows = (
+            spec.source.objects.filter(company_id=company_id, is_active=True)
+            .order_by()
+            .values_list(*spec.fields)
+            .iterator(chunk_size=2000)
+        )
+        for row in rows:
+            key, measures = spec.contribution(dict(zip(spec.fields, row)))
+            bucket = totals.setdefault(key, dict.fromkeys(measures, 0))
+            for field, value in measures.items():
+                bucket[field] += value
+        objs = [spec.rollup(**dict(zip(spec.key_fields, key)), **measures) for key, measures in totals.items()]
+        with transaction.atomic():
+            spec.rollup.objects.filter(company_id=company_id).delete()
+            spec.rollup.objects.bulk_create(objs, batch_size=1000)
+
+
+# ---------------- Stats readers -----------------
+
+def lead_stats(company_ids):
+    """LeadStatsView payload computed from LeadDailyRollup."""
+    rows = (
+        LeadDailyRollup.objects.filter(company_id__in=company_ids)
+        .values('status', 'lead_source', 'assigned_to_id')
+        .annotate(count=Sum('lead_count'), converted=Sum('converted_count'), seconds=Sum('conversion_seconds'))
+        .order_by()
+    )
+    total = converted = conversion_seconds = 0
+    by_status, by_source, by_assigned = {}, {}, {}
+    for row in rows:
+        if not row['count']:
+            continue
+        total += row['count']
+        converted += row['converted']
+        conversion_seconds += row['seconds']
+        by_status[row['status']] = by_status.get(row['status'], 0) + row['count']
+        by_source[row['lead_source']] = by_source.get(row['lead_source'], 0) + row['count']
+        assigned = str(row['assigned_to_id'])
+        by_assigned[assigned] = by_assigned.get(assigned, 0) + row['count']
+    converted_leads = by_status.get('converted', 0)
+    conversion_rate = (converted_leads / total * 100) if total else 0
+    avg_time_days = (conversion_seconds / converted / 86400) if converted else 0
+    return {
+        'total_leads': total,
+        'leads_by_status': by_status,
+        'leads_by_source': by_source,
+        'conversion_rate_percent': round(conversion_rate, 2),
+        'average_time_to_conversion_days': round(avg_time_days, 2),
+        'leads_by_assigned_user': by_assigned,
+    }
+
+
+def deal_stats(company_ids):
+    """DealStatsView payload computed from DealDailyRollup."""
+    rollups = DealDailyRollup.objects.filter(company_id__in=company_ids)
+    rows = (
+        rollups.values('stage__name', 'status', 'assigned_to_id')
+        .annotate(count=Sum('deal_count'), valued=Sum('valued_count'), value=Sum('value_sum'),
+                  closed=Sum('closed_count'), seconds=Sum('close_seconds'))
+        .order_by()
+    )
+    total = valued = won = closed = close_seconds = 0
+    total_value = 0
+    by_stage, by_assigned = {}, {}
+    for row in rows:
+        if not row['count']:
+            continue
+        value = row['value'] or 0
+        total += row['count']
+        valued += row['valued']
+        total_value += value
+        closed += row['closed']
+        close_seconds += row['seconds']
+        if row['status'] == 'won':
+            won += row['count']
+        stage = by_stage.setdefault(row['stage__name'] or '', {'count': 0, 'value': 0.0})
+        stage['count'] += row['count']
+        stage['value'] += float(value)
+        assigned = by_assigned.setdefault(str(row['assigned_to_id']), {'count': 0, 'value': 0.0})
+        assigned['count'] += row['count']
+        assigned['value'] += float(value)
+    monthly = (
+        rollups.annotate(m=TruncMonth('day')).values('m')
+        .annotate(count=Sum('deal_count'), value=Sum('value_sum'))
+        .filter(count__gt=0)
+        .order_by('m')
+    )
+    return {
+        'total_deals_value': float(total_value),
+        'deals_by_stage': by_stage,
+        'win_rate_percent': round(won / (total or 1) * 100, 2),
+        # Deals without a value do not pull the average down
+        'average_deal_size': float(total_value / valued) if valued else 0.0,
+        'average_days_to_close': round(close_seconds / closed / 86400, 2) if closed else 0,
+        'deals_by_assigned_user': by_assigned,
+        'monthly_trends': [{'month': str(row['m'])[:7], 'count': row['count'], 'value': float(row['value'] or 0)} for row in monthly],
+    }
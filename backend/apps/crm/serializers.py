@@ -3,6 +3,7 @@ from django.utils import timezone
 from django.db import transaction
 from .models import Lead, Deal, Pipeline, DealStage, Activity
 from apps.authentication.models import CompanyUser, User
+from apps.authentication.tenant import get_tenant_context
 from django.db.models import Sum, Count
 
 class UserMiniSerializer(serializers.ModelSerializer):
@@ -62,11 +63,7 @@ class CreateLeadSerializer(serializers.ModelSerializer):
         request = self.context['request']
         user = request.user
         # Determine company - first active membership unless explicit company_id param
-        company_id = request.data.get('company_id')
-        if company_id:
-            membership = CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).first()
-        else:
-            membership = CompanyUser.objects.filter(user=user, is_active=True).order_by('joined_at').first()
+        membership = get_tenant_context(request).resolve(request.data.get('company_id'))
         if not membership:
             raise serializers.ValidationError('User must belong to a company to create leads.')
         assigned_to_id = validated_data.pop('assigned_to_id', None)
@@ -76,10 +73,10 @@ class CreateLeadSerializer(serializers.ModelSerializer):
             if not assigned_to:
                 raise serializers.ValidationError({'assigned_to_id': 'User not found.'})
             # Ensure same company
-            if not CompanyUser.objects.filter(user=assigned_to, company=membership.company, is_active=True).exists():
+            if not CompanyUser.objects.filter(user=assigned_to, company_id=membership.company_id, is_active=True).exists():
                 raise serializers.ValidationError({'assigned_to_id': 'User not in your company.'})
         lead = Lead.objects.create(
-            company=membership.company,
+            company_id=membership.company_id,
             created_by=user,
             assigned_to=assigned_to,
             **validated_data
@@ -266,16 +263,12 @@ class CreatePipelineSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         request = self.context['request']
         user = request.user
-        company_id = request.data.get('company_id')
-        membership = None
-        if company_id:
-            membership = CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).first()
-        if not membership:
-            membership = CompanyUser.objects.filter(user=user, is_active=True).order_by('joined_at').first()
+        tenant = get_tenant_context(request)
+        membership = tenant.resolve(request.data.get('company_id')) or tenant.primary
         if not membership:
             raise serializers.ValidationError('User must belong to a company.')
         stages_data = validated_data.pop('stages', None)
-        pipeline = Pipeline.objects.create(company=membership.company, created_by=user, **validated_data)
+        pipeline = Pipeline.objects.create(company_id=membership.company_id, created_by=user, **validated_data)
         if not stages_data:
             order = 1
             for name, prob in self.DEFAULT_STAGES:
@@ -327,10 +320,8 @@ class DealSerializer(serializers.ModelSerializer):
         return obj.activities.count()
 
     def get_days_in_stage(self, obj):
-        # Use last stage change activity time if exists; else created_at
-        last_change = obj.activities.filter(activity_type='note', subject__icontains='Stage changed').order_by('-created_at').first()
-        ref = last_change.created_at if last_change else obj.created_at
-        from django.utils import timezone
+        # stage_entered_at is maintained by Deal.save(); the backfill_stage_entered_at command fills older rows
+        ref = obj.stage_entered_at or obj.created_at
         return (timezone.now() - ref).days if ref else 0
 
     def get_weighted_value(self, obj):
@@ -361,18 +352,13 @@ class CreateDealSerializer(serializers.ModelSerializer):
 
     def validate(self, data):
         request = self.context['request']
-        user = request.user
         # company selection from membership
-        company_id = request.data.get('company_id')
-        if company_id:
-            membership = CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).first()
-        else:
-            membership = CompanyUser.objects.filter(user=user, is_active=True).order_by('joined_at').first()
+        membership = get_tenant_context(request).resolve(request.data.get('company_id'))
         if not membership:
             raise serializers.ValidationError('User must belong to a company.')
-        data['_company'] = membership.company
+        data['_company_id'] = membership.company_id
 
-        pipeline = Pipeline.objects.filter(id=data['pipeline_id'], company=membership.company, is_active=True).first()
+        pipeline = Pipeline.objects.filter(id=data['pipeline_id'], company_id=membership.company_id, is_active=True).first()
         if not pipeline:
             raise serializers.ValidationError({'pipeline_id':'Pipeline not found for company.'})
         data['_pipeline'] = pipeline
@@ -387,20 +373,20 @@ class CreateDealSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         request = self.context['request']
-        company = validated_data.pop('_company')
+        company_id = validated_data.pop('_company_id')
         pipeline = validated_data.pop('_pipeline')
         stage = validated_data.pop('_stage')
         validated_data.pop('pipeline_id', None)
         validated_data.pop('stage_id', None)
         deal = Deal.objects.create(
-            company=company,
+            company_id=company_id,
             pipeline=pipeline,
             stage=stage,
             created_by=request.user,
             **validated_data
         )
         if deal.assigned_to:
-            Activity.objects.create(company=company, user=request.user, deal=deal, activity_type='note', subject='Deal assigned', description=f'Assigned to {deal.assigned_to_id}')
+            Activity.objects.create(company_id=company_id, user=request.user, deal=deal, activity_type='note', subject='Deal assigned', description=f'Assigned to {deal.assigned_to_id}')
         return deal
 
 class UpdateDealSerializer(serializers.ModelSerializer):
@@ -422,7 +408,7 @@ class UpdateDealSerializer(serializers.ModelSerializer):
             instance.probability = stage.probability
         for k, v in validated_data.items():
             setattr(instance, k, v)
-        instance.save()
+        instance.save(changed_by=request.user)
         if stage_id is not None and old_stage_id != instance.stage_id:
             Activity.objects.create(
                 company=instance.company,
@@ -449,8 +435,7 @@ class MoveDealStageSerializer(serializers.Serializer):
         deal = self.context['deal']
         stage = self.validated_data['stage']
         deal.stage = stage
-        deal.probability = stage.probability
-        deal.save()
+        deal.save(changed_by=self.context['request'].user)
         Activity.objects.create(company=deal.company, user=self.context['request'].user, deal=deal, activity_type='note', subject='Stage changed', description=f'Stage changed to {stage.name}')
         return deal
 
@@ -538,42 +523,41 @@ class CreateActivitySerializer(serializers.ModelSerializer):
 
     def validate(self, data):
         request = self.context['request']
-        user = request.user
         lead_id = data.get('lead_id')
         deal_id = data.get('deal_id')
         if not lead_id and not deal_id:
             raise serializers.ValidationError('Either lead_id or deal_id is required.')
         if lead_id and deal_id:
             raise serializers.ValidationError('Provide only one of lead_id or deal_id, not both.')
-        target_company = None
+        target_company_id = None
         lead = None
         deal = None
         if lead_id:
             lead = Lead.objects.filter(id=lead_id, is_active=True).first()
             if not lead:
                 raise serializers.ValidationError({'lead_id':'Lead not found.'})
-            target_company = lead.company
+            target_company_id = lead.company_id
         if deal_id:
             deal = Deal.objects.filter(id=deal_id, is_active=True).first()
             if not deal:
                 raise serializers.ValidationError({'deal_id':'Deal not found.'})
-            target_company = deal.company
+            target_company_id = deal.company_id
         # Ensure requester belongs to company
-        if not CompanyUser.objects.filter(user=user, company=target_company, is_active=True).exists():
+        if not get_tenant_context(request).is_member(target_company_id):
             raise serializers.ValidationError('You are not a member of this company.')
-        data['_company'] = target_company
+        data['_company_id'] = target_company_id
         data['_lead'] = lead
         data['_deal'] = deal
         return data
 
     def create(self, validated_data):
         request = self.context['request']
-        company = validated_data.pop('_company')
+        company_id = validated_data.pop('_company_id')
         lead = validated_data.pop('_lead')
         deal = validated_data.pop('_deal')
         validated_data.pop('lead_id', None)
         validated_data.pop('deal_id', None)
-        return Activity.objects.create(company=company, user=request.user, lead=lead, deal=deal, **validated_data)
+        return Activity.objects.create(company_id=company_id, user=request.user, lead=lead, deal=deal, **validated_data)
 
 class ActivityListSerializer(serializers.ModelSerializer):
     user = ActivityUserMiniSerializer(read_only=True)
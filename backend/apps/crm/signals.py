@@ -1,9 +1,11 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
 from apps.authentication.models import Company, User  # noqa
-from .models import Pipeline, DealStage
+from .models import Pipeline, DealStage, Lead, Deal
+from . import rollups
+from apps.core.search import refresh_search_vector
 
 DEFAULT_STAGES = [
     ('Prospecting', 10),
@@ -37,3 +39,43 @@ def create_default_pipeline(sender, instance, created, **kwargs):
                 probability=probability,
             )
             order += 1
+
+
+@receiver(pre_save, sender=Lead)
+@receiver(pre_save, sender=Deal)
+def capture_rollup_contribution(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    rollups.capture_previous(instance, update_fields=update_fields)
+
+
+@receiver(post_save, sender=Lead)
+@receiver(post_save, sender=Deal)
+def update_rollups_on_save(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    rollups.record_save(instance, update_fields=update_fields)
+
+
+@receiver(post_delete, sender=Lead)
+@receiver(post_delete, sender=Deal)
+def update_rollups_on_delete(sender, instance, **kwargs):
+    rollups.record_delete(instance)
+
+
+@receiver(pre_save, sender=Lead)
+@receiver(pre_save, sender=Deal)
+def mark_search_document_dirty(sender, instance, raw=False, **kwargs):
+    loaded = getattr(instance, '_loaded_values', None)
+    instance._search_dirty = not raw and (
+        instance._state.adding or loaded is None
+        or any(field not in loaded or loaded[field] != getattr(instance, field) for field in sender.SEARCH_FIELDS)
+    )
+
+
+@receiver(post_save, sender=Lead)
+@receiver(post_save, sender=Deal)
+def refresh_search_document(sender, instance, **kwargs):
+    if getattr(instance, '_search_dirty', False):
+        refresh_search_vector(instance)
+        instance._search_dirty = False
@@ -0,0 +1,34 @@
+from celery import shared_task
+from django.utils import timezone
+from apps.authentication.models import Company
+from apps.crm.rollups import rebuild_company_rollups
+from apps.crm.models import LeadImport
+from apps.crm.lead_import import run_import
+
+
+
+@shared_task
+def rebuild_company_rollups_task(company_id: int):
+    rebuild_company_rollups(company_id)
+    return True
+
+
+@shared_task
+def rebuild_all_rollups_task():
+    for company_id in Company.objects.values_list('id', flat=True):
+        rebuild_company_rollups_task.delay(company_id)
+    return True
+
+
+@shared_task
+def import_leads_task(import_id: int):
+    lead_import = LeadImport.objects.filter(pk=import_id, status='pending').first()
+    if not lead_import:
+        return False
+    try:
+        run_import(lead_import)
+    except Exception as exc:  # noqa: BLE001
+        # Batches already written stay imported: not retried, see run_import for how to resume
+        LeadImport.objects.filter(pk=import_id).update(status='failed', error_message=str(exc), completed_at=timezone.now())
+        return False
+    return True
@@ -0,0 +1,293 @@
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework.test import APIClient
+from django.contrib.auth import get_user_model
+from apps.authentication.models import Company, CompanyUser
+from apps.crm.models import Activity, Lead, Deal, Pipeline, LeadDailyRollup, DealDailyRollup, DealStageTransition, LeadImport
+from apps.crm.rollups import rebuild_company_rollups, lead_stats, deal_stats
+from apps.core.search import prefix_query
+
+
+User = get_user_model()
+
+
+class CrmTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='rollup', email='rollup@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='RollupCo', created_by=self.user)
+        CompanyUser.objects.create(user=self.user, company=self.company, role='ceo')
+        self.pipeline = Pipeline.objects.get(company=self.company, is_default=True)
+        self.stages = list(self.pipeline.stages.order_by('order'))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def make_lead(self, **kwargs):
+        data = dict(company=self.company, created_by=self.user, first_name='A', last_name='B', email='a@example.com', lead_source='website')
+        data.update(kwargs)
+        return Lead.objects.create(**data)
+
+    def make_deal(self, **kwargs):
+        data = dict(company=self.company, pipeline=self.pipeline, stage=self.stages[0], created_by=self.user, title='Deal', value=100,
+                    contact_name='C', contact_email='c@example.com', company_name='Acme')
+        data.update(kwargs)
+        return Deal.objects.create(**data)
+
+
+class RollupStatsTests(CrmTestCase):
+    def test_incremental_rollups_match_rebuild(self):
+        self.make_lead()
+        lead = self.make_lead(lead_source='referral', assigned_to=self.user)
+        lead.status = 'converted'
+        lead.converted_at = timezone.now()
+        lead.save()
+        Lead.objects.get(pk=self.make_lead().pk).delete()
+        deal = self.make_deal(value=250)
+        self.make_deal(stage=self.stages[1], assigned_to=self.user)
+        deal = Deal.objects.get(pk=deal.pk)
+        deal.stage = self.stages[4]
+        deal.status = 'won'
+        deal.actual_close_date = timezone.now().date()
+        deal.save()
+
+        incremental = (lead_stats([self.company.id]), deal_stats([self.company.id]))
+        self.assertEqual(incremental[0]['total_leads'], 2)
+        self.assertEqual(incremental[0]['leads_by_status'], {'new': 1, 'converted': 1})
+        self.assertEqual(incremental[1]['deals_by_stage']['Closed Won'], {'count': 1, 'value': 250.0})
+        self.assertEqual(incremental[1]['win_rate_percent'], 50.0)
+
+        rebuild_company_rollups(self.company.id)
+        self.assertEqual((lead_stats([self.company.id]), deal_stats([self.company.id])), incremental)
+
+    def test_stats_endpoints_read_rollups(self):
+        self.make_lead()
+        self.make_deal()
+        Lead.objects.update(is_active=False)  # bypasses signals; rollup is stale until rebuilt
+        self.assertEqual(self.client.get('/api/leads/stats/').json()['total_leads'], 1)
+        rebuild_company_rollups(self.company.id)
+        self.assertEqual(self.client.get('/api/leads/stats/').json()['total_leads'], 0)
+        self.assertFalse(LeadDailyRollup.objects.exists())
+        res = self.client.get('/api/deals/stats/')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['total_deals_value'], 100.0)
+        self.assertEqual(DealDailyRollup.objects.count(), 1)
+
+    def test_average_deal_size_skips_deals_without_value(self):
+        self.make_deal(value=300)
+        # A legacy row with no value counts as a deal but not towards the average
+        DealDailyRollup.objects.create(company=self.company, day=timezone.now().date(), stage=self.stages[1], status='open', deal_count=1)
+        stats = deal_stats([self.company.id])
+        self.assertEqual(sum(stage['count'] for stage in stats['deals_by_stage'].values()), 2)
+        self.assertEqual(stats['average_deal_size'], 300.0)
+
+
+class DealBoardTests(CrmTestCase):
+    def test_board_is_one_deals_query_with_totals(self):
+        for value in (100, 200, 300):
+            self.make_deal(value=value)
+        self.make_deal(stage=self.stages[2], value=50)
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(f'/api/deals/by-stage/?pipeline_id={self.pipeline.id}&limit=2')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len([q for q in ctx.captured_queries if 'FROM "crm_deal"' in q['sql']]), 1)
+        column = res.json()[str(self.stages[0].id)]
+        self.assertEqual(column['totals'], {'count': 3, 'value': 600.0, 'weighted_value': 60.0})
+        self.assertEqual(len(column['deals']), 2)
+        self.assertEqual(res.json()[str(self.stages[2].id)]['totals']['weighted_value'], 25.0)
+
+        more = self.client.get(f'/api/deals/by-stage/?pipeline_id={self.pipeline.id}&stage_id={self.stages[0].id}&limit=2&cursor={column["next_cursor"]}')
+        rest = more.json()[str(self.stages[0].id)]
+        self.assertEqual(len(rest['deals']), 1)
+        self.assertIsNone(rest['next_cursor'])
+        seen = {d['id'] for d in column['deals']} | {d['id'] for d in rest['deals']}
+        self.assertEqual(len(seen), 3)
+
+        # Without a limit columns are not cut, for clients that do not page
+        whole = self.client.get(f'/api/deals/by-stage/?pipeline_id={self.pipeline.id}').json()[str(self.stages[0].id)]
+        self.assertEqual((len(whole['deals']), whole['next_cursor']), (3, None))
+
+    def test_non_integer_ids_are_rejected(self):
+        for query in ('pipeline_id=abc', f'pipeline_id={self.pipeline.id}&stage_id=abc', 'limit=x'):
+            self.assertEqual(self.client.get(f'/api/deals/by-stage/?{query}').status_code, 400)
+
+    def test_foreign_pipeline_is_not_found(self):
+        other_owner = User.objects.create_user(username='boardother', email='bo@example.com', password='pass123', account_type='company')
+        other = Company.objects.create(company_name='BoardOther', created_by=other_owner)
+        pipeline = Pipeline.objects.get(company=other, is_default=True)
+        self.assertEqual(self.client.get(f'/api/deals/by-stage/?pipeline_id={pipeline.id}').status_code, 404)
+
+
+class DealStageHistoryTests(CrmTestCase):
+    def test_stage_move_records_transition_without_reload(self):
+        deal = Deal.objects.get(pk=self.make_deal().pk)
+        deal.stage = self.stages[1]
+        with CaptureQueriesContext(connection) as ctx:
+            deal.save()
+        self.assertFalse([q for q in ctx.captured_queries if q['sql'].startswith('SELECT') and 'FROM "crm_deal"' in q['sql']])
+        transitions = list(DealStageTransition.objects.filter(deal=deal).order_by('entered_at', 'id'))
+        self.assertEqual([(t.from_stage_id, t.to_stage_id) for t in transitions], [(None, self.stages[0].id), (self.stages[0].id, self.stages[1].id)])
+        self.assertIsNotNone(transitions[1].duration_seconds)
+        self.assertEqual(deal.probability, self.stages[1].probability)
+        self.assertEqual(deal.stage_entered_at, transitions[1].entered_at)
+
+    def test_stage_durations_endpoint(self):
+        deal = self.make_deal()
+        res = self.client.post(f'/api/deals/{deal.id}/move-stage/', {'stage_id': self.stages[1].id}, format='json')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(DealStageTransition.objects.get(deal=deal, from_stage=self.stages[0]).changed_by, self.user)
+        res = self.client.get(f'/api/pipelines/{self.pipeline.id}/stage-durations/')
+        self.assertEqual(res.status_code, 200)
+        stages = res.json()['stages']
+        self.assertEqual(stages[0]['transitions'], 1)
+        self.assertEqual(stages[0]['median_days'], 0.0)
+        self.assertIsNone(stages[1]['median_days'])
+
+    def test_backfill_uses_latest_stage_change_activity(self):
+        moved, untouched = self.make_deal(), self.make_deal()
+        created = timezone.now() - timedelta(days=30)
+        Deal.objects.update(stage_entered_at=None, created_at=created)
+        for days_ago in (20, 10):
+            note = Activity.objects.create(company=self.company, user=self.user, deal=moved, activity_type='note',
+                                           subject='Stage changed', description='Stage changed to Qualified')
+            Activity.objects.filter(pk=note.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+        call_command('backfill_stage_entered_at', stdout=StringIO())
+        moved.refresh_from_db()
+        untouched.refresh_from_db()
+        self.assertEqual((timezone.now() - moved.stage_entered_at).days, 10)
+        self.assertEqual(untouched.stage_entered_at, created)
+        self.assertEqual(self.client.get(f'/api/deals/{moved.id}/').json()['days_in_stage'], 10)
+
+
+class LeadSearchTests(CrmTestCase):
+    def test_search_param_filters_leads(self):
+        self.make_lead(first_name='Jane', email='jane@acme.com')
+        self.make_lead(first_name='Bob', email='bob@other.com')
+        res = self.client.get('/api/leads/?search=acme')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([row['email'] for row in res.json()], ['jane@acme.com'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'full-text search needs PostgreSQL')
+    def test_prefix_search_on_postgres(self):
+        jane = self.make_lead(first_name='Jane', last_name='Doe', email='jane@acme.com')
+        janet = self.make_lead(first_name='Janet', last_name="O'Brien", email='janet@other.com')
+        self.make_lead(first_name='Bob', email='bob@other.com')
+        self.assertIsNotNone(Lead.objects.get(pk=jane.pk).search_vector)
+
+        def search(text):
+            return sorted(row['id'] for row in self.client.get('/api/leads/', {'search': text}).json())
+
+        self.assertEqual(search('jan'), sorted([jane.id, janet.id]))
+        self.assertEqual(search('acme'), [jane.id])
+        self.assertEqual(search('jan doe'), [jane.id])
+        self.assertEqual(search("o'brien"), [janet.id])
+        self.assertEqual(search('&:*'), [])
+        # Full-text, not substring: 'cme' does not start a word
+        self.assertEqual(search('cme'), [])
+
+    def test_prefix_query_strips_tsquery_syntax(self):
+        self.assertIsNone(prefix_query(" & ) :* "))
+        self.assertEqual(prefix_query("jan o'brien").get_source_expressions()[1].value, "jan:* & o:* & brien:*")
+
+
+class KeysetPaginationTests(CrmTestCase):
+    def test_lead_list_pages_with_cursor(self):
+        leads = [self.make_lead(first_name=f'L{i}') for i in range(5)]
+        Lead.objects.filter(pk__in=[l.pk for l in leads[:3]]).update(created_at=leads[0].created_at)
+        self.assertIsInstance(self.client.get('/api/leads/').json(), list)
+        seen, cursor = [], ''
+        while True:
+            body = self.client.get(f'/api/leads/?page_size=2&count=exact&cursor={cursor}').json()
+            self.assertEqual(body['count'], 5)
+            seen += [row['id'] for row in body['results']]
+            cursor = body['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(sorted(seen), sorted(l.pk for l in leads))
+        self.assertEqual(len(seen), 5)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/leads/?cursor=bogus').status_code, 404)
+
+
+class LeadImportTests(CrmTestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.member = User.objects.create_user(username='rep@example.com', email='rep@example.com', password='pass123', account_type='company')
+        CompanyUser.objects.create(user=self.member, company=self.company, role='sales_rep')
+
+    def test_import_csv_reports_rejected_rows(self):
+        content = (
+            "First Name,Last Name,Email,Source,Estimated Value,Assignee\n"
+            "Ann,Lee,ann@example.com,website,1200.50,REP@example.com\n"
+            "Bob,Ray,not-an-email,referral,,\n"
+            "Cid,Fox,cid@example.com,Cold Call,,\n"
+            "Dee,Moe,dee@example.com,website,,stranger@example.com\n"
+        ).encode()
+        with override_settings(MEDIA_ROOT=self.media_root):
+            res = self.client.post('/api/leads/import/', {'file': SimpleUploadedFile('leads.csv', content)}, format='multipart')
+            self.assertEqual(res.status_code, 202)
+            self.assertEqual(res.data['status'], 'completed')
+            self.assertEqual((res.data['processed_rows'], res.data['imported_count'], res.data['rejected_count']), (4, 2, 2))
+            ann = Lead.objects.get(email='ann@example.com')
+            self.assertEqual(ann.assigned_to_id, self.member.id)
+            self.assertEqual(str(ann.estimated_value), '1200.50')
+            self.assertEqual(Lead.objects.get(email='cid@example.com').lead_source, 'cold_call')
+            self.assertEqual(lead_stats([self.company.id])['total_leads'], 2)
+
+            report = self.client.get(f"/api/leads/import/{res.data['id']}/rejected/")
+            self.assertEqual(report.status_code, 200)
+            lines = b''.join(report.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('3,Invalid email'))
+        self.assertIn('stranger@example.com', lines[2])
+
+    def test_failure_partway_keeps_written_batches_and_report(self):
+        from apps.crm import lead_import
+        content = (
+            "first_name,last_name,email,lead_source\n"
+            "Ann,Lee,ann@example.com,website\n"
+            "Bob,Ray,not-an-email,referral\n"
+            "Cid,Fox,cid@example.com,website\n"
+            "Dee,Moe,dee@example.com,website\n"
+        ).encode()
+        write_batch = lead_import._write_batch
+        calls = []
+
+        def flaky_write(leads):
+            calls.append(len(leads))
+            if len(calls) > 1:
+                raise RuntimeError('database went away')
+            write_batch(leads)
+
+        with override_settings(MEDIA_ROOT=self.media_root), mock.patch.object(lead_import, 'BATCH_SIZE', 2), \
+                mock.patch.object(lead_import, '_write_batch', flaky_write):
+            res = self.client.post('/api/leads/import/', {'file': SimpleUploadedFile('leads.csv', content)}, format='multipart')
+            record = LeadImport.objects.get(pk=res.data['id'])
+            self.assertEqual(record.status, 'failed')
+            self.assertEqual((record.processed_rows, record.imported_count, record.rejected_count), (2, 1, 1))
+            self.assertEqual(list(Lead.objects.values_list('email', flat=True)), ['ann@example.com'])
+            self.assertEqual(lead_stats([self.company.id])['total_leads'], 1)
+            report = self.client.get(f"/api/leads/import/{record.pk}/rejected/")
+            self.assertEqual(report.status_code, 200)
+            lines = b''.join(report.streaming_content).decode().splitlines()
+        self.assertTrue(lines[1].startswith('3,Invalid email'))
+
+    def test_missing_required_column_fails_import(self):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            res = self.client.post('/api/leads/import/', {'file': SimpleUploadedFile('leads.csv', b"first_name,email\nAnn,ann@example.com\n")}, format='multipart')
+        self.assertEqual(res.data['status'], 'failed')
+        self.assertIn('last_name', res.data['error_message'])
+        self.assertFalse(Lead.objects.exists())
@@ -1,9 +1,9 @@
 from django.urls import path
 from .views import (
     LeadListCreateView, LeadDetailView, ConvertLeadView,
-    AssignLeadView, LeadStatsView,
+    AssignLeadView, LeadStatsView, LeadImportView, LeadImportDetailView, LeadImportRejectedView,
     PipelineListCreateView, PipelineDetailView, StageListCreateView,
-    StageUpdateView, ReorderStagesView,
+    StageUpdateView, ReorderStagesView, PipelineStageDurationsView,
     DealListCreateView, DealDetailView, MoveDealStageView, CloseDealView, AssignDealView, DealStatsView, DealsByStageView,
     ActivityListCreateView, ActivityDetailView, LeadActivitiesView, DealActivitiesView, MarkActivityCompleteView
 )
@@ -11,6 +11,9 @@ from .views import (
 urlpatterns = [
     path('leads/', LeadListCreateView.as_view(), name='lead-list-create'),
     path('leads/stats/', LeadStatsView.as_view(), name='lead-stats'),
+    path('leads/import/', LeadImportView.as_view(), name='lead-import'),
+    path('leads/import/<int:pk>/', LeadImportDetailView.as_view(), name='lead-import-detail'),
+    path('leads/import/<int:pk>/rejected/', LeadImportRejectedView.as_view(), name='lead-import-rejected'),
     path('leads/<int:pk>/', LeadDetailView.as_view(), name='lead-detail'),
     path('leads/<int:pk>/convert/', ConvertLeadView.as_view(), name='lead-convert'),
     path('leads/<int:pk>/assign/', AssignLeadView.as_view(), name='lead-assign'),
@@ -20,6 +23,7 @@ urlpatterns = [
     path('pipelines/<int:pk>/stages/', StageListCreateView.as_view(), name='stage-list-create'),
     path('stages/<int:pk>/', StageUpdateView.as_view(), name='stage-update'),
     path('pipelines/<int:pk>/reorder-stages/', ReorderStagesView.as_view(), name='pipeline-reorder-stages'),
+    path('pipelines/<int:pk>/stage-durations/', PipelineStageDurationsView.as_view(), name='pipeline-stage-durations'),
     # Deals
     path('deals/', DealListCreateView.as_view(), name='deal-list-create'),
     path('deals/stats/', DealStatsView.as_view(), name='deal-stats'),
@@ -2,11 +2,10 @@ from rest_framework import generics, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.db import models
-from django.db.models import Q, Count, Avg, F, DurationField, ExpressionWrapper
+from django.http import FileResponse
 from django.utils import timezone
-from datetime import timedelta
 
-from .models import Lead, Activity, Deal, Pipeline, DealStage
+from .models import Lead, Activity, Deal, Pipeline, DealStage, LeadImport
 from .serializers import (
     LeadSerializer, LeadListSerializer, CreateLeadSerializer,
     UpdateLeadSerializer, ConvertLeadSerializer, AssignLeadSerializer,
@@ -15,11 +14,19 @@ from .serializers import (
     ActivitySerializer, CreateActivitySerializer, ActivityListSerializer
 )
 from .permissions import IsCompanyUser, CanManageLeads, IsLeadOwnerOrManager, PipelineManagePermission, IsDealOwnerOrManager
+from .rollups import lead_stats, deal_stats
+from .analytics import stage_durations
+from .board import build_board, load_column, DEFAULT_COLUMN_LIMIT, MAX_COLUMN_LIMIT
+from .tasks import import_leads_task
 from apps.authentication.models import CompanyUser, User
+from apps.authentication.tenant import get_tenant_context
+from apps.core.search import apply_search
+from apps.core.pagination import OptionalKeysetPagination
 
 class LeadListCreateView(generics.ListCreateAPIView):
     queryset = Lead.objects.filter(is_active=True).select_related('assigned_to','created_by','company')
     permission_classes = [IsCompanyUser]
+    pagination_class = OptionalKeysetPagination
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -27,14 +34,9 @@ class LeadListCreateView(generics.ListCreateAPIView):
         return LeadListSerializer
 
     def get_queryset(self):
-        user = self.request.user
         # Determine company context
-        company_id = self.request.query_params.get('company_id')
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            qs = Lead.objects.filter(company_id=company_id, is_active=True)
-        else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            qs = Lead.objects.filter(company_id__in=memberships, is_active=True)
+        tenant = get_tenant_context(self.request)
+        qs = Lead.objects.filter(company_id__in=tenant.scope(self.request.query_params.get('company_id')), is_active=True)
         # Filters
         status_f = self.request.query_params.get('status')
         if status_f:
@@ -53,18 +55,15 @@ class LeadListCreateView(generics.ListCreateAPIView):
             qs = qs.filter(created_at__date__lte=end_date)
         search = self.request.query_params.get('search')
         if search:
-            qs = qs.filter(
-                Q(first_name__icontains=search) |
-                Q(last_name__icontains=search) |
-                Q(email__icontains=search) |
-                Q(company_name__icontains=search)
-            )
+            qs = apply_search(qs, search, ['first_name','last_name','email','company_name'])
         sort = self.request.query_params.get('sort')
         if sort in ['created_at','updated_at','estimated_value']:
             direction = self.request.query_params.get('direction','desc')
             if direction == 'desc':
                 sort = f'-{sort}'
             qs = qs.order_by(sort)
+        elif search:
+            qs = qs.order_by('-search_rank','-created_at')
         else:
             qs = qs.order_by('-created_at')
         return qs.select_related('assigned_to','created_by')
@@ -159,31 +158,66 @@ class LeadStatsView(APIView):
     permission_classes = [IsCompanyUser]
 
     def get(self, request):
-        user = request.user
-        company_id = request.query_params.get('company_id')
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            leads = Lead.objects.filter(company_id=company_id, is_active=True)
-        else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            leads = Lead.objects.filter(company_id__in=memberships, is_active=True)
-        total = leads.count()
-        by_status = leads.values('status').annotate(count=Count('id')).order_by()
-        by_source = leads.values('lead_source').annotate(count=Count('id')).order_by()
-        converted = leads.filter(status='converted')
-        conversion_rate = (converted.count() / total * 100) if total else 0
-        # Avg time to conversion
-        converted_times = converted.exclude(converted_at__isnull=True).values_list('created_at','converted_at')
-        durations = [ (c2 - c1).total_seconds() for c1,c2 in converted_times ]
-        avg_time_days = (sum(durations)/len(durations)/86400) if durations else 0
-        by_assigned = leads.values('assigned_to').annotate(count=Count('id')).order_by()
-        return Response({
-            'total_leads': total,
-            'leads_by_status': {row['status']: row['count'] for row in by_status},
-            'leads_by_source': {row['lead_source']: row['count'] for row in by_source},
-            'conversion_rate_percent': round(conversion_rate,2),
-            'average_time_to_conversion_days': round(avg_time_days,2),
-            'leads_by_assigned_user': {str(row['assigned_to']): row['count'] for row in by_assigned},
-        })
+        tenant = get_tenant_context(request)
+        # Served from the daily rollups (apps.crm.rollups), not the leads table
+        return Response(lead_stats(tenant.scope(request.query_params.get('company_id'))))
+
+def _lead_import_data(lead_import):
+    return {
+        'id': lead_import.id,
+        'company_id': lead_import.company_id,
+        'filename': lead_import.original_filename,
+        'status': lead_import.status,
+        'processed_rows': lead_import.processed_rows,
+        'imported_count': lead_import.imported_count,
+        'rejected_count': lead_import.rejected_count,
+        'has_rejected_report': bool(lead_import.rejected_file),
+        'error_message': lead_import.error_message,
+        'created_at': lead_import.created_at,
+        'started_at': lead_import.started_at,
+        'completed_at': lead_import.completed_at,
+    }
+
+class LeadImportView(APIView):
+    permission_classes = [IsCompanyUser, CanManageLeads]
+    ALLOWED_EXTENSIONS = ('.csv', '.xlsx', '.xlsm')
+
+    def post(self, request):
+        upload = request.FILES.get('file')
+        if not upload:
+            return Response({'detail':'file is required.'}, status=400)
+        if not upload.name.lower().endswith(self.ALLOWED_EXTENSIONS):
+            return Response({'detail':'Upload a .csv or .xlsx file.'}, status=400)
+        membership = get_tenant_context(request).resolve(request.data.get('company_id'))
+        if not membership or not membership.can_manage_deals:
+            return Response({'detail':'Insufficient permissions to manage leads.'}, status=403)
+        lead_import = LeadImport.objects.create(
+            company_id=membership.company_id, created_by=request.user,
+            file=upload, original_filename=upload.name,
+        )
+        # Parsing, validation and inserts run in the worker; poll the detail endpoint
+        import_leads_task.delay(lead_import.id)
+        lead_import.refresh_from_db()
+        return Response(_lead_import_data(lead_import), status=202)
+
+class LeadImportDetailView(APIView):
+    permission_classes = [IsCompanyUser, CanManageLeads]
+
+    def get(self, request, pk):
+        lead_import = LeadImport.objects.filter(pk=pk, company_id__in=get_tenant_context(request).company_ids).first()
+        if not lead_import:
+            return Response({'detail':'Not found.'}, status=404)
+        return Response(_lead_import_data(lead_import))
+
+class LeadImportRejectedView(APIView):
+    permission_classes = [IsCompanyUser, CanManageLeads]
+
+    def get(self, request, pk):
+        lead_import = LeadImport.objects.filter(pk=pk, company_id__in=get_tenant_context(request).company_ids).first()
+        if not lead_import or not lead_import.rejected_file:
+            return Response({'detail':'Not found.'}, status=404)
+        filename = f"rejected_{lead_import.original_filename.rsplit('.', 1)[0]}.csv"
+        return FileResponse(lead_import.rejected_file.open('rb'), as_attachment=True, filename=filename, content_type='text/csv')
 
 # ---------------- Pipeline & Stage Views -----------------
 
@@ -196,12 +230,8 @@ class PipelineListCreateView(generics.ListCreateAPIView):
         return PipelineSerializer
 
     def get_queryset(self):
-        user = self.request.user
-        company_id = self.request.query_params.get('company_id')
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            return Pipeline.objects.filter(company_id=company_id, is_active=True).order_by('id')
-        memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-        return Pipeline.objects.filter(company_id__in=memberships, is_active=True).order_by('id')
+        tenant = get_tenant_context(self.request)
+        return Pipeline.objects.filter(company_id__in=tenant.scope(self.request.query_params.get('company_id')), is_active=True).order_by('id')
 
     def perform_create(self, serializer):
         serializer.save()
@@ -327,10 +357,30 @@ class ReorderStagesView(APIView):
         serializer.save()
         return Response({'detail':'Stages reordered.'})
 
+class PipelineStageDurationsView(APIView):
+    permission_classes = [IsCompanyUser]
+
+    def get(self, request, pk):
+        pipeline = Pipeline.objects.filter(pk=pk, company_id__in=get_tenant_context(request).company_ids).first()
+        if not pipeline:
+            return Response({'detail':'Not found.'}, status=404)
+        durations = stage_durations(pipeline)
+        data = []
+        for stage in pipeline.stages.order_by('order'):
+            row = durations.get(stage.id)
+            data.append({
+                'stage': {'id':stage.id,'name':stage.name,'order':stage.order},
+                'transitions': row['count'] if row else 0,
+                'median_days': round(row['median'] / 86400, 2) if row else None,
+                'p90_days': round(row['p90'] / 86400, 2) if row else None,
+            })
+        return Response({'pipeline_id': pipeline.id, 'stages': data})
+
 # ---------------- Deal Views -----------------
 
 class DealListCreateView(generics.ListCreateAPIView):
     permission_classes = [IsCompanyUser]
+    pagination_class = OptionalKeysetPagination
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -338,13 +388,8 @@ class DealListCreateView(generics.ListCreateAPIView):
         return DealListSerializer
 
     def get_queryset(self):
-        user = self.request.user
-        company_id = self.request.query_params.get('company_id')
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            qs = Deal.objects.filter(company_id=company_id, is_active=True)
-        else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            qs = Deal.objects.filter(company_id__in=memberships, is_active=True)
+        tenant = get_tenant_context(self.request)
+        qs = Deal.objects.filter(company_id__in=tenant.scope(self.request.query_params.get('company_id')), is_active=True)
         # Filters
         pipeline = self.request.query_params.get('pipeline')
         if pipeline:
@@ -369,17 +414,15 @@ class DealListCreateView(generics.ListCreateAPIView):
             qs = qs.filter(created_at__date__lte=end_date)
         search = self.request.query_params.get('search')
         if search:
-            qs = qs.filter(
-                Q(title__icontains=search) |
-                Q(company_name__icontains=search) |
-                Q(contact_name__icontains=search)
-            )
+            qs = apply_search(qs, search, ['title','company_name','contact_name'])
         sort = self.request.query_params.get('sort')
         if sort in ['created_at','value','expected_close_date']:
             direction = self.request.query_params.get('direction','desc')
             if direction == 'desc':
                 sort = f'-{sort}'
             qs = qs.order_by(sort)
+        elif search:
+            qs = qs.order_by('-search_rank','-created_at')
         else:
             qs = qs.order_by('-created_at')
         return qs.select_related('pipeline','stage','assigned_to')
@@ -497,78 +540,63 @@ class DealStatsView(APIView):
     permission_classes = [IsCompanyUser]
 
     def get(self, request):
-        user = request.user
-        company_id = request.query_params.get('company_id')
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            deals = Deal.objects.filter(company_id=company_id, is_active=True)
-        else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            deals = Deal.objects.filter(company_id__in=memberships, is_active=True)
-        from django.db.models.functions import TruncMonth
-        total_value = deals.aggregate(s=models.Sum('value'))['s'] or 0
-        by_stage = deals.values('stage__name').annotate(count=Count('id'), value=models.Sum('value')).order_by()
-        won = deals.filter(status='won')
-        total = deals.count() or 1
-        win_rate = won.count()/total*100
-        avg_deal_size = (deals.aggregate(a=models.Avg('value'))['a'] or 0)
-        # Avg days to close (won + lost with actual_close_date)
-        durations = list(
-            deals.exclude(actual_close_date__isnull=True).values_list('created_at','actual_close_date')
-        )
-        import datetime
-        avg_days = 0
-        if durations:
-            seconds = [ (datetime.datetime.combine(d2, datetime.time.min, tzinfo=None) - d1.replace(tzinfo=None)).total_seconds() for d1,d2 in durations ]
-            avg_days = (sum(seconds)/len(seconds))/86400
-        by_assigned = deals.values('assigned_to').annotate(count=Count('id'), value=models.Sum('value')).order_by()
-        monthly = deals.annotate(m=TruncMonth('created_at')).values('m').annotate(count=Count('id'), value=models.Sum('value')).order_by('m')
-        return Response({
-            'total_deals_value': float(total_value),
-            'deals_by_stage': {row['stage__name'] or '': {'count':row['count'],'value':float(row['value'] or 0)} for row in by_stage},
-            'win_rate_percent': round(win_rate,2),
-            'average_deal_size': float(avg_deal_size or 0),
-            'average_days_to_close': round(avg_days,2),
-            'deals_by_assigned_user': {str(row['assigned_to']): {'count':row['count'],'value':float(row['value'] or 0)} for row in by_assigned},
-            'monthly_trends': [ {'month':str(row['m'])[:7], 'count':row['count'], 'value':float(row['value'] or 0)} for row in monthly ],
-        })
+        tenant = get_tenant_context(request)
+        # Served from the daily rollups (apps.crm.rollups), not the deals table
+        return Response(deal_stats(tenant.scope(request.query_params.get('company_id'))))
 
 class DealsByStageView(APIView):
     permission_classes = [IsCompanyUser]
 
     def get(self, request):
-        user = request.user
-        pipeline_id = request.query_params.get('pipeline_id')
-        qs = Deal.objects.filter(is_active=True)
+        company_ids = get_tenant_context(request).company_ids
+        params = {}
+        for name in ('pipeline_id', 'stage_id', 'limit'):
+            if request.query_params.get(name):
+                try:
+                    params[name] = int(request.query_params[name])
+                except ValueError:
+                    return Response({'detail':f'{name} must be an integer.'}, status=400)
+        pipeline_id, stage_id = params.get('pipeline_id'), params.get('stage_id')
+        # Columns are only paged when asked to (``limit``, or one column via ``stage_id``)
+        limit = params.get('limit')
+        if limit is None and stage_id:
+            limit = DEFAULT_COLUMN_LIMIT
+        if limit is not None:
+            if limit < 1:
+                return Response({'detail':'limit must be positive.'}, status=400)
+            limit = min(limit, MAX_COLUMN_LIMIT)
+        deals = Deal.objects.filter(company_id__in=company_ids, is_active=True)
         if pipeline_id:
-            qs = qs.filter(pipeline_id=pipeline_id)
+            pipeline = Pipeline.objects.filter(pk=pipeline_id, company_id__in=company_ids).first()
+            if not pipeline:
+                return Response({'detail':'Pipeline not found.'}, status=404)
+            deals = deals.filter(pipeline=pipeline)
+            stages = DealStage.objects.filter(pipeline=pipeline).order_by('order')
         else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            qs = qs.filter(company_id__in=memberships)
-        data = {}
-        for stage in DealStage.objects.filter(pipeline_id=pipeline_id).order_by('order') if pipeline_id else DealStage.objects.filter(is_active=True).order_by('pipeline_id','order'):
-            deals = qs.filter(stage=stage).select_related('assigned_to','stage','pipeline')
-            data.setdefault(str(stage.id), {
-                'stage': {'id':stage.id,'name':stage.name,'order':stage.order,'probability':stage.probability},
-                'deals': DealListSerializer(deals, many=True).data
-            })
-        return Response(data)
+            stages = DealStage.objects.filter(pipeline__company_id__in=company_ids, is_active=True).order_by('pipeline_id','order')
+        # Lazy-load one column: ?stage_id=<id>&cursor=<next_cursor>
+        if stage_id:
+            stage = stages.filter(pk=stage_id).first()
+            if not stage:
+                return Response({'detail':'Stage not found.'}, status=404)
+            try:
+                return Response(load_column(stage, deals, limit, request.query_params.get('cursor')))
+            except ValueError:
+                return Response({'detail':'Invalid cursor.'}, status=400)
+        return Response(build_board(stages, deals, limit))
 
 # ---------------- Activity Views -----------------
 
 class ActivityListCreateView(generics.ListCreateAPIView):
     permission_classes = [IsCompanyUser]
+    pagination_class = OptionalKeysetPagination
 
     def get_serializer_class(self):
         return CreateActivitySerializer if self.request.method == 'POST' else ActivityListSerializer
 
     def get_queryset(self):
-        user = self.request.user
-        company_id = self.request.query_params.get('company_id')
-        if company_id and CompanyUser.objects.filter(user=user, company_id=company_id, is_active=True).exists():
-            qs = Activity.objects.filter(company_id=company_id)
-        else:
-            memberships = CompanyUser.objects.filter(user=user, is_active=True).values_list('company_id', flat=True)
-            qs = Activity.objects.filter(company_id__in=memberships)
+        tenant = get_tenant_context(self.request)
+        qs = Activity.objects.filter(company_id__in=tenant.scope(self.request.query_params.get('company_id')))
         # Filters
         lead = self.request.query_params.get('lead')
         if lead:
@@ -605,7 +633,7 @@ class ActivityDetailView(APIView):
     permission_classes = [IsCompanyUser]
 
     def get_object(self, pk, request):
-        memberships = CompanyUser.objects.filter(user=request.user, is_active=True).values_list('company_id', flat=True)
+        memberships = get_tenant_context(request).company_ids
         return Activity.objects.filter(pk=pk, company_id__in=memberships).select_related('user','lead','deal','deal__stage').first()
 
     def get(self, request, pk):
@@ -665,7 +693,7 @@ class MarkActivityCompleteView(APIView):
     permission_classes = [IsCompanyUser]
 
     def post(self, request, pk):
-        memberships = CompanyUser.objects.filter(user=request.user, is_active=True).values_list('company_id', flat=True)
+        memberships = get_tenant_context(request).company_ids
         obj = Activity.objects.filter(pk=pk, company_id__in=memberships).first()
         if not obj:
             return Response({'detail':'Not found.'}, status=404)
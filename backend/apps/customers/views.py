@@ -14,6 +14,8 @@ from datetime import timedelta
 from django.shortcuts import get_object_or_404
 
 from apps.authentication.models import Customer, CustomerCompany, User
+from apps.core.search import apply_search
+from apps.core.pagination import keyset_paginate, wants_keyset
 from apps.customers.models import (
     CustomerProfile, CustomerTag, CustomerSegment,
     Order, CustomerInteraction
@@ -89,15 +91,14 @@ class CustomerListView(APIView):
         # Search by name, email, phone
         search = request.query_params.get('search')
         if search:
-            queryset = queryset.filter(
-                Q(customer__user__first_name__icontains=search) |
-                Q(customer__user__last_name__icontains=search) |
-                Q(customer__user__email__icontains=search) |
-                Q(customer__user__phone__icontains=search)
+            queryset = apply_search(
+                queryset, search,
+                ['customer__user__first_name', 'customer__user__last_name', 'customer__user__email', 'customer__user__phone'],
+                vector_field='customer__search_vector',
             )
         
-        # Sort
-        sort_by = request.query_params.get('sort_by', '-created_at')
+        # Sort (best matches first when searching without an explicit sort)
+        sort_by = request.query_params.get('sort_by', '-search_rank' if search else '-created_at')
         valid_sorts = {
             'name': 'customer__user__first_name',
             '-name': '-customer__user__first_name',
@@ -114,10 +115,17 @@ class CustomerListView(APIView):
             'created_at': 'created_at',
             '-created_at': '-created_at',
         }
+        if search:
+            valid_sorts['-search_rank'] = '-search_rank'
         
         if sort_by in valid_sorts:
             queryset = queryset.order_by(valid_sorts[sort_by])
         
+        # Keyset pagination when the client asks for cursors
+        if wants_keyset(request):
+            customers, meta = keyset_paginate(queryset, request, default_page_size=20)
+            return Response({'results': CustomerListSerializer(customers, many=True).data, **meta})
+        
         # Pagination
         page = int(request.query_params.get('page', 1))
         page_size = int(request.query_params.get('page_size', 20))
@@ -487,6 +495,16 @@ class CustomersBySegmentView(APIView):
         # Apply segment criteria
         # TODO: Implement dynamic criteria evaluation
         # For now, return all customers as placeholder
+        segment_data = {
+            'id': segment.id,
+            'name': segment.name,
+            'description': segment.description
+        }
+        
+        # Keyset pagination when the client asks for cursors
+        if wants_keyset(request):
+            customers, meta = keyset_paginate(queryset, request, default_page_size=20)
+            return Response({'segment': segment_data, 'results': CustomerListSerializer(customers, many=True).data, **meta})
         
         # Pagination
         page = int(request.query_params.get('page', 1))
@@ -500,11 +518,7 @@ class CustomersBySegmentView(APIView):
         serializer = CustomerListSerializer(customers, many=True)
         
         return Response({
-            'segment': {
-                'id': segment.id,
-                'name': segment.name,
-                'description': segment.description
-            },
+            'segment': segment_data,
             'count': total_count,
             'page': page,
             'page_size': page_size,
@@ -585,6 +599,11 @@ class OrderListCreateView(APIView):
         if sort_by in valid_sorts:
             queryset = queryset.order_by(sort_by)
         
+        # Keyset pagination when the client asks for cursors
+        if wants_keyset(request):
+            orders, meta = keyset_paginate(queryset, request, default_page_size=20)
+            return Response({'results': OrderListSerializer(orders, many=True).data, **meta})
+        
         # Pagination
         page = int(request.query_params.get('page', 1))
         page_size = int(request.query_params.get('page_size', 20))
@@ -836,37 +855,48 @@ class CustomerOrdersView(APIView):
             customer=customer_company.customer
         ).order_by('-order_date')
         
+        # Calculate stats
+        paid = Q(payment_status='paid')
+        totals = orders.aggregate(
+            total_count=Count('id'),
+            total_spent=Sum('total_amount', filter=paid),
+            average_order=Avg('total_amount', filter=paid),
+        )
+        total_count = totals['total_count']
+        customer_data = {
+            'id': customer_company.id,
+            'name': customer_company.customer.get_full_name(),
+            'email': customer_company.customer.email
+        }
+        stats = {
+            'total_orders': total_count,
+            'total_spent': float(totals['total_spent'] or 0),
+            'average_order_value': float(totals['average_order'] or 0)
+        }
+        
+        # Keyset pagination when the client asks for cursors
+        if wants_keyset(request):
+            orders_page, meta = keyset_paginate(orders, request, default_page_size=20)
+            return Response({
+                'customer': customer_data,
+                'stats': stats,
+                'results': OrderListSerializer(orders_page, many=True).data,
+                **meta
+            })
+        
         # Pagination
         page = int(request.query_params.get('page', 1))
         page_size = int(request.query_params.get('page_size', 20))
         start = (page - 1) * page_size
         end = start + page_size
         
-        total_count = orders.count()
         orders_page = orders[start:end]
         
-        # Calculate stats
-        total_spent = orders.filter(payment_status='paid').aggregate(
-            total=Sum('total_amount')
-        )['total'] or 0
-        
-        average_order = orders.filter(payment_status='paid').aggregate(
-            avg=Avg('total_amount')
-        )['avg'] or 0
-        
         serializer = OrderListSerializer(orders_page, many=True)
         
         return Response({
-            'customer': {
-                'id': customer_company.id,
-                'name': customer_company.customer.get_full_name(),
-                'email': customer_company.customer.email
-            },
-            'stats': {
-                'total_orders': total_count,
-                'total_spent': float(total_spent),
-                'average_order_value': float(average_order)
-            },
+            'customer': customer_data,
+            'stats': stats,
             'count': total_count,
             'page': page,
             'page_size': page_size,
@@ -1,9 +1,9 @@
 from django.contrib import admin
-from .models import EmailAccount, EmailThread, Email, EmailAttachment, EmailTemplate, EmailRule, EmailSyncLog
+from .models import EmailAccount, EmailCategoryCounter, EmailThread, Email, EmailAttachment, EmailTemplate, EmailRule, EmailSyncLog, EmailFolderState, EmailCampaign, CampaignRecipient, EmailLink
 
 @admin.register(EmailAccount)
 class EmailAccountAdmin(admin.ModelAdmin):
-    list_display = ('email', 'company', 'user', 'provider', 'is_active', 'is_default', 'last_sync')
+    list_display = ('email', 'company', 'user', 'provider', 'is_active', 'is_default', 'last_sync', 'next_sync_at', 'sync_interval', 'unread_count', 'email_count')
     list_filter = ('provider', 'is_active', 'is_default')
     search_fields = ('email', 'username')
 
@@ -21,8 +21,8 @@ class EmailAdmin(admin.ModelAdmin):
 
 @admin.register(EmailAttachment)
 class EmailAttachmentAdmin(admin.ModelAdmin):
-    list_display = ('file_name', 'email', 'file_size', 'file_type')
-    search_fields = ('file_name', 'file_type')
+    list_display = ('file_name', 'email', 'file_size', 'file_type', 'sha256')
+    search_fields = ('file_name', 'file_type', 'sha256')
 
 @admin.register(EmailTemplate)
 class EmailTemplateAdmin(admin.ModelAdmin):
@@ -38,6 +38,39 @@ class EmailRuleAdmin(admin.ModelAdmin):
 
 @admin.register(EmailSyncLog)
 class EmailSyncLogAdmin(admin.ModelAdmin):
-    list_display = ('email_account', 'sync_started_at', 'sync_completed_at', 'emails_synced', 'status')
+    list_display = ('email_account', 'sync_started_at', 'sync_completed_at', 'emails_synced', 'status', 'latency_ms', 'error_count')
     list_filter = ('status',)
     search_fields = ('email_account__email',)
+
+
+@admin.register(EmailFolderState)
+class EmailFolderStateAdmin(admin.ModelAdmin):
+    list_display = ('email_account', 'folder', 'uidvalidity', 'last_uid', 'highest_modseq', 'last_synced_at')
+    search_fields = ('email_account__email', 'folder')
+
+
+@admin.register(EmailCampaign)
+class EmailCampaignAdmin(admin.ModelAdmin):
+    list_display = ('name', 'company', 'audience', 'status', 'total_recipients', 'sent_count', 'failed_count', 'created_at')
+    list_filter = ('status', 'audience')
+    search_fields = ('name',)
+
+
+@admin.register(CampaignRecipient)
+class CampaignRecipientAdmin(admin.ModelAdmin):
+    list_display = ('email_address', 'campaign', 'status', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('email_address',)
+
+
+@admin.register(EmailLink)
+class EmailLinkAdmin(admin.ModelAdmin):
+    list_display = ('url', 'url_hash')
+    search_fields = ('url',)
+
+
+@admin.register(EmailCategoryCounter)
+class EmailCategoryCounterAdmin(admin.ModelAdmin):
+    list_display = ('email_account', 'category', 'thread_count', 'unread_count')
+    list_filter = ('category',)
+    search_fields = ('email_account__email',)
@@ -3,4 +3,7 @@ from django.apps import AppConfig
 class EmailsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.emails'
-    verbose_name = 'Emails'
\ No newline at end of file
+    verbose_name = 'Emails'
+
+    def ready(self):
+        from . import signals  # noqa
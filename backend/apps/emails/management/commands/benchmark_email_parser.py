@@ -0,0 +1,91 @@
+import time
+from email import message_from_bytes
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.emails.services.email_parser import parse_email_message
+
+FIXTURES_DIR = Path(__file__).resolve().parents[2] / 'fixtures' / 'eml'
+
+
+def legacy_parse(raw):
+    """The previous parser (whole-message decode, BeautifulSoup, html2text), for comparison."""
+    from bs4 import BeautifulSoup
+    import html2text
+
+    msg = message_from_bytes(raw)
+    body_text = body_html = None
+    for part in msg.walk():
+        disposition = part.get('Content-Disposition', '')
+        if part.get_content_type() == 'text/plain' and 'attachment' not in disposition:
+            body_text = (part.get_payload(decode=True) or b'').decode(errors='ignore')
+        elif part.get_content_type() == 'text/html' and 'attachment' not in disposition:
+            body_html = (part.get_payload(decode=True) or b'').decode(errors='ignore')
+        elif 'attachment' in disposition:
+            part.get_payload(decode=True)
+    if body_html:
+        soup = BeautifulSoup(body_html, 'html.parser')
+        for tag in soup(['script', 'style']):
+            tag.decompose()
+        body_html = str(soup)
+        body_text = body_text or html2text.html2text(body_html)
+    return body_text, body_html
+
+
+def synthetic_newsletter(megabytes):
+    row = ('<tr><td style="padding:12px"><a href="https://shop.example.com/p/1?utm_source=newsletter">'
+           '<img src="https://cdn.example.com/1.jpg" width="96" alt="Item"></a></td>'
+           '<td><strong>Trail Harness</strong><br>Now only &euro;49.99</td></tr>\n')
+    html = '<html><body><table>' + row * (megabytes * 1024 * 1024 // len(row)) + '</table></body></html>'
+    return (
+        'Message-ID: <synthetic@example.com>\r\nFrom: news@shop.example.com\r\nSubject: Synthetic newsletter\r\n'
+        'MIME-Version: 1.0\r\nContent-Type: text/html; charset="utf-8"\r\nContent-Transfer-Encoding: 8bit\r\n\r\n'
+    ).encode() + html.encode()
+
+
+class Command(BaseCommand):
+    help = 'Measure parse_email_message throughput over .eml files (default: the bundled fixtures)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='.eml files or directories of them')
+        parser.add_argument('--repeat', type=int, default=20, help='Passes over the corpus per parser')
+        parser.add_argument('--synthetic-mb', type=int, default=0, help='Add a generated HTML newsletter of this size')
+        parser.add_argument('--no-legacy', action='store_true', help='Skip timing the previous parser')
+
+    def handle(self, *args, **options):
+        corpus = self.load(options['paths'] or [FIXTURES_DIR])
+        if options['synthetic_mb']:
+            corpus.append(('synthetic', synthetic_newsletter(options['synthetic_mb'])))
+        if not corpus:
+            raise CommandError('No .eml files found')
+        total_bytes = sum(len(raw) for _, raw in corpus)
+        self.stdout.write(f"{len(corpus)} messages, {total_bytes / 1024:.0f} KiB, {options['repeat']} passes")
+
+        current = self.measure(parse_email_message, corpus, options['repeat'])
+        self.report('streaming parser', current, len(corpus), total_bytes, options['repeat'])
+        if not options['no_legacy']:
+            legacy = self.measure(legacy_parse, corpus, options['repeat'])
+            self.report('previous parser', legacy, len(corpus), total_bytes, options['repeat'])
+            self.stdout.write(self.style.SUCCESS(f'Speedup: {legacy / current:.1f}x'))
+
+    def load(self, paths):
+        corpus = []
+        for path in map(Path, paths):
+            files = sorted(path.glob('*.eml')) if path.is_dir() else [path]
+            corpus.extend((f.name, f.read_bytes()) for f in files)
+        return corpus
+
+    def measure(self, parse, corpus, repeat):
+        parse(corpus[0][1])  # warm up imports and caches
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for _, raw in corpus:
+                parse(raw)
+        return time.perf_counter() - start
+
+    def report(self, label, elapsed, messages, total_bytes, repeat):
+        self.stdout.write(
+            f'{label:>17}: {elapsed:.3f}s, {messages * repeat / elapsed:.0f} msg/s, '
+            f'{total_bytes * repeat / elapsed / 1024 / 1024:.1f} MiB/s'
+        )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from apps.emails.services.idle_listener import run_idle_listener
+
+
+class Command(BaseCommand):
+    help = 'Keep IMAP IDLE sessions open for active email accounts and sync new mail as it arrives'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--refresh', type=int, default=60, help='Seconds between reloads of the account list')
+        parser.add_argument('--max-accounts', type=int, default=None, help='Watch at most this many accounts in this process')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('Listening for new mail (Ctrl+C to stop)'))
+        try:
+            run_idle_listener(refresh_seconds=options['refresh'], max_accounts=options['max_accounts'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from apps.core.search import search_enabled
+from apps.emails.models import Email
+from apps.emails.services.email_search import refresh_email_search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild full-text search vectors for stored emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--missing-only', action='store_true', help='Only emails that have no vector yet')
+
+    def handle(self, *args, **options):
+        if not search_enabled():
+            self.stdout.write(self.style.WARNING('Full-text search requires PostgreSQL; nothing to do.'))
+            return
+        queryset = Email.objects.all()
+        if options['missing_only']:
+            queryset = queryset.filter(search_vector__isnull=True)
+        batch, total = [], 0
+        for email_id in queryset.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=options['batch_size']):
+            batch.append(email_id)
+            if len(batch) >= options['batch_size']:
+                total += refresh_email_search(batch)
+                batch = []
+        total += refresh_email_search(batch)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} email search vectors"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from apps.emails.services.mailbox_counters import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized unread/total inbox counters (also backfills them after upgrading)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_ids', nargs='*', type=int, help='Email account ids (default: all)')
+
+    def handle(self, *args, **options):
+        drifted = reconcile(options['account_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f"Repaired counters of {len(drifted)} email accounts"))
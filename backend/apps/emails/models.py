@@ -1,4 +1,6 @@
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.utils import timezone
 
@@ -30,6 +32,17 @@ class EmailAccount(models.Model):
     is_default = models.BooleanField(default=False)
     sync_enabled = models.BooleanField(default=True)
     last_sync = models.DateTimeField(null=True, blank=True)
+    sync_failures = models.IntegerField(default=0)  # consecutive failed syncs
+    sync_retry_at = models.DateTimeField(null=True, blank=True)  # backoff: skipped by the sync pool until then
+    idle_heartbeat_at = models.DateTimeField(null=True, blank=True)  # set while an IMAP IDLE listener watches the inbox
+    # Adaptive polling (services.sync_pool): the pool syncs the account once next_sync_at passes
+    next_sync_at = models.DateTimeField(default=timezone.now)
+    sync_interval = models.IntegerField(default=300)  # seconds, adapted to how often mail arrives
+    inbox_viewed_at = models.DateTimeField(null=True, blank=True)  # polled faster while someone has the inbox open
+    send_rate_per_minute = models.IntegerField(null=True, blank=True)  # campaign throttle; EMAIL_SEND_RATE_PER_MINUTE when empty
+    # Maintained by services.mailbox_counters
+    email_count = models.IntegerField(default=0)
+    unread_count = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -37,6 +50,7 @@ class EmailAccount(models.Model):
         indexes = [
             models.Index(fields=['company', 'email']),
             models.Index(fields=['user', 'is_default']),
+            models.Index(fields=['next_sync_at'], name='email_account_due_idx', condition=models.Q(is_active=True, sync_enabled=True)),
         ]
 
     def __str__(self):
@@ -77,6 +91,7 @@ class EmailThread(models.Model):
     company = models.ForeignKey('authentication.Company', on_delete=models.CASCADE, related_name='email_threads')
     email_account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='threads')
     subject = models.CharField(max_length=500)
+    normalized_subject = models.CharField(max_length=500, blank=True)  # subject without Re:/Fwd: prefixes
     participants = models.JSONField(default=list)
     lead = models.ForeignKey('crm.Lead', null=True, blank=True, on_delete=models.SET_NULL, related_name='email_threads')
     deal = models.ForeignKey('crm.Deal', null=True, blank=True, on_delete=models.SET_NULL, related_name='email_threads')
@@ -94,12 +109,27 @@ class EmailThread(models.Model):
             models.Index(fields=['company', 'last_message_at']),
             models.Index(fields=['email_account', 'is_read']),
             models.Index(fields=['category']),
+            models.Index(fields=['email_account', 'normalized_subject']),
         ]
 
     def __str__(self):
         return f"Thread: {self.subject[:50]} ({self.company_id})"
 
 
+class EmailCategoryCounter(models.Model):
+    """Thread totals per account and category, maintained by services.mailbox_counters."""
+    email_account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='category_counters')
+    category = models.CharField(max_length=32, choices=EmailThread.CATEGORY_CHOICES)
+    thread_count = models.IntegerField(default=0)
+    unread_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('email_account', 'category')
+
+    def __str__(self):
+        return f"{self.email_account_id}/{self.category}: {self.unread_count}/{self.thread_count}"
+
+
 class Email(models.Model):
     DIRECTION_INBOUND = 'inbound'
     DIRECTION_OUTBOUND = 'outbound'
@@ -125,7 +155,9 @@ class Email(models.Model):
 
     thread = models.ForeignKey(EmailThread, on_delete=models.CASCADE, related_name='emails')
     email_account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='emails')
-    message_id = models.CharField(max_length=255, unique=True)
+    message_id = models.CharField(max_length=255)
+    in_reply_to = models.CharField(max_length=255, blank=True)
+    references = models.TextField(blank=True)  # space separated Message-IDs, oldest first
     from_email = models.EmailField()
     from_name = models.CharField(max_length=255, blank=True)
     to_emails = models.JSONField(default=list)
@@ -147,31 +179,75 @@ class Email(models.Model):
     clicks_count = models.IntegerField(default=0)
     reply_to = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='replies')
     has_attachments = models.BooleanField(default=False)
+    template = models.ForeignKey('EmailTemplate', null=True, blank=True, on_delete=models.SET_NULL, related_name='emails')  # for engagement reporting
     created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='sent_emails')
     created_at = models.DateTimeField(auto_now_add=True)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)  # see services.email_search
+    ai_categorized_at = models.DateTimeField(null=True, blank=True)  # set by the AI classification stage
 
     class Meta:
+        # Each account keeps its own copy of a message delivered to several accounts
+        unique_together = ('email_account', 'message_id')
         indexes = [
             models.Index(fields=['thread', 'sent_at']),
             models.Index(fields=['email_account', 'status']),
             models.Index(fields=['direction']),
+            GinIndex(fields=['search_vector'], name='email_search_gin'),
+            models.Index(
+                fields=['created_at'], name='email_ai_pending_idx',
+                condition=models.Q(ai_categorized_at__isnull=True, direction='inbound'),
+            ),
         ]
 
     def __str__(self):
         return f"Email {self.id} - {self.subject[:40]}"
 
 
+class EmailMessageRef(models.Model):
+    """Message-ID -> thread lookup used to attach replies to their conversation.
+
+    Holds every id a thread's messages carry or reference, so a reply whose
+    parent was never synced still lands next to its siblings.
+    """
+    email_account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='message_refs')
+    message_id = models.CharField(max_length=255)
+    thread = models.ForeignKey(EmailThread, on_delete=models.CASCADE, related_name='message_refs')
+
+    class Meta:
+        unique_together = ('email_account', 'message_id')
+
+    def __str__(self):
+        return f"{self.message_id} -> {self.thread_id}"
+
+
 class EmailAttachment(models.Model):
     email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name='attachments')
     file_name = models.CharField(max_length=255)
     file_size = models.IntegerField()
     file_type = models.CharField(max_length=255)
-    file_path = models.FileField(upload_to='email_attachments/')
+    # Content-addressed blob (services.attachment_store); empty until downloaded
+    file_path = models.FileField(upload_to='email_attachments/', max_length=255, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    # Where the body still lives on the server, for lazy download
+    imap_folder = models.CharField(max_length=255, blank=True)
+    imap_uidvalidity = models.BigIntegerField(null=True, blank=True)
+    imap_uid = models.BigIntegerField(null=True, blank=True)
+    imap_section = models.CharField(max_length=64, blank=True)
+    transfer_encoding = models.CharField(max_length=32, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], name='attachment_pending_idx', condition=models.Q(file_path='', imap_uid__isnull=False)),
+        ]
+
     def __str__(self):
         return self.file_name
 
+    @property
+    def is_downloaded(self):
+        return bool(self.file_path)
+
 
 class EmailTemplate(models.Model):
     CATEGORY_LEAD = 'lead'
@@ -250,6 +326,159 @@ class EmailSyncLog(models.Model):
     emails_synced = models.IntegerField(default=0)
     status = models.CharField(max_length=32, choices=STATUS_CHOICES, default=STATUS_RUNNING)
     error_message = models.TextField(null=True, blank=True)
+    latency_ms = models.IntegerField(null=True, blank=True)
+    error_count = models.IntegerField(default=0)  # the account's consecutive failures after this run
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['email_account', 'sync_started_at']),
+        ]
+
+    def __str__(self):
+        return f"Sync {self.id} - {self.email_account.email} ({self.status})"
+
+class EmailFolderState(models.Model):
+    """IMAP checkpoint per (account, folder): only UIDs above last_uid are fetched."""
+    email_account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='folder_states')
+    folder = models.CharField(max_length=255, default='INBOX')
+    uidvalidity = models.BigIntegerField(null=True, blank=True)
+    last_uid = models.BigIntegerField(default=0)
+    highest_modseq = models.BigIntegerField(null=True, blank=True)  # CONDSTORE servers only
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    failed_uids = models.JSONField(default=dict, blank=True)  # uid -> failed attempts; retried on later syncs
+
+    class Meta:
+        unique_together = ('email_account', 'folder')
+
+    def __str__(self):
+        return f"{self.email_account_id}:{self.folder} uid>{self.last_uid}"
+
+
+
+class EmailCampaign(models.Model):
+    AUDIENCE_SEGMENT = 'segment'
+    AUDIENCE_LEADS = 'leads'
+    AUDIENCE_CHOICES = [
+        (AUDIENCE_SEGMENT, 'Customer segment'),
+        (AUDIENCE_LEADS, 'Leads'),
+    ]
+
+    STATUS_DRAFT = 'draft'
+    STATUS_QUEUED = 'queued'
+    STATUS_SENDING = 'sending'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_DRAFT, 'Draft'),
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    company = models.ForeignKey('authentication.Company', on_delete=models.CASCADE, related_name='email_campaigns')
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='email_campaigns')
+    name = models.CharField(max_length=255)
+    template = models.ForeignKey(EmailTemplate, on_delete=models.PROTECT, related_name='campaigns')
+    email_account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='campaigns')
+    audience = models.CharField(max_length=16, choices=AUDIENCE_CHOICES)
+    segment = models.ForeignKey('customers.CustomerSegment', null=True, blank=True, on_delete=models.SET_NULL, related_name='email_campaigns')
+    lead_filters = models.JSONField(default=dict, blank=True)  # status, lead_source, assigned_to
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_DRAFT)
+    total_recipients = models.IntegerField(default=0)
+    sent_count = models.IntegerField(default=0)
+    failed_count = models.IntegerField(default=0)
+    error_message = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['company', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class CampaignRecipient(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'  # claimed by a chunk task; left here only if a worker died mid-send
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    campaign = models.ForeignKey(EmailCampaign, on_delete=models.CASCADE, related_name='recipients')
+    email_address = models.EmailField()
+    name = models.CharField(max_length=255, blank=True)
+    lead = models.ForeignKey('crm.Lead', null=True, blank=True, on_delete=models.SET_NULL, related_name='campaign_recipients')
+    customer = models.ForeignKey('authentication.Customer', null=True, blank=True, on_delete=models.SET_NULL, related_name='campaign_recipients')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    error = models.CharField(max_length=500, blank=True)
+    email = models.ForeignKey(Email, null=True, blank=True, on_delete=models.SET_NULL, related_name='campaign_recipients')
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('campaign', 'email_address')
+        indexes = [
+            models.Index(fields=['campaign', 'status']),
+        ]
+
+    def __str__(self):
+        return f"{self.email_address} ({self.status})"
+
+
+class EmailEngagementEvent(models.Model):
+    """One open or click, append-only.
+
+    On PostgreSQL the table is range-partitioned by month on occurred_at
+    (see services.engagement.ensure_event_partitions), so there is no
+    database-level foreign key and rows outlive deleted emails.
+    """
+    KIND_OPEN = 1
+    KIND_CLICK = 2
+    KIND_CHOICES = [
+        (KIND_OPEN, 'Open'),
+        (KIND_CLICK, 'Click'),
+    ]
+
+    UA_UNKNOWN = 0
+    UA_DESKTOP = 1
+    UA_MOBILE = 2
+    UA_PROXY = 3  # image proxies / privacy prefetch: the open may not be a human
+    UA_BOT = 4
+    UA_CHOICES = [
+        (UA_UNKNOWN, 'Unknown'),
+        (UA_DESKTOP, 'Desktop'),
+        (UA_MOBILE, 'Mobile'),
+        (UA_PROXY, 'Proxy'),
+        (UA_BOT, 'Bot'),
+    ]
+
+    email = models.ForeignKey(Email, on_delete=models.DO_NOTHING, db_constraint=False, related_name='engagement_events')
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    url_hash = models.BigIntegerField(null=True, blank=True)  # clicks: EmailLink.url_hash
+    ua_class = models.PositiveSmallIntegerField(choices=UA_CHOICES, default=UA_UNKNOWN)
+    occurred_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['email', 'kind']),
+            models.Index(fields=['kind', 'occurred_at']),
+        ]
+
+
+class EmailLink(models.Model):
+    """Clicked URLs, keyed by the hash stored on EmailEngagementEvent."""
+    url_hash = models.BigIntegerField(unique=True)
+    url = models.TextField()
 
     def __str__(self):
-        return f"Sync {self.id} - {self.email_account.email} ({self.status})"
\ No newline at end of file
+        return self.url[:80]
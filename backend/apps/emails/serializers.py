@@ -1,11 +1,12 @@
 from rest_framework import serializers
 from email_validator import validate_email, EmailNotValidError
 from django.conf import settings
-from apps.emails.models import EmailAccount, EmailTemplate, Email, EmailThread
+from apps.emails.models import EmailAccount, EmailTemplate, Email, EmailAttachment, EmailThread, EmailCampaign, CampaignRecipient
+from apps.emails.services.mail_merge import MAX_MERGE_RECIPIENTS, RECIPIENT_TYPES
 
 
 class EmailAccountSerializer(serializers.ModelSerializer):
-    unread_count = serializers.SerializerMethodField()
+    unread_count = serializers.IntegerField(read_only=True)
     last_sync = serializers.DateTimeField(read_only=True)
     password = serializers.SerializerMethodField()
 
@@ -16,9 +17,6 @@ class EmailAccountSerializer(serializers.ModelSerializer):
             'username', 'is_active', 'is_default', 'sync_enabled', 'last_sync', 'unread_count', 'password'
         ]
 
-    def get_unread_count(self, obj):
-        return obj.emails.filter(is_read=False).count()
-
     def get_password(self, obj):
         return '********'
 
@@ -68,10 +66,18 @@ class GmailOAuthSerializer(serializers.Serializer):
         return account
 
 
+class EmailAttachmentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EmailAttachment
+        fields = ['id', 'file_name', 'file_size', 'file_type', 'sha256', 'is_downloaded']
+
+
 class EmailSerializer(serializers.ModelSerializer):
+    attachments = EmailAttachmentSerializer(many=True, read_only=True)
+
     class Meta:
         model = Email
-        fields = '__all__'
+        exclude = ['search_vector']
 
 
 class SendEmailSerializer(serializers.Serializer):
@@ -87,6 +93,7 @@ class SendEmailSerializer(serializers.Serializer):
     def create(self, validated_data):
         from apps.emails.services.email_sender import send_email
         from apps.emails.services.template_renderer import render_template
+        from apps.emails.services.mail_merge import record_usage
         user = self.context['request'].user
         from_account = EmailAccount.objects.filter(user=user, is_default=True).first() or EmailAccount.objects.filter(user=user).first()
         reply_to = None
@@ -98,6 +105,7 @@ class SendEmailSerializer(serializers.Serializer):
         body_text = validated_data.get('body_text')
 
         # Template processing
+        template = None
         if validated_data.get('template_id'):
             template = EmailTemplate.objects.get(id=validated_data['template_id'])
             context = _build_template_context(user)
@@ -106,9 +114,7 @@ class SendEmailSerializer(serializers.Serializer):
             body_html = rendered['body_html']
             if not body_text:
                 body_text = rendered['body_text']
-            # increment usage
-            template.usage_count = (template.usage_count or 0) + 1
-            template.save(update_fields=['usage_count'])
+            record_usage(template.id, 1)
 
         email = send_email(
             to=validated_data['to_emails'],
@@ -119,6 +125,8 @@ class SendEmailSerializer(serializers.Serializer):
             cc=validated_data.get('cc_emails'),
             bcc=validated_data.get('bcc_emails'),
             reply_to_email=reply_to,
+            deliver=False,  # the view queues send_email_task
+            template=template,
         )
         return email
 
@@ -130,6 +138,14 @@ class EmailThreadListSerializer(serializers.ModelSerializer):
         fields = ['id', 'subject', 'participants', 'last_message_at', 'message_count', 'is_read', 'is_starred', 'category', 'sentiment']
 
 
+class EmailSearchResultSerializer(EmailThreadListSerializer):
+    rank = serializers.FloatField(source='search_rank', read_only=True)
+    snippet = serializers.CharField(read_only=True)  # HTML-escaped, matches wrapped in <mark>
+
+    class Meta(EmailThreadListSerializer.Meta):
+        fields = EmailThreadListSerializer.Meta.fields + ['rank', 'snippet']
+
+
 class EmailThreadDetailSerializer(serializers.ModelSerializer):
     emails = EmailSerializer(many=True, read_only=True)
     class Meta:
@@ -143,16 +159,8 @@ ALLOWED_TEMPLATE_VARIABLES = {
 
 
 def _build_template_context(user):
-    company_user = user.company_users.first()
-    company = company_user.company if company_user else None
-    return {
-        'customer_name': '',
-        'company_name': company.company_name if company else '',
-        'user_name': user.get_full_name() or user.username,
-        'lead_name': '',
-        'deal_title': '',
-        'order_number': '',
-    }
+    from apps.emails.services.mail_merge import sender_context
+    return sender_context(user)
 
 
 class EmailTemplateSerializer(serializers.ModelSerializer):
@@ -164,7 +172,7 @@ class EmailTemplateSerializer(serializers.ModelSerializer):
 class CreateTemplateSerializer(serializers.ModelSerializer):
     class Meta:
         model = EmailTemplate
-        fields = ['name', 'subject', 'body_html', 'body_text', 'category']
+        fields = ['id', 'name', 'subject', 'body_html', 'body_text', 'category']
 
     def validate(self, attrs):
         import re
@@ -193,3 +201,57 @@ class TemplatePreviewSerializer(serializers.Serializer):
             context.update({k: v for k, v in validated_data['sample_data'].items() if k in ALLOWED_TEMPLATE_VARIABLES})
         return render_template(template, context)
 
+
+class MailMergeSerializer(serializers.Serializer):
+    recipient_type = serializers.ChoiceField(choices=RECIPIENT_TYPES)
+    ids = serializers.ListField(child=serializers.IntegerField(), min_length=1, max_length=MAX_MERGE_RECIPIENTS)
+    send = serializers.BooleanField(default=False)
+    email_account = serializers.PrimaryKeyRelatedField(queryset=EmailAccount.objects.all(), required=False)
+
+    def validate_email_account(self, account):
+        if account.user_id != self.context['request'].user.id:
+            raise serializers.ValidationError('Email account not found.')
+        return account
+
+
+class EmailCampaignSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EmailCampaign
+        fields = [
+            'id', 'name', 'template', 'email_account', 'audience', 'segment', 'lead_filters', 'status',
+            'total_recipients', 'sent_count', 'failed_count', 'error_message', 'created_at', 'started_at', 'completed_at',
+        ]
+        read_only_fields = fields
+
+
+class CreateCampaignSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = EmailCampaign
+        fields = ['name', 'template', 'email_account', 'audience', 'segment', 'lead_filters']
+
+    def validate(self, attrs):
+        user = self.context['request'].user
+        template = attrs['template']
+        if template.created_by_id != user.id:
+            raise serializers.ValidationError({'template': 'Template not found.'})
+        if attrs['email_account'].user_id != user.id:
+            raise serializers.ValidationError({'email_account': 'Email account not found.'})
+        segment = attrs.get('segment')
+        if attrs['audience'] == EmailCampaign.AUDIENCE_SEGMENT:
+            if segment is None or segment.company_id != template.company_id:
+                raise serializers.ValidationError({'segment': 'A segment of the template\'s company is required.'})
+        elif segment is not None:
+            raise serializers.ValidationError({'segment': 'Only used with the segment audience.'})
+        if not isinstance(attrs.get('lead_filters', {}), dict):
+            raise serializers.ValidationError({'lead_filters': 'Must be an object.'})
+        return attrs
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        return EmailCampaign.objects.create(company_id=validated_data['template'].company_id, created_by=user, **validated_data)
+
+
+class CampaignRecipientSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CampaignRecipient
+        fields = ['id', 'email_address', 'name', 'lead', 'customer', 'status', 'error', 'sent_at']
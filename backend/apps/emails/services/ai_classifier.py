@@ -0,0 +1,262 @@
+"""AI email classification, off the sync path.
+
+Synced emails only get the rule-based category (services.email_categorizer).
+``classify_pending`` (run by Celery beat while AI_EMAIL_SORTING_ENABLED)
+picks up recent inbound emails the model has not seen yet and:
+
+- answers repeats from the cache, keyed by a hash of the normalised
+  subject and body, so recurring newsletters cost one call ever;
+- sends the rest to the backend several emails per request;
+- retries the emails of a failed batch one by one, so one email the model
+  chokes on does not sink its neighbours; an email the model leaves out of
+  its answer, or answers with nothing usable, counts as failed and is
+  neither cached nor marked. An email that fails on its own
+  MAX_ATTEMPTS times is marked attempted and keeps its rule-based category;
+- stops calling a failing backend for a while (CircuitBreaker); emails it
+  could not classify stay pending for the next run.
+
+Backends: ``openai`` and ``stub``, a deterministic local classifier for
+tests and development (settings.AI_EMAIL_BACKEND).
+"""
+
+import hashlib
+import json
+import logging
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from apps.emails.models import Email, EmailThread
+from .mailbox_counters import set_category
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_KEY = 'emails:ai-category:{digest}'
+RESULT_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+PENDING_MAX_AGE = timedelta(days=2)  # older unclassified mail is left alone
+ATTEMPTS_CACHE_KEY = 'emails:ai-attempts:{digest}'
+MAX_ATTEMPTS = 3  # failed single-email requests before an email is given up on
+BODY_CHARS = 1000
+
+CATEGORY_ALIASES = {
+    'lead': EmailThread.CATEGORY_LEAD,
+    'deal': EmailThread.CATEGORY_DEAL,
+    'customer': EmailThread.CATEGORY_CUSTOMER,
+    'customer support': EmailThread.CATEGORY_CUSTOMER,
+    'support': EmailThread.CATEGORY_CUSTOMER,
+    'complaint': EmailThread.CATEGORY_COMPLAINT,
+    'promotional': EmailThread.CATEGORY_PROMOTIONS,
+    'promotions': EmailThread.CATEGORY_PROMOTIONS,
+    'social': EmailThread.CATEGORY_SOCIAL,
+    'other': EmailThread.CATEGORY_OTHER,
+}
+SENTIMENTS = {value for value, _ in EmailThread.SENTIMENT_CHOICES}
+
+_URLS = re.compile(r'https?://\S+')
+_DIGITS = re.compile(r'\d+')
+_SPACE = re.compile(r'\s+')
+
+
+def content_hash(email):
+    """Digest of subject and body with links, numbers and whitespace normalised away."""
+    text = f"{email.subject}\n{(email.body_text or '')[:BODY_CHARS * 2]}".lower()
+    text = _SPACE.sub(' ', _DIGITS.sub('0', _URLS.sub('', text))).strip()
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def normalize_result(result):
+    """{'category', 'sentiment'} restricted to EmailThread choices, or None when neither is usable."""
+    if not isinstance(result, dict):
+        return None
+    category = CATEGORY_ALIASES.get(str(result.get('category') or '').strip().lower())
+    sentiment = str(result.get('sentiment') or '').strip().lower()
+    sentiment = sentiment if sentiment in SENTIMENTS else None
+    if category is None and sentiment is None:
+        return None
+    return {'category': category, 'sentiment': sentiment}
+
+
+class CircuitBreaker:
+    """Shared-cache breaker: opens after ``threshold`` consecutive failures for ``reset_after`` seconds.
+
+    The failure count is kept while open, so the first call after the pause
+    is a trial: one more failure reopens it, a success closes it.
+    """
+
+    def __init__(self, name, threshold=5, reset_after=300):
+        self.failures_key = f'emails:breaker:{name}:failures'
+        self.open_key = f'emails:breaker:{name}:open'
+        self.threshold = threshold
+        self.reset_after = reset_after
+
+    def allow(self):
+        return not cache.get(self.open_key)
+
+    def record_success(self):
+        cache.delete(self.failures_key)
+
+    def record_failure(self):
+        cache.add(self.failures_key, 0, timeout=None)
+        if cache.incr(self.failures_key) >= self.threshold:
+            cache.set(self.open_key, 1, timeout=self.reset_after)
+
+
+class StubBackend:
+    """Keyword classifier with the same interface as the model backends."""
+
+    RULES = [
+        (('unsubscribe', 'newsletter', '% off', 'sale'), 'promotional'),
+        (('refund', 'complaint', 'unacceptable', 'angry'), 'complaint'),
+        (('quote', 'pricing', 'interested in'), 'lead'),
+        (('invoice', 'contract', 'proposal'), 'deal'),
+        (('help', 'support', 'not working'), 'customer support'),
+    ]
+
+    def classify(self, emails):
+        results = []
+        for email in emails:
+            text = f"{email.subject} {email.body_text}".lower()
+            category = next((cat for words, cat in self.RULES if any(w in text for w in words)), 'other')
+            sentiment = 'negative' if category == 'complaint' else 'neutral'
+            results.append({'category': category, 'sentiment': sentiment})
+        return results
+
+
+class OpenAIBackend:
+    model = 'gpt-4o-mini'
+
+    def __init__(self, api_key):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=api_key, timeout=30, max_retries=0)
+
+    def classify(self, emails):
+        items = [{'id': i, 'subject': e.subject, 'body': (e.body_text or '')[:BODY_CHARS]} for i, e in enumerate(emails)]
+        prompt = (
+            "Categorize each email into one of: Lead, Deal, Customer Support, Complaint, Promotional, Social, Other. "
+            "Also provide sentiment (Positive, Neutral, Negative). Return a JSON object "
+            '{"results": [{"id": <id>, "category": ..., "sentiment": ...}]} with one entry per email.\n'
+            f"Emails: {json.dumps(items)}"
+        )
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.2,
+            response_format={"type": "json_object"},
+        )
+        data = json.loads(response.choices[0].message.content)
+        by_id = {}
+        for row in data.get('results', []):
+            try:
+                by_id[int(row['id'])] = row  # models sometimes echo ids as strings
+            except (KeyError, TypeError, ValueError):
+                continue
+        # None for an email the model left out
+        return [by_id.get(i) for i in range(len(emails))]
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'AI_EMAIL_BACKEND', 'openai')
+        if name == 'stub':
+            _backend = StubBackend()
+        elif getattr(settings, 'OPENAI_API_KEY', ''):
+            _backend = OpenAIBackend(settings.OPENAI_API_KEY)
+    return _backend
+
+
+def pending_emails(limit):
+    return (
+        Email.objects.filter(
+            direction=Email.DIRECTION_INBOUND, ai_categorized_at__isnull=True,
+            created_at__gte=timezone.now() - PENDING_MAX_AGE,
+        )
+        .order_by('created_at')[:limit]
+    )
+
+
+def classify_pending(limit=200, batch_size=None, backend=None):
+    """Classify up to ``limit`` pending emails; returns how many were classified."""
+    backend = backend or get_backend()
+    if backend is None:
+        return 0
+    batch_size = batch_size or getattr(settings, 'AI_EMAIL_BATCH_SIZE', 10)
+    breaker = CircuitBreaker('ai-categorizer')
+    emails = list(pending_emails(limit))
+    digests = {email.id: content_hash(email) for email in emails}
+    results = {
+        key.rpartition(':')[2]: value
+        for key, value in cache.get_many([RESULT_CACHE_KEY.format(digest=d) for d in set(digests.values())]).items()
+    }
+
+    # One request slot per distinct content
+    unknown = list({digests[e.id]: e for e in emails if digests[e.id] not in results}.values())
+    batches = [unknown[start:start + batch_size] for start in range(0, len(unknown), batch_size)]
+    given_up = set()
+
+    def retry(batch, failed):
+        # Out of a shared batch: again one by one; on its own: one attempt used
+        if len(batch) > 1:
+            batches[:0] = [[email] for email in failed]
+        elif _record_attempt(digests[batch[0].id]) >= MAX_ATTEMPTS:
+            given_up.add(digests[batch[0].id])
+
+    while batches:
+        if not breaker.allow():
+            logger.warning('AI categorizer circuit open; %s emails left pending', sum(len(batch) for batch in batches))
+            break
+        batch = batches.pop(0)
+        try:
+            answers = [normalize_result(answer) for answer in backend.classify(batch)]
+        except Exception as exc:  # noqa: BLE001
+            breaker.record_failure()
+            logger.warning('AI categorization batch failed: %s', exc)
+            retry(batch, batch)
+            continue
+        answers += [None] * (len(batch) - len(answers))
+        fresh = {digests[email.id]: answer for email, answer in zip(batch, answers) if answer}
+        missed = [email for email, answer in zip(batch, answers) if not answer]
+        if fresh:
+            breaker.record_success()
+            results.update(fresh)
+            cache.set_many({RESULT_CACHE_KEY.format(digest=d): answer for d, answer in fresh.items()}, RESULT_CACHE_TIMEOUT)
+        else:
+            breaker.record_failure()
+        if missed:
+            logger.warning('AI categorizer returned no usable answer for %s of %s emails', len(missed), len(batch))
+            retry(batch, missed)
+
+    if given_up:
+        logger.warning('AI categorizer gave up on %s emails after %s failed attempts', len(given_up), MAX_ATTEMPTS)
+        Email.objects.filter(id__in=[e.id for e in emails if digests[e.id] in given_up]).update(ai_categorized_at=timezone.now())
+    classified = [email for email in emails if digests[email.id] in results]
+    _apply(classified, {email.id: results[digests[email.id]] for email in classified})
+    return len(classified)
+
+
+def _record_attempt(digest):
+    """Count a failed single-email request for ``digest``; returns the attempts so far."""
+    key = ATTEMPTS_CACHE_KEY.format(digest=digest)
+    cache.add(key, 0, timeout=int(PENDING_MAX_AGE.total_seconds()))
+    return cache.incr(key)
+
+
+def _apply(emails, answers):
+    updates = {}
+    for email in emails:
+        answer = answers[email.id]
+        if answer['category'] or answer['sentiment']:
+            updates.setdefault((answer['category'], answer['sentiment']), []).append(email.thread_id)
+    for (category, sentiment), thread_ids in updates.items():
+        changes = {'sentiment': sentiment} if sentiment else {}
+        if category:
+            set_category(thread_ids, category, **changes)
+        else:
+            EmailThread.objects.filter(id__in=thread_ids).update(**changes)
+    Email.objects.filter(id__in=[email.id for email in emails]).update(ai_categorized_at=timezone.now())
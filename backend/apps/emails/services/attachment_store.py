@@ -0,0 +1,193 @@
+"""Content-addressed attachment storage and lazy download.
+
+The IMAP sync records attachment metadata from BODYSTRUCTURE and leaves the
+bodies on the server. A body is fetched, one MIME section at a time, when a
+user opens it (``download_attachment``) or by the background prefetch for
+small attachments (``prefetch_pending``). Blobs are stored once per SHA-256
+digest under ``email_attachments/sha256/``, so the same PDF arriving fifty
+times takes the space of one. The section is fetched in FETCH_RANGE_SIZE
+partial fetches (``BODY.PEEK[section]<offset.length>``) and decoded and
+hashed range by range, spilling to a temporary file, so a large attachment
+is never held in memory, encoded or decoded.
+"""
+
+import base64
+import hashlib
+import logging
+import quopri
+import tempfile
+from itertools import groupby
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from apps.emails.models import EmailAttachment
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+FETCH_RANGE_SIZE = 1024 * 1024  # encoded bytes per partial IMAP fetch
+SPOOL_MAX_SIZE = 1024 * 1024  # decoded bytes kept in memory before spilling to disk
+BLOB_PREFIX = 'email_attachments/sha256'
+
+
+class AttachmentUnavailable(Exception):
+    """The attachment body can no longer be fetched from the mailbox."""
+
+
+def blob_name(digest):
+    return f'{BLOB_PREFIX}/{digest[:2]}/{digest}'
+
+
+def estimated_size(encoded_size, encoding):
+    """Decoded size from the encoded size BODYSTRUCTURE reports."""
+    if (encoding or '').lower() == 'base64':
+        return encoded_size * 3 // 4
+    return encoded_size
+
+
+def decode_stream(chunks, encoding):
+    """Yield the transfer-decoded bytes of a stream of encoded ``chunks``, cut anywhere."""
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        pending = b''
+        for chunk in chunks:
+            block = pending + b''.join(chunk.split())
+            usable = len(block) - len(block) % 4
+            pending = block[usable:]
+            yield base64.b64decode(block[:usable])
+        if pending.rstrip(b'='):
+            yield base64.b64decode(pending + b'=' * (-len(pending) % 4))
+    elif encoding == 'quoted-printable':
+        pending = b''
+        for chunk in chunks:
+            # Cut at line ends so soft line breaks and =XX escapes stay whole
+            block = pending + chunk
+            cut = block.rfind(b'\n') + 1
+            pending = block[cut:]
+            if cut:
+                yield quopri.decodestring(block[:cut])
+        if pending:
+            yield quopri.decodestring(pending)
+    else:
+        yield from chunks
+
+
+def decoded_chunks(data, encoding):
+    """Yield the transfer-decoded ``data`` in chunks of about CHUNK_SIZE."""
+    view = memoryview(data)
+    return decode_stream((bytes(view[start:start + CHUNK_SIZE]) for start in range(0, len(view), CHUNK_SIZE)), encoding)
+
+
+def store_chunks(chunks):
+    """Store a stream of bytes once per content; returns (sha256, size, storage name)."""
+    digest, size = hashlib.sha256(), 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+        for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+            spool.write(chunk)
+        name = blob_name(digest.hexdigest())
+        if not default_storage.exists(name):
+            spool.seek(0)
+            saved = default_storage.save(name, File(spool))
+            if saved != name:  # stored concurrently by another worker
+                default_storage.delete(saved)
+    return digest.hexdigest(), size, name
+
+
+def store_bytes(data):
+    return store_chunks([data])
+
+
+def fetch_ranges(client, uid, section, size=None):
+    """Yield a message section's encoded bytes in partial fetches of ``size`` bytes."""
+    size = size or FETCH_RANGE_SIZE
+    offset = 0
+    while True:
+        response = client.fetch([uid], [f'BODY.PEEK[{section}]<{offset}.{size}>'])
+        data = (response.get(uid) or {}).get(f'BODY[{section}]<{offset}>'.encode())
+        if data is None:
+            raise AttachmentUnavailable('Message is no longer on the mail server')
+        if data:
+            yield data
+        if len(data) < size:
+            return
+        offset += len(data)
+
+
+def download_attachment(attachment, client=None):
+    """Fetch the attachment's MIME section from IMAP into blob storage; returns the attachment.
+
+    ``client`` is a logged-in client for the attachment's account; without
+    one a connection is opened for this download.
+    """
+    if attachment.is_downloaded:
+        return attachment
+    if attachment.imap_uid is None:
+        raise AttachmentUnavailable('Attachment has no source on the mail server')
+    from .email_receiver import connect
+
+    own_client = client is None
+    if own_client:
+        client = connect(attachment.email.email_account, timeout=getattr(settings, 'EMAIL_SYNC_TIMEOUT', 120))
+    try:
+        info = client.select_folder(attachment.imap_folder, readonly=True)
+        if attachment.imap_uidvalidity is not None and info.get(b'UIDVALIDITY') != attachment.imap_uidvalidity:
+            raise AttachmentUnavailable('Mailbox was renumbered since the message was synced')
+        ranges = fetch_ranges(client, attachment.imap_uid, attachment.imap_section)
+        digest, size, name = store_chunks(decode_stream(ranges, attachment.transfer_encoding))
+    finally:
+        if own_client:
+            try:
+                client.logout()
+            except Exception:  # noqa: BLE001
+                pass
+    EmailAttachment.objects.filter(pk=attachment.pk).update(sha256=digest, file_size=size, file_path=name)
+    attachment.sha256, attachment.file_size, attachment.file_path = digest, size, name
+    return attachment
+
+
+def pending_attachments(max_size, limit):
+    return (
+        EmailAttachment.objects.filter(file_path='', imap_uid__isnull=False, file_size__lte=max_size)
+        .select_related('email__email_account')
+        .order_by('email__email_account_id', 'imap_folder', 'id')[:limit]
+    )
+
+
+def prefetch_pending(max_size=None, limit=200):
+    """Download pending attachments up to ``max_size`` bytes, one IMAP session per account.
+
+    Attachments whose message is gone are marked unavailable so they are not
+    retried. Returns the number downloaded.
+    """
+    from .email_receiver import connect
+
+    if max_size is None:
+        max_size = getattr(settings, 'EMAIL_ATTACHMENT_PREFETCH_MAX_BYTES', 5 * 1024 * 1024)
+    downloaded = 0
+    for _, group in groupby(pending_attachments(max_size, limit), key=lambda a: a.email.email_account_id):
+        attachments = list(group)
+        account = attachments[0].email.email_account
+        try:
+            client = connect(account, timeout=getattr(settings, 'EMAIL_SYNC_TIMEOUT', 120))
+        except Exception as exc:  # noqa: BLE001
+            logger.warning('Attachment prefetch could not connect to account %s: %s', account.id, exc)
+            continue
+        try:
+            for attachment in attachments:
+                try:
+                    download_attachment(attachment, client)
+                    downloaded += 1
+                except AttachmentUnavailable:
+                    EmailAttachment.objects.filter(pk=attachment.pk).update(imap_uid=None)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning('Attachment %s prefetch failed: %s', attachment.id, exc)
+        finally:
+            try:
+                client.logout()
+            except Exception:  # noqa: BLE001
+                pass
+    return downloaded
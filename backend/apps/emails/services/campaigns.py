@@ -0,0 +1,215 @@
+"""Bulk email campaigns.
+
+start_campaign_task materialises the audience (customer segment or lead
+filter) into CampaignRecipient rows with batched inserts, then fans out one
+send_campaign_chunk_task per id range. A chunk renders its recipients,
+bulk-creates their threads and Email rows, and sends over the pooled
+transport under the sender account's rate limit. Each recipient is claimed
+(pending -> sending) with a conditional UPDATE before it is sent and its
+status and the campaign counters are written as soon as the send returns,
+so a redelivered or duplicated chunk task never mails anyone twice. A
+throttled chunk stops and is retried when the account's next window opens,
+resuming with the recipients still pending. ``send_queued`` applies the same limit to other bulk sends
+(mail merges) that already have their Email rows.
+"""
+
+import time
+from email.utils import make_msgid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from apps.authentication.models import CustomerCompany
+from apps.crm.models import Lead
+from apps.emails.models import CampaignRecipient, Email, EmailCampaign, EmailMessageRef, EmailThread
+from .email_search import refresh_email_search
+from .email_sender import transmit_email
+from .email_threading import normalize_subject
+from .mail_merge import record_usage
+from .mailbox_counters import email_added, threads_added
+from .rate_limit import SendRateLimiter
+from .template_renderer import compile_template
+
+RECIPIENT_BATCH_SIZE = 1000
+MAX_INLINE_WAIT = 5  # seconds a chunk sleeps for a token before handing the worker back
+LEAD_FILTERS = {'status': 'status', 'lead_source': 'lead_source', 'assigned_to': 'assigned_to_id'}
+
+
+def chunk_size():
+    return getattr(settings, 'EMAIL_CAMPAIGN_CHUNK_SIZE', 200)
+
+
+def audience_rows(campaign):
+    """(email, name, lead_id, customer_id) for every member of the campaign's audience."""
+    if campaign.audience == EmailCampaign.AUDIENCE_LEADS:
+        leads = Lead.objects.filter(company_id=campaign.company_id, is_active=True).exclude(email='')
+        for key, field in LEAD_FILTERS.items():
+            if campaign.lead_filters.get(key):
+                leads = leads.filter(**{field: campaign.lead_filters[key]})
+        rows = leads.order_by('id').values_list('email', 'first_name', 'last_name', 'id')
+        for email, first_name, last_name, lead_id in rows.iterator(chunk_size=RECIPIENT_BATCH_SIZE):
+            yield email, f'{first_name} {last_name}'.strip(), lead_id, None
+        return
+    customers = CustomerCompany.objects.filter(company_id=campaign.company_id)
+    # Segment criteria understood so far; other keys select every customer, as the segments API does
+    criteria = campaign.segment.criteria if campaign.segment_id and isinstance(campaign.segment.criteria, dict) else {}
+    if criteria.get('customer_status'):
+        customers = customers.filter(customer_status=criteria['customer_status'])
+    if 'verified' in criteria:
+        customers = customers.filter(verified=bool(criteria['verified']))
+    rows = customers.order_by('id').values_list('customer__user__email', 'customer__user__first_name', 'customer__user__last_name', 'customer_id')
+    for email, first_name, last_name, customer_id in rows.iterator(chunk_size=RECIPIENT_BATCH_SIZE):
+        if email:
+            yield email, f'{first_name} {last_name}'.strip(), None, customer_id
+
+
+def prepare_recipients(campaign):
+    """Insert the audience as pending recipients in batches; returns the recipient count."""
+    batch = []
+    for email, name, lead_id, customer_id in audience_rows(campaign):
+        batch.append(CampaignRecipient(campaign=campaign, email_address=email.lower(), name=name[:255], lead_id=lead_id, customer_id=customer_id))
+        if len(batch) >= RECIPIENT_BATCH_SIZE:
+            CampaignRecipient.objects.bulk_create(batch, ignore_conflicts=True)  # same address twice: one mail
+            batch = []
+    if batch:
+        CampaignRecipient.objects.bulk_create(batch, ignore_conflicts=True)
+    return campaign.recipients.count()
+
+
+def chunk_ranges(campaign):
+    ids = list(campaign.recipients.filter(status=CampaignRecipient.STATUS_PENDING).order_by('id').values_list('id', flat=True))
+    size = chunk_size()
+    return [(ids[i], ids[min(i + size, len(ids)) - 1]) for i in range(0, len(ids), size)]
+
+
+def _base_context(campaign):
+    user = campaign.created_by
+    return {
+        'company_name': campaign.company.company_name,
+        'user_name': user.get_full_name() or user.username,
+    }
+
+
+def _create_emails(campaign, recipients):
+    """Bulk-create a thread and an Email per recipient; sets recipient.email_id."""
+    account, template = campaign.email_account, campaign.template
+    compiled = compile_template(template)
+    base = _base_context(campaign)
+    now = timezone.now()
+    domain = account.email.rpartition('@')[2] or None
+    rendered = []
+    for recipient in recipients:
+        context = dict(base, customer_name=recipient.name if recipient.customer_id else '', lead_name=recipient.name if recipient.lead_id else '')
+        rendered.append(compiled.render(context))
+    with transaction.atomic():
+        email_added(account.id, unread=False, count=len(recipients))
+        threads = EmailThread.objects.bulk_create([
+            EmailThread(
+                company_id=campaign.company_id, email_account=account, subject=content['subject'][:500],
+                normalized_subject=normalize_subject(content['subject']), participants=[account.email, recipient.email_address],
+                lead_id=recipient.lead_id, customer_id=recipient.customer_id,
+                last_message_at=now, message_count=1, is_read=True,
+            )
+            for recipient, content in zip(recipients, rendered)
+        ])
+        threads_added(threads)
+        emails = Email.objects.bulk_create([
+            Email(
+                thread=thread, email_account=account, message_id=make_msgid(domain=domain),
+                from_email=account.email, to_emails=[recipient.email_address], subject=content['subject'][:500],
+                body_text=content['body_text'], body_html=content['body_html'],
+                direction=Email.DIRECTION_OUTBOUND, status=Email.STATUS_QUEUED, is_read=True, template=template, created_by_id=campaign.created_by_id,
+            )
+            for recipient, thread, content in zip(recipients, threads, rendered)
+        ])
+        EmailMessageRef.objects.bulk_create(
+            [EmailMessageRef(email_account=account, message_id=email.message_id, thread=email.thread) for email in emails],
+            ignore_conflicts=True,
+        )
+        refresh_email_search([email.id for email in emails])
+        record_usage(template.id, len(emails))
+        for recipient, email in zip(recipients, emails):
+            recipient.email = email
+        CampaignRecipient.objects.bulk_update(recipients, ['email'])
+
+
+def _acquire(limiter):
+    """0 once a send token is taken, else seconds until the account's next window."""
+    wait = limiter.try_acquire()
+    while 0 < wait <= MAX_INLINE_WAIT:
+        time.sleep(wait)
+        wait = limiter.try_acquire()
+    return wait
+
+
+def send_queued(account, email_ids):
+    """Send the still-queued emails among ``email_ids`` under the account's rate limit.
+
+    Returns 0 when done, else seconds until the rest may be sent.
+    """
+    emails = Email.objects.filter(id__in=email_ids, email_account=account, status=Email.STATUS_QUEUED).order_by('id')
+    limiter = SendRateLimiter(account)
+    for email in emails:
+        wait = _acquire(limiter)
+        if wait:
+            return wait
+        email.email_account = account
+        # Each status is written as soon as the send returns, so a restarted task resends nothing
+        try:
+            transmit_email(email)
+        except Exception:  # noqa: BLE001
+            Email.objects.filter(pk=email.pk).update(status=Email.STATUS_FAILED)
+        else:
+            Email.objects.filter(pk=email.pk).update(status=Email.STATUS_SENT, sent_at=timezone.now())
+    return 0
+
+
+def send_chunk(campaign, start_id, end_id):
+    """Send the chunk's pending recipients; returns 0 when done, else seconds until it may resume."""
+    recipients = list(campaign.recipients.filter(id__range=(start_id, end_id), status=CampaignRecipient.STATUS_PENDING).order_by('id'))
+    if not recipients:
+        return 0
+    account = campaign.email_account
+    # A retried chunk already created Email rows for some recipients
+    missing = [r for r in recipients if r.email_id is None]
+    if missing:
+        _create_emails(campaign, missing)
+    emails = Email.objects.in_bulk([r.email_id for r in recipients])
+    limiter = SendRateLimiter(account)
+    for recipient in recipients:
+        # Another copy of this chunk task may have taken the recipient already
+        pending = CampaignRecipient.objects.filter(pk=recipient.pk, status=CampaignRecipient.STATUS_PENDING)
+        if not pending.update(status=CampaignRecipient.STATUS_SENDING):
+            continue
+        wait = _acquire(limiter)
+        if wait:
+            CampaignRecipient.objects.filter(pk=recipient.pk).update(status=CampaignRecipient.STATUS_PENDING)
+            return wait
+        email = emails[recipient.email_id]
+        email.email_account = account
+        try:
+            transmit_email(email)
+        except Exception as exc:  # noqa: BLE001
+            _record_result(campaign, recipient, error=f'{type(exc).__name__}: {exc}'[:500])
+        else:
+            _record_result(campaign, recipient)
+    if not campaign.recipients.filter(status=CampaignRecipient.STATUS_PENDING).exists():
+        EmailCampaign.objects.filter(pk=campaign.pk, status=EmailCampaign.STATUS_SENDING).update(
+            status=EmailCampaign.STATUS_COMPLETED, completed_at=timezone.now(),
+        )
+    return 0
+
+
+def _record_result(campaign, recipient, error=None):
+    now = timezone.now()
+    with transaction.atomic():
+        if error is None:
+            Email.objects.filter(pk=recipient.email_id).update(status=Email.STATUS_SENT, sent_at=now)
+            CampaignRecipient.objects.filter(pk=recipient.pk).update(status=CampaignRecipient.STATUS_SENT, sent_at=now)
+            EmailCampaign.objects.filter(pk=campaign.pk).update(sent_count=F('sent_count') + 1)
+        else:
+            Email.objects.filter(pk=recipient.email_id).update(status=Email.STATUS_FAILED)
+            CampaignRecipient.objects.filter(pk=recipient.pk).update(status=CampaignRecipient.STATUS_FAILED, error=error)
+            EmailCampaign.objects.filter(pk=campaign.pk).update(failed_count=F('failed_count') + 1)
@@ -1,64 +1,311 @@
-from email import message_from_bytes
+"""MIME parsing for received mail.
+
+``parse_email_message`` feeds the message through a BytesFeedParser in
+chunks instead of decoding it to one string up front, and decodes at most
+EMAIL_PARSE_MAX_BODY_BYTES of each text part: the rest of a 30MB newsletter
+is never decoded, sanitized or stored. HTML is sanitized in a single
+tokenizer pass (``sanitize_html``) that also extracts the plain text, only
+when the message has no text/plain part of its own.
+
+Benchmark: ``manage.py benchmark_email_parser`` (fixtures in fixtures/eml/).
+"""
+
+import base64
+import binascii
+import quopri
+import re
 from email.header import decode_header
-from bs4 import BeautifulSoup
-import html2text
+from email.parser import BytesFeedParser, BytesHeaderParser
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+from html import escape
+from html.parser import HTMLParser
+
+from django.conf import settings
+
+FEED_CHUNK_SIZE = 64 * 1024
+DROPPED_TAGS = frozenset({'script', 'style', 'iframe', 'object', 'embed', 'noscript', 'template'})
+BLOCK_TAGS = frozenset({
+    'address', 'article', 'blockquote', 'br', 'div', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'header', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul',
+})
+URL_ATTRIBUTES = frozenset({
+    'href', 'src', 'srcset', 'action', 'formaction', 'background', 'poster', 'cite', 'longdesc', 'lowsrc', 'dynsrc', 'xlink:href',
+})
+ALLOWED_URL_SCHEMES = frozenset({'http', 'https', 'mailto', 'tel', 'cid'})  # relative URLs have none and are kept
+# Browsers ignore ASCII whitespace and control characters inside a scheme ('java&#9;script:')
+_URL_IGNORED = re.compile(r'[\x00-\x20\x7f]+')
+_URL_SCHEME = re.compile(r'([a-z][a-z0-9+.\-]*):')
+
+
+def max_body_bytes():
+    return getattr(settings, 'EMAIL_PARSE_MAX_BODY_BYTES', 2 * 1024 * 1024)
 
 
-def parse_email_message(raw_email: bytes):
-    """Parse raw RFC822 email bytes into structured parts."""
-    msg = message_from_bytes(raw_email)
+def parse_email_message(raw_email):
+    """Parse an RFC822 message, as bytes or a binary file, into headers, bodies and attachments."""
+    parser = BytesFeedParser()
+    for chunk in _chunks(raw_email):
+        parser.feed(chunk)
+    msg = parser.close()
     headers = {k: _decode_header(v) for k, v in msg.items()}
     body_text, body_html, attachments = _extract_parts(msg)
-    cleaned_html = clean_html(body_html) if body_html else None
-    text_version = body_text or (html2text.html2text(cleaned_html) if cleaned_html else "")
+    body_text, body_html = finish_bodies(body_text, body_html)
     return {
         'headers': headers,
-        'body_text': text_version.strip(),
-        'body_html': cleaned_html or "",
+        'body_text': body_text,
+        'body_html': body_html,
         'attachments': attachments,
     }
 
 
+def _chunks(raw_email):
+    if isinstance(raw_email, (bytes, bytearray, memoryview)):
+        view = memoryview(raw_email)
+        for start in range(0, len(view), FEED_CHUNK_SIZE):
+            yield bytes(view[start:start + FEED_CHUNK_SIZE])
+        return
+    while True:
+        chunk = raw_email.read(FEED_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def finish_bodies(body_text, body_html):
+    """(text, sanitized html); without a text part the text is extracted from the html."""
+    derived = None
+    if body_html:
+        body_html, derived = sanitize_html(body_html, extract_text=not body_text)
+    return (body_text or derived or "").strip(), body_html or ""
+
+
+def parse_headers(header_bytes: bytes):
+    """Decoded headers of a message header block (e.g. a BODY[HEADER] fetch)."""
+    msg = BytesHeaderParser().parsebytes(header_bytes or b'')
+    return {k: _decode_header(v) for k, v in msg.items()}
+
+
 def _decode_header(value):
     parts = decode_header(value)
     decoded = []
     for text, charset in parts:
         if isinstance(text, bytes):
-            decoded.append(text.decode(charset or 'utf-8', errors='ignore'))
+            try:
+                decoded.append(text.decode(charset or 'utf-8', errors='ignore'))
+            except LookupError:
+                decoded.append(text.decode('utf-8', errors='ignore'))
         else:
             decoded.append(text)
     return ''.join(decoded)
 
 
+def _leaf_parts(part):
+    # Attached messages (message/rfc822) are leaves, not walked into
+    if part.get_content_maintype() == 'multipart' and part.is_multipart():
+        for child in part.get_payload():
+            yield from _leaf_parts(child)
+    else:
+        yield part
+
+
+def _part_text(part, limit):
+    """Decoded text of a part, reading only as much of the encoded payload as ``limit`` needs."""
+    encoding = (part.get('Content-Transfer-Encoding') or '').strip().lower()
+    if encoding in ('base64', 'quoted-printable'):
+        encoded = part.get_payload()
+        if not isinstance(encoded, str):
+            return ''
+        # Either encoding takes well under 2 bytes per decoded byte on average
+        data = encoded[:limit * 2].encode('ascii', 'surrogateescape')
+    else:
+        data, encoding = part.get_payload(decode=True) or b'', ''
+    return decode_text(data, encoding, part.get_content_charset(), limit)
+
+
 def _extract_parts(msg):
     body_text = None
     body_html = None
     attachments = []
-    if msg.is_multipart():
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            disp = part.get('Content-Disposition', '')
-            if ctype == 'text/plain' and 'attachment' not in disp:
-                body_text = (part.get_payload(decode=True) or b'').decode(errors='ignore')
-            elif ctype == 'text/html' and 'attachment' not in disp:
-                body_html = (part.get_payload(decode=True) or b'').decode(errors='ignore')
-            elif 'attachment' in disp:
-                attachments.append({
-                    'file_name': part.get_filename(),
-                    'content_type': ctype,
-                    'data': part.get_payload(decode=True),
-                })
-    else:
-        ctype = msg.get_content_type()
-        if ctype == 'text/plain':
-            body_text = (msg.get_payload(decode=True) or b'').decode(errors='ignore')
-        elif ctype == 'text/html':
-            body_html = (msg.get_payload(decode=True) or b'').decode(errors='ignore')
+    limit = max_body_bytes()
+    for part in _leaf_parts(msg):
+        ctype = part.get_content_type()
+        if part.get_content_disposition() == 'attachment':
+            data = part.get_payload(0).as_bytes() if ctype == 'message/rfc822' else part.get_payload(decode=True)
+            attachments.append({
+                'file_name': part.get_filename(),
+                'content_type': ctype,
+                'data': data,
+            })
+        elif ctype == 'text/plain' and body_text is None:
+            body_text = _part_text(part, limit)
+        elif ctype == 'text/html' and body_html is None:
+            body_html = _part_text(part, limit)
     return body_text, body_html, attachments
 
 
+def _safe_url(value):
+    scheme = _URL_SCHEME.match(_URL_IGNORED.sub('', value).lower())
+    return scheme is None or scheme.group(1) in ALLOWED_URL_SCHEMES
+
+
+def _safe_attribute(name, value):
+    if name.startswith('on'):
+        return False
+    if name not in URL_ATTRIBUTES or not value:
+        return True
+    if name == 'srcset':
+        return all(_safe_url(candidate.strip().split(' ')[0]) for candidate in value.split(','))
+    return _safe_url(value)
+
+
+class _HTMLSanitizer(HTMLParser):
+    """Copies markup token by token, dropping active content; optionally collects the text."""
+
+    def __init__(self, extract_text):
+        super().__init__(convert_charrefs=True)
+        self.html = []
+        self.text = [] if extract_text else None
+        self._skipping = 0
+
+    def _start_tag(self, tag, attrs, closed):
+        allowed = [(name, value) for name, value in attrs if _safe_attribute(name, value)]
+        if len(allowed) != len(attrs):
+            attrs = allowed
+            rendered = ''.join(f' {n}' if v is None else f' {n}="{escape(v)}"' for n, v in attrs)
+            return f"<{tag}{rendered}{' /' if closed else ''}>"
+        return self.get_starttag_text()
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS:
+            self._skipping += 1
+        elif not self._skipping:
+            self.html.append(self._start_tag(tag, attrs, False))
+            if self.text is not None and tag in BLOCK_TAGS:
+                self.text.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag not in DROPPED_TAGS and not self._skipping:
+            self.html.append(self._start_tag(tag, attrs, True))
+            if self.text is not None and tag in BLOCK_TAGS:
+                self.text.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif not self._skipping:
+            self.html.append(f'</{tag}>')
+            if self.text is not None and tag in BLOCK_TAGS:
+                self.text.append('\n')
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.html.append(escape(data, quote=False))
+            if self.text is not None:
+                self.text.append(data)
+
+    def handle_decl(self, decl):
+        self.html.append(f'<!{decl}>')
+
+
+def sanitize_html(html: str, extract_text=False):
+    """(html without scripts, styles, event handlers and URLs outside ALLOWED_URL_SCHEMES, text or None)."""
+    sanitizer = _HTMLSanitizer(extract_text)
+    sanitizer.feed(html)
+    sanitizer.close()
+    text = None
+    if extract_text:
+        lines = (' '.join(line.split()) for line in ''.join(sanitizer.text).splitlines())
+        text = '\n'.join(line for line in lines if line)
+    return ''.join(sanitizer.html), text
+
+
 def clean_html(html: str):
-    soup = BeautifulSoup(html, 'html.parser')
-    for tag in soup(['script', 'style']):
-        tag.decompose()
-    return str(soup)
+    return sanitize_html(html)[0]
+
+
+def html_to_text(html: str):
+    return sanitize_html(html, extract_text=True)[1]
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode(errors='ignore')
+    return value or ''
+
+
+def _params(raw):
+    # (b'NAME', b'value', ...) -> {'name': 'value'}
+    if not isinstance(raw, (tuple, list)):
+        return {}
+    return {_text(raw[i]).lower(): _text(raw[i + 1]) for i in range(0, len(raw) - 1, 2)}
+
+
+def _filename(disposition_params, params):
+    name = disposition_params.get('filename') or params.get('name')
+    if not name and 'filename*' in disposition_params:
+        name = collapse_rfc2231_value(decode_rfc2231(disposition_params['filename*']))
+    return _decode_header(name) if name else None
+
+
+def bodystructure_parts(structure, prefix=''):
+    """Leaf parts of an IMAP BODYSTRUCTURE, each a dict with the ``section`` to fetch it by.
+
+    Nested messages (message/rfc822) are leaves: they are stored as attachments.
+    """
+    if isinstance(structure[0], (list, tuple)):
+        for number, child in enumerate(structure[0], 1):
+            yield from bodystructure_parts(child, f'{prefix}.{number}' if prefix else str(number))
+        return
+    main, sub = _text(structure[0]).lower(), _text(structure[1]).lower()
+    content_type = f'{main}/{sub}'
+    params = _params(structure[2])
+    # Extension data follows the type-specific fields: disposition comes after the MD5
+    position = 9 if main == 'text' else 11 if content_type == 'message/rfc822' else 8
+    disposition = structure[position] if len(structure) > position else None
+    disposition_type, disposition_params = '', {}
+    if isinstance(disposition, (tuple, list)) and disposition:
+        disposition_type, disposition_params = _text(disposition[0]).lower(), _params(disposition[1] if len(disposition) > 1 else None)
+    yield {
+        'section': prefix or '1',
+        'content_type': content_type,
+        'charset': params.get('charset'),
+        'encoding': _text(structure[5]).lower(),
+        'size': structure[6] or 0,
+        'disposition': disposition_type,
+        'file_name': _filename(disposition_params, params),
+    }
+
+
+def body_parts(parts):
+    """The text/plain and text/html parts shown as the body, by content type."""
+    bodies = {}
+    for part in parts:
+        if part['content_type'] in ('text/plain', 'text/html') and part['disposition'] != 'attachment':
+            bodies.setdefault(part['content_type'], part)
+    return bodies
+
+
+def attachment_parts(parts):
+    return [part for part in parts if part['disposition'] == 'attachment']
+
+
+def decode_transfer(data: bytes, encoding: str) -> bytes:
+    encoding = (encoding or '').lower()
+    try:
+        if encoding == 'base64':
+            data = b''.join(data.split())
+            # A payload cut short for the size cap may end mid-quantum
+            return base64.b64decode(data[:len(data) - len(data) % 4])
+        if encoding == 'quoted-printable':
+            return quopri.decodestring(data)
+    except (binascii.Error, ValueError):
+        pass
+    return data
+
+
+def decode_text(data: bytes, encoding: str, charset=None, limit=None) -> str:
+    raw = decode_transfer(data or b'', encoding)[:limit]
+    try:
+        return raw.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        return raw.decode('utf-8', errors='ignore')
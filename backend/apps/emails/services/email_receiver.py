@@ -1,62 +1,290 @@
+import logging
+
 import imapclient
+from collections import defaultdict
+from datetime import timezone as dt_timezone
+from email.utils import parsedate_to_datetime
 from django.utils import timezone
 from django.conf import settings
-from django.core.files.base import ContentFile
-from apps.emails.models import EmailAccount, EmailThread, Email, EmailAttachment
-from .email_parser import parse_email_message
+from django.db import transaction
+from apps.emails.models import EmailAccount, Email, EmailAttachment, EmailFolderState
+from .attachment_store import estimated_size, store_bytes
+from .email_parser import (
+    attachment_parts, body_parts, bodystructure_parts, decode_text, finish_bodies, max_body_bytes, parse_email_message, parse_headers,
+)
 from .email_categorizer import categorize_email
+from .email_search import refresh_email_search
+from .email_threading import assign_thread, parse_message_ids
+from .encryption import decrypt_secret
+from .mailbox_counters import email_added
+
+logger = logging.getLogger(__name__)
+
+FETCH_BATCH_SIZE = 100
+MAX_MESSAGE_ATTEMPTS = 5  # a message that fails to store this many times is given up on
+MESSAGE_ID_HEADER = b'BODY[HEADER.FIELDS (MESSAGE-ID)]'
+STRUCTURE_FETCH = ['BODYSTRUCTURE', 'BODY.PEEK[HEADER]']
+
+
+def sync_emails(email_account: EmailAccount, limit: int = 20, folder: str = 'INBOX'):
+    """Fetch messages that arrived since the last checkpoint of ``folder`` via IMAP.
 
+    The first sync (and any UIDVALIDITY change) imports only the newest ``limit``
+    messages; later syncs fetch every UID above the stored checkpoint.
+    """
+    try:
+        return sync_account(email_account, limit, folder)
+    except Exception:  # noqa: BLE001
+        logger.exception('Email sync failed for account %s', email_account.id)
+        email_account.last_sync = timezone.now()
+        email_account.save(update_fields=["last_sync"])
+        return 0
+
+
+def sync_account(email_account: EmailAccount, limit: int = 20, folder: str = 'INBOX', timeout=None):
+    """Same as sync_emails but connection and protocol errors propagate to the caller.
 
-def sync_emails(email_account: EmailAccount, limit: int = 20):
-    """Sync latest emails via IMAP (simplified)."""
+    ``timeout`` bounds every socket operation, so a stalled server cannot hang the sync.
+    """
     if email_account.provider not in (EmailAccount.PROVIDER_IMAP, EmailAccount.PROVIDER_GMAIL):
         return 0
     emails_synced = 0
-    # Placeholder IMAP logic
     if email_account.imap_host and email_account.imap_port:
+        client = connect(email_account, timeout)
         try:
-            client = imapclient.IMAPClient(email_account.imap_host, port=email_account.imap_port, ssl=True)
-            client.login(email_account.username, email_account.password)
-            client.select_folder('INBOX')
-            messages = client.search(['NOT', 'DELETED'])[-limit:]
-            for msgid in messages:
-                raw = client.fetch([msgid], ['RFC822'])[msgid][b'RFC822']
-                parsed = parse_email_message(raw)
-                thread = EmailThread.objects.create(
-                    company=email_account.company,
-                    email_account=email_account,
-                    subject=parsed['headers'].get('Subject', '(No Subject)'),
-                    participants=[parsed['headers'].get('From')],
-                    last_message_at=timezone.now(),
-                )
-                email = Email.objects.create(
-                    thread=thread,
-                    email_account=email_account,
-                    message_id=parsed['headers'].get('Message-ID', f'imap-{msgid}'),
-                    from_email=parsed['headers'].get('From', ''),
-                    subject=parsed['headers'].get('Subject', '(No Subject)'),
-                    to_emails=[parsed['headers'].get('To', '')],
-                    body_text=parsed['body_text'],
-                    body_html=parsed['body_html'],
-                    direction=Email.DIRECTION_INBOUND,
-                    status=Email.STATUS_DELIVERED,
-                )
-                if parsed['attachments']:
-                    for att in parsed['attachments']:
-                        if att['data']:
-                            EmailAttachment.objects.create(
-                                email=email,
-                                file_name=att['file_name'] or 'attachment.bin',
-                                file_size=len(att['data']),
-                                file_type=att['content_type'],
-                                file_path=ContentFile(att['data'], name=att['file_name'] or 'attachment.bin'),
-                            )
-                    email.has_attachments = True
-                    email.save(update_fields=["has_attachments"])
-                categorize_email(email)
-                emails_synced += 1
-        except Exception:  # noqa: BLE001
-            pass
+            emails_synced = sync_folder(client, email_account, folder, limit)
+        finally:
+            try:
+                client.logout()
+            except Exception:  # noqa: BLE001
+                pass
     email_account.last_sync = timezone.now()
     email_account.save(update_fields=["last_sync"])
     return emails_synced
+
+
+def connect(email_account: EmailAccount, timeout=None):
+    """Logged-in IMAP client for the account."""
+    client = imapclient.IMAPClient(email_account.imap_host, port=email_account.imap_port, ssl=True, timeout=timeout)
+    try:
+        client.login(email_account.username, decrypt_secret(email_account.password))
+    except Exception:
+        client.shutdown()
+        raise
+    return client
+
+
+def sync_folder(client, email_account: EmailAccount, folder: str = 'INBOX', limit: int = 20):
+    """Import new messages of ``folder`` on a logged-in client, advancing the checkpoint per batch.
+
+    A message that fails to store does not hold the checkpoint back: its UID
+    is kept in ``failed_uids`` and fetched again on the next syncs, up to
+    MAX_MESSAGE_ATTEMPTS times.
+    """
+    info = client.select_folder(folder, readonly=True)
+    uidvalidity = info.get(b'UIDVALIDITY')
+    uidnext = info.get(b'UIDNEXT')
+    state, _ = EmailFolderState.objects.get_or_create(email_account=email_account, folder=folder)
+    if state.uidvalidity != uidvalidity:
+        # UIDs were renumbered: start over; Message-ID dedupe keeps already stored mail out
+        state.uidvalidity = uidvalidity
+        state.last_uid = 0
+        state.highest_modseq = None
+        state.failed_uids = {}
+    state.last_synced_at = timezone.now()
+    retries = {int(uid): attempts for uid, attempts in state.failed_uids.items()}
+    if uidnext is not None and state.last_uid and uidnext <= state.last_uid + 1 and not retries:
+        # Nothing appended since the checkpoint: skip SEARCH and FETCH entirely
+        state.highest_modseq = info.get(b'HIGHESTMODSEQ', state.highest_modseq)
+        state.save()
+        return 0
+
+    # "n:*" always matches the highest UID, even when it is below n
+    uids = sorted(uid for uid in client.search(['UID', f'{state.last_uid + 1}:*', 'NOT', 'DELETED']) if uid > state.last_uid)
+    if not state.last_uid:
+        uids = uids[-limit:]
+    uids = sorted(set(uids) | set(retries))
+    emails_synced = 0
+    for start in range(0, len(uids), FETCH_BATCH_SIZE):
+        batch = uids[start:start + FETCH_BATCH_SIZE]
+        synced, failed = _sync_batch(client, email_account, folder, uidvalidity, batch)
+        emails_synced += synced
+        for uid in batch:
+            if uid not in failed:
+                retries.pop(uid, None)
+            elif retries.get(uid, 0) + 1 >= MAX_MESSAGE_ATTEMPTS:
+                retries.pop(uid, None)
+                logger.warning('Giving up on UID %s in %s of account %s after %s attempts', uid, folder, email_account.id, MAX_MESSAGE_ATTEMPTS)
+            else:
+                retries[uid] = retries.get(uid, 0) + 1
+        state.failed_uids = {str(uid): attempts for uid, attempts in retries.items()}
+        state.last_uid = max(state.last_uid, batch[-1])
+        state.save(update_fields=['uidvalidity', 'last_uid', 'last_synced_at', 'failed_uids'])
+    state.highest_modseq = info.get(b'HIGHESTMODSEQ')
+    state.save()
+    return emails_synced
+
+
+def _fallback_message_id(email_account, uidvalidity, uid):
+    return f'imap-{email_account.id}-{uidvalidity}-{uid}'
+
+
+def _parse_message_id(header_bytes):
+    # b'Message-ID: <abc@host>\r\n\r\n', possibly folded onto a continuation line
+    _, _, value = (header_bytes or b'').decode(errors='ignore').partition(':')
+    return ' '.join(value.split())
+
+
+def _sync_batch(client, email_account, folder, uidvalidity, uids):
+    """Message-ID headers first, then headers, structure and text parts of unseen messages only.
+
+    Attachment bodies stay on the server (services.attachment_store). A
+    message whose BODYSTRUCTURE cannot be used is fetched whole instead.
+    Returns (messages stored, UIDs that failed to store).
+    """
+    headers = client.fetch(uids, ['BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'])
+    message_ids = {}
+    for uid in uids:
+        data = headers.get(uid) or {}
+        message_ids[uid] = _parse_message_id(data.get(MESSAGE_ID_HEADER)) or _fallback_message_id(email_account, uidvalidity, uid)
+    existing = set(
+        Email.objects.filter(email_account=email_account, message_id__in=list(message_ids.values())).values_list('message_id', flat=True)
+    )
+    new_uids = []
+    for uid in uids:
+        # Also drops a second copy of the same message within the batch
+        if message_ids[uid] not in existing:
+            existing.add(message_ids[uid])
+            new_uids.append(uid)
+    if not new_uids:
+        return 0, set()
+
+    structures = client.fetch(new_uids, STRUCTURE_FETCH)
+    plans, whole = {}, []
+    for uid in new_uids:
+        data = structures.get(uid) or {}
+        try:
+            plans[uid] = (data[b'BODY[HEADER]'], list(bodystructure_parts(data[b'BODYSTRUCTURE'])))
+        except (KeyError, IndexError, TypeError):
+            whole.append(uid)
+    # One FETCH per distinct set of body sections, usually just one or two per batch
+    by_sections = defaultdict(list)
+    for uid, (_, parts) in plans.items():
+        by_sections[tuple(part['section'] for part in body_parts(parts).values())].append(uid)
+    texts = {}
+    for sections, group in by_sections.items():
+        if sections:
+            texts.update(client.fetch(group, [f'BODY.PEEK[{section}]' for section in sections]))
+    bodies = client.fetch(whole, ['BODY.PEEK[]']) if whole else {}
+
+    synced, failed = 0, set()
+    for uid in new_uids:
+        try:
+            with transaction.atomic():
+                if uid in plans:
+                    header, parts = plans[uid]
+                    source = {'imap_folder': folder, 'imap_uidvalidity': uidvalidity, 'imap_uid': uid}
+                    _store_structured(email_account, message_ids[uid], header, parts, texts.get(uid) or {}, source)
+                else:
+                    raw = (bodies.get(uid) or {}).get(b'BODY[]')
+                    if not raw:
+                        logger.warning('No body returned for UID %s in %s of account %s', uid, folder, email_account.id)
+                        failed.add(uid)
+                        continue
+                    _store_message(email_account, message_ids[uid], raw)
+            synced += 1
+        except Exception:  # noqa: BLE001
+            logger.exception('Could not store UID %s in %s of account %s', uid, folder, email_account.id)
+            failed.add(uid)
+    return synced, failed
+
+
+def _message_date(value):
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date and timezone.is_naive(date):
+        date = timezone.make_aware(date, dt_timezone.utc)
+    return date
+
+
+def _store_message(email_account, message_id, raw):
+    """Store a message fetched whole; its attachments are stored right away."""
+    parsed = parse_email_message(raw)
+    attachments = []
+    for att in parsed['attachments']:
+        if att['data']:
+            sha256, size, name = store_bytes(att['data'])
+            attachments.append({'file_name': att['file_name'], 'file_type': att['content_type'], 'file_size': size, 'sha256': sha256, 'file_path': name})
+    return _store_email(
+        email_account, message_id, parsed['headers'], parsed['body_text'], parsed['body_html'],
+        attachments, has_attachments=bool(parsed['attachments']),
+    )
+
+
+def _store_structured(email_account, message_id, header, parts, fetched, source):
+    """Store a message from its headers, BODYSTRUCTURE parts and fetched text sections.
+
+    Attachments are recorded with where to fetch them from (``source``) and
+    downloaded later.
+    """
+    texts = {}
+    for content_type, part in body_parts(parts).items():
+        data = fetched.get(f"BODY[{part['section']}]".encode())
+        if data is not None:
+            texts[content_type] = decode_text(data, part['encoding'], part['charset'], max_body_bytes())
+    body_text, body_html = finish_bodies(texts.get('text/plain'), texts.get('text/html'))
+    attachments = [
+        {
+            'file_name': part['file_name'],
+            'file_type': part['content_type'],
+            'file_size': estimated_size(part['size'], part['encoding']),
+            'imap_section': part['section'],
+            'transfer_encoding': part['encoding'][:32],
+            **source,
+        }
+        for part in attachment_parts(parts)
+    ]
+    return _store_email(email_account, message_id, parse_headers(header), body_text, body_html, attachments, bool(attachments))
+
+
+def _store_email(email_account, message_id, headers, body_text, body_html, attachments, has_attachments):
+    subject = headers.get('Subject', '(No Subject)')
+    in_reply_to = headers.get('In-Reply-To', '')
+    references = ' '.join(parse_message_ids(headers.get('References', '')))
+    sent_at = _message_date(headers.get('Date'))
+    email_added(email_account.id, unread=True)
+    thread = assign_thread(
+        email_account,
+        message_id=message_id,
+        subject=subject,
+        participants=[headers.get('From'), headers.get('To')],
+        in_reply_to=in_reply_to,
+        references=references,
+        message_at=min(sent_at or timezone.now(), timezone.now()),
+        unread=True,
+    )
+    email = Email.objects.create(
+        thread=thread,
+        email_account=email_account,
+        message_id=message_id,
+        in_reply_to=in_reply_to[:255],
+        references=references,
+        from_email=headers.get('From', ''),
+        subject=subject,
+        to_emails=[headers.get('To', '')],
+        body_text=body_text,
+        body_html=body_html,
+        direction=Email.DIRECTION_INBOUND,
+        status=Email.STATUS_DELIVERED,
+        sent_at=sent_at,
+        has_attachments=has_attachments,
+    )
+    EmailAttachment.objects.bulk_create([
+        EmailAttachment(email=email, **{**att, 'file_name': (att['file_name'] or 'attachment.bin')[:255]})
+        for att in attachments
+    ])
+    refresh_email_search([email.id])
+    categorize_email(email)
+    return email
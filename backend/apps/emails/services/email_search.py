@@ -0,0 +1,157 @@
+"""Mailbox search.
+
+Each Email keeps a GIN-indexed ``search_vector`` over its subject (A),
+sender (B), recipients (C) and body text (D), filled in by the sync, send
+and campaign paths right after the row is inserted and backfilled by
+``manage.py rebuild_email_search``. A query is free text plus operators:
+
+    quarterly report from:jane has:attachment category:sales
+
+Matching emails are grouped into threads ranked by their best match, with a
+highlighted snippet from that email. Free text uses the same prefix tsquery
+as the CRM lists (apps.core.search); on databases other than
+PostgreSQL it falls back to icontains.
+"""
+
+import html
+import re
+
+from django.contrib.postgres.search import SearchHeadline, SearchRank, SearchVector
+from django.db.models import F, FloatField, Max, Q, TextField, Value
+from django.db.models.functions import Cast, Concat, Replace, Substr
+
+from apps.core.search import SEARCH_CONFIG, prefix_query, search_enabled
+from apps.emails.models import Email, EmailThread
+
+SEARCH_BODY_CHARS = 100_000  # body text indexed per email; tsvectors are capped at 1MB
+SNIPPET_CHARS = 200
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+_TOKEN = re.compile(r'(?:(\w+):)?("[^"]*"|\S+)')
+# ts_headline does not escape; mark matches with control characters, escape, then swap in tags
+_START, _STOP = '\x02', '\x03'
+# ts_headline drops anything that parses as an HTML tag, so '<'/'>' go in disguised
+_LT, _GT = '\x04', '\x05'
+
+
+def _with_address_parts(expression):
+    """Address text plus a copy with '@' split, so 'acme' finds 'jane@acme.com'."""
+    return Concat(expression, Value(' '), Replace(expression, Value('@'), Value(' ')), output_field=TextField())
+
+
+def email_search_vector():
+    return (
+        SearchVector('subject', weight='A', config=SEARCH_CONFIG)
+        + SearchVector(_with_address_parts(F('from_email')), 'from_name', weight='B', config=SEARCH_CONFIG)
+        + SearchVector(
+            _with_address_parts(Cast('to_emails', TextField())), _with_address_parts(Cast('cc_emails', TextField())),
+            weight='C', config=SEARCH_CONFIG,
+        )
+        + SearchVector(Substr('body_text', 1, SEARCH_BODY_CHARS), weight='D', config=SEARCH_CONFIG)
+    )
+
+
+def refresh_email_search(email_ids):
+    """Recompute ``search_vector`` for the given emails in one UPDATE."""
+    if not search_enabled() or not email_ids:
+        return 0
+    return Email.objects.filter(pk__in=email_ids).update(search_vector=email_search_vector())
+
+
+def _operator_filter(key, value):
+    if key == 'from':
+        return Q(from_email__icontains=value) | Q(from_name__icontains=value)
+    if key == 'has' and value in ('attachment', 'attachments'):
+        return Q(has_attachments=True)
+    if key == 'category':
+        return Q(thread__category=value)
+    return None
+
+
+def parse_query(text):
+    """(free text, Q of operator filters)."""
+    terms, filters = [], Q()
+    for match in _TOKEN.finditer(text):
+        key, value = (match.group(1) or '').lower(), match.group(2).strip('"')
+        condition = _operator_filter(key, value.lower()) if key and value else None
+        if condition is None:
+            terms.append(match.group(0).strip('"'))
+        else:
+            filters &= condition
+    return ' '.join(terms), filters
+
+
+def _headline_source():
+    body = Substr('body_text', 1, SEARCH_BODY_CHARS)
+    return Replace(Replace(body, Value('<'), Value(_LT)), Value('>'), Value(_GT))
+
+
+def _mark(text):
+    text = text.replace(_LT, '<').replace(_GT, '>')
+    return html.escape(text).replace(_START, '<mark>').replace(_STOP, '</mark>')
+
+
+def _fallback_snippet(body, terms):
+    body = body or ''
+    lowered = body.lower()
+    for term in terms.lower().split():
+        position = lowered.find(term)
+        if position >= 0:
+            start = max(0, position - SNIPPET_CHARS // 3)
+            window = body[start:start + SNIPPET_CHARS]
+            offset = position - start
+            return _mark(window[:offset] + _START + window[offset:offset + len(term)] + _STOP + window[offset + len(term):])
+    return html.escape(body[:SNIPPET_CHARS])
+
+
+def search_threads(user, text, limit=DEFAULT_LIMIT):
+    """The user's threads matching ``text``, best first, each with ``search_rank`` and ``snippet``."""
+    terms, filters = parse_query(text)
+    if not terms and not filters:
+        return []
+    emails = Email.objects.filter(email_account__user=user).filter(filters)
+    query = None
+    if terms and search_enabled():
+        query = prefix_query(terms)
+        if query is None:
+            return []
+        emails = emails.filter(search_vector=query).annotate(rank=SearchRank(F('search_vector'), query))
+    elif terms:
+        emails = emails.filter(
+            Q(subject__icontains=terms) | Q(body_text__icontains=terms) | Q(from_email__icontains=terms)
+        ).annotate(rank=Value(0.0, output_field=FloatField()))
+    else:
+        emails = emails.annotate(rank=Value(0.0, output_field=FloatField()))
+
+    ranked = list(
+        emails.values('thread_id').annotate(best=Max('rank'), latest=Max('thread__last_message_at'))
+        .order_by('-best', '-latest').values_list('thread_id', 'best')[:limit]
+    )
+    threads = EmailThread.objects.in_bulk([thread_id for thread_id, _ in ranked])
+
+    # Best email per thread, then a headline for just those emails
+    best_email = {}
+    for email_id, thread_id in emails.filter(thread_id__in=list(threads)).order_by('-rank', '-id').values_list('id', 'thread_id'):
+        best_email.setdefault(thread_id, email_id)
+    if query is not None:
+        headlines = dict(
+            Email.objects.filter(pk__in=best_email.values()).annotate(
+                headline=SearchHeadline(
+                    _headline_source(), query, config=SEARCH_CONFIG,
+                    start_sel=_START, stop_sel=_STOP, max_words=35, min_words=15,
+                )
+            ).values_list('id', 'headline')
+        )
+        snippets = {thread_id: _mark(headlines.get(email_id) or '') for thread_id, email_id in best_email.items()}
+    else:
+        bodies = dict(Email.objects.filter(pk__in=best_email.values()).values_list('id', 'body_text'))
+        snippets = {thread_id: _fallback_snippet(bodies.get(email_id), terms) for thread_id, email_id in best_email.items()}
+
+    results = []
+    for thread_id, rank in ranked:
+        thread = threads.get(thread_id)
+        if thread is not None:
+            thread.search_rank = rank
+            thread.snippet = snippets.get(thread_id, '')
+            results.append(thread)
+    return results
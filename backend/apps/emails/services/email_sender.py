@@ -1,67 +1,84 @@
-import smtplib
 import base64
 import json
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.utils import make_msgid
 from django.conf import settings
+from django.db import transaction
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from .email_parser import clean_html
+from .email_parser import html_to_text
 from apps.emails.models import Email, EmailAccount
 from django.utils import timezone
 from .encryption import decrypt_secret
+from .email_threading import assign_thread, parse_message_ids
+from .smtp_pool import smtp_pool
+from .email_search import refresh_email_search
+from .mailbox_counters import email_added
 
 
 def _get_default_account(user):
     return EmailAccount.objects.filter(user=user, is_default=True, is_active=True).first()
 
 
-def send_email(to, subject, body_html, body_text, from_account=None, attachments=None, cc=None, bcc=None, reply_to_email: Email | None = None):
+def send_email(to, subject, body_html, body_text, from_account=None, attachments=None, cc=None, bcc=None, reply_to_email: Email | None = None, deliver=True, template=None):
     """Send email via SMTP or Gmail API. Updates Email record status.
 
     Creates an Email + EmailThread if necessary before sending if from_account provided.
+    With ``deliver=False`` the Email is only stored as queued, for send_email_task.
     """
     if from_account is None:
         from_account = _get_default_account(reply_to_email.created_by if reply_to_email else None)
     if from_account is None:
         raise ValueError("No sending account available")
 
-    # Create or reuse thread
-    if reply_to_email:
-        thread = reply_to_email.thread
-    else:
-        from apps.emails.models import EmailThread
-        thread = EmailThread.objects.create(
-            company=from_account.company,
-            email_account=from_account,
+    message_id = make_msgid(domain=from_account.email.rpartition('@')[2] or None)
+    in_reply_to = reply_to_email.message_id if reply_to_email else ''
+    references = ' '.join(parse_message_ids(f"{reply_to_email.references} {in_reply_to}")) if reply_to_email else ''
+    with transaction.atomic():
+        email_added(from_account.id, unread=False)
+        thread = assign_thread(
+            from_account,
+            message_id=message_id,
             subject=subject,
             participants=[from_account.email] + to,
-            last_message_at=timezone.now(),
+            in_reply_to=in_reply_to,
+            references=references,
+            thread=reply_to_email.thread if reply_to_email else None,
         )
 
-    email = Email.objects.create(
-        thread=thread,
-        email_account=from_account,
-        message_id=f"local-{thread.id}-{timezone.now().timestamp()}",
-        from_email=from_account.email,
-        from_name="",
-        to_emails=to,
-        cc_emails=cc or [],
-        bcc_emails=bcc or [],
-        subject=subject,
-        body_text=body_text or (clean_html(body_html) if body_html else ""),
-        body_html=body_html or "",
-        direction=Email.DIRECTION_OUTBOUND,
-        status=Email.STATUS_QUEUED,
-        created_by=from_account.user,
-        reply_to=reply_to_email,
-    )
+        email = Email.objects.create(
+            thread=thread,
+            email_account=from_account,
+            message_id=message_id,
+            in_reply_to=in_reply_to[:255],
+            references=references,
+            from_email=from_account.email,
+            from_name="",
+            to_emails=to,
+            cc_emails=cc or [],
+            bcc_emails=bcc or [],
+            subject=subject,
+            body_text=body_text or (html_to_text(body_html) if body_html else ""),
+            body_html=body_html or "",
+            direction=Email.DIRECTION_OUTBOUND,
+            is_read=True,
+            status=Email.STATUS_QUEUED,
+            template=template,
+            created_by=from_account.user,
+            reply_to=reply_to_email,
+        )
+    refresh_email_search([email.id])
+
+    if deliver:
+        deliver_email(email)
+    return email
 
+
+def deliver_email(email: Email):
+    """Send a stored Email through its account and record the outcome on it."""
     try:
-        if from_account.provider == EmailAccount.PROVIDER_GMAIL:
-            _send_via_gmail_api(from_account, email)
-        else:
-            _send_via_smtp(from_account, email)
+        transmit_email(email)
         email.status = Email.STATUS_SENT
         email.sent_at = timezone.now()
         email.save(update_fields=["status", "sent_at"])
@@ -72,6 +89,23 @@ def send_email(to, subject, body_html, body_text, from_account=None, attachments
     return email
 
 
+def transmit_email(email: Email):
+    """Hand a stored Email to its account's transport without touching its status."""
+    account = email.email_account
+    if account.provider == EmailAccount.PROVIDER_GMAIL:
+        _send_via_gmail_api(account, email)
+    else:
+        _send_via_smtp(account, email)
+
+
+def _set_threading_headers(msg, email: Email):
+    msg["Message-ID"] = email.message_id
+    if email.in_reply_to:
+        msg["In-Reply-To"] = email.in_reply_to
+    if email.references:
+        msg["References"] = email.references
+
+
 def _send_via_smtp(account: EmailAccount, email: Email):
     host = account.smtp_host or settings.EMAIL_HOST
     port = account.smtp_port or settings.EMAIL_PORT
@@ -79,6 +113,7 @@ def _send_via_smtp(account: EmailAccount, email: Email):
     msg["Subject"] = email.subject
     msg["From"] = account.email
     msg["To"] = ",".join(email.to_emails)
+    _set_threading_headers(msg, email)
     if email.cc_emails:
         msg["Cc"] = ",".join(email.cc_emails)
     if email.body_text:
@@ -86,10 +121,10 @@ def _send_via_smtp(account: EmailAccount, email: Email):
     if email.body_html:
         msg.attach(MIMEText(email.body_html, "html"))
 
-    with smtplib.SMTP(host, port) as server:
-        server.starttls()
-        server.login(account.username, decrypt_secret(account.password))
-        server.sendmail(account.email, email.to_emails + (email.cc_emails or []) + (email.bcc_emails or []), msg.as_string())
+    smtp_pool.sendmail(
+        host, port, account.username, lambda: decrypt_secret(account.password),
+        account.email, email.to_emails + (email.cc_emails or []) + (email.bcc_emails or []), msg.as_string(),
+    )
 
 
 def _send_via_gmail_api(account: EmailAccount, email: Email):
@@ -106,5 +141,6 @@ def _send_via_gmail_api(account: EmailAccount, email: Email):
     message['to'] = ",".join(email.to_emails)
     message['from'] = account.email
     message['subject'] = email.subject
+    _set_threading_headers(message, email)
     raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
     service.users().messages().send(userId='me', body={'raw': raw}).execute()
@@ -0,0 +1,92 @@
+"""Conversation threading for synced and sent mail (RFC 5322 Message-ID / In-Reply-To / References).
+
+A message joins the thread of the closest ancestor found in EmailMessageRef
+(In-Reply-To first, then References newest to oldest). Replies with no known
+ancestor fall back to a recent thread of the same account with the same
+normalized subject. Thread counters are updated in place, never recounted, and
+so are the account's inbox counters (services.mailbox_counters).
+"""
+
+import re
+from datetime import timedelta
+
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from apps.emails.models import EmailThread, EmailMessageRef
+from .mailbox_counters import bump_category, threads_added
+
+SUBJECT_FALLBACK_WINDOW = timedelta(days=30)
+_MESSAGE_ID = re.compile(r'<[^<>\s]+>')
+_REPLY_PREFIX = re.compile(r'^\s*((re|fw|fwd|aw|sv|wg)(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+
+
+def parse_message_ids(value):
+    """Message-IDs in a header value, in order, e.g. a References chain."""
+    return _MESSAGE_ID.findall(value or '')
+
+
+def normalize_subject(subject):
+    return ' '.join(_REPLY_PREFIX.sub('', subject or '').lower().split())[:500]
+
+
+def is_reply_subject(subject):
+    return bool(_REPLY_PREFIX.match(subject or ''))
+
+
+def find_thread(email_account, in_reply_to='', references='', subject='', message_at=None):
+    """Existing thread for a message, or None when it starts a new conversation."""
+    ancestors = parse_message_ids(in_reply_to) + list(reversed(parse_message_ids(references)))
+    if ancestors:
+        found = dict(EmailMessageRef.objects.filter(email_account=email_account, message_id__in=ancestors).values_list('message_id', 'thread_id'))
+        for message_id in ancestors:
+            if message_id in found:
+                return EmailThread.objects.filter(pk=found[message_id]).first()
+    if ancestors or is_reply_subject(subject):
+        normalized = normalize_subject(subject)
+        if normalized:
+            return EmailThread.objects.filter(
+                email_account=email_account, normalized_subject=normalized,
+                last_message_at__gte=(message_at or timezone.now()) - SUBJECT_FALLBACK_WINDOW,
+            ).order_by('-last_message_at').first()
+    return None
+
+
+def assign_thread(email_account, message_id, subject, participants, in_reply_to='', references='', message_at=None, unread=False, thread=None):
+    """Thread for a new message: appended to its conversation or started fresh.
+
+    ``thread`` skips the lookup when the conversation is already known, e.g. a
+    reply composed in the app.
+    """
+    message_at = message_at or timezone.now()
+    participants = [p for p in participants if p]
+    if thread is None:
+        thread = find_thread(email_account, in_reply_to, references, subject, message_at)
+    if thread is None:
+        thread = EmailThread.objects.create(
+            company=email_account.company,
+            email_account=email_account,
+            subject=subject[:500],
+            normalized_subject=normalize_subject(subject),
+            participants=list(dict.fromkeys(participants)),
+            last_message_at=message_at,
+            message_count=1,
+            is_read=not unread,
+        )
+        threads_added([thread])
+    else:
+        updates = {'message_count': F('message_count') + 1, 'last_message_at': Greatest(F('last_message_at'), Value(message_at))}
+        if unread and EmailThread.objects.filter(pk=thread.pk, is_read=True).update(is_read=False):
+            bump_category(email_account.id, thread.category, unread=1)
+        added = [p for p in participants if p not in thread.participants]
+        if added:
+            updates['participants'] = list(dict.fromkeys(thread.participants + added))
+        EmailThread.objects.filter(pk=thread.pk).update(**updates)
+        thread.refresh_from_db()
+    ids = parse_message_ids(message_id) + parse_message_ids(in_reply_to) + parse_message_ids(references)
+    EmailMessageRef.objects.bulk_create(
+        [EmailMessageRef(email_account=email_account, message_id=ref, thread=thread) for ref in dict.fromkeys(ids)],
+        ignore_conflicts=True,
+    )
+    return thread
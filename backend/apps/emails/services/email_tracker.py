@@ -1,45 +1,145 @@
+"""Open/click tracking.
+
+The tracking endpoints never touch the database: each pixel load or link
+click is appended to a Redis list and the response goes out immediately.
+``flush_tracking_events`` (run by Celery beat) drains the list, aggregates
+the events per email and applies them with one F() update per email, so
+concurrent hits can no longer overwrite each other's increments, and
+appends every hit to the engagement event store (services.engagement). If
+Redis is unreachable the hit is applied directly instead of being dropped.
+"""
+
 import base64
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+import redis
 from django.conf import settings
-from django.utils import timezone
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
 from django.http import HttpResponse, HttpResponseRedirect
-from apps.emails.models import Email
+from django.utils import timezone
+from apps.emails.models import Email, EmailEngagementEvent
+from .engagement import classify_user_agent, store_events
+
+TRACKING_QUEUE_KEY = 'puppycrm:emails:tracking'
+FLUSHING_KEY = f'{TRACKING_QUEUE_KEY}:flushing'  # batch being applied; retried by the next flush if one fails
+FLUSH_LOCK_KEY = 'emails:tracking-flush-lock'
+FLUSH_PAGE_SIZE = 5000
+OPEN, CLICK = EmailEngagementEvent.KIND_OPEN, EmailEngagementEvent.KIND_CLICK
+TOKEN_SALT = 'apps.emails.tracking'
+
+PIXEL_GIF = base64.b64decode("R0lGODlhAQABAIABAP///wAAACwAAAAAAQABAAACAkQBADs=")
+
+_redis = None
+
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis
 
 
 def generate_open_token(email: Email) -> str:
-    raw = f"open:{email.id}:{settings.SECRET_KEY[:8]}".encode()
-    return base64.urlsafe_b64encode(raw).decode()
+    return signing.dumps(["open", email.id, ""], salt=TOKEN_SALT, compress=True)
 
 
 def generate_click_token(email: Email, url: str) -> str:
-    raw = f"click:{email.id}:{url}:{settings.SECRET_KEY[:8]}".encode()
-    return base64.urlsafe_b64encode(raw).decode()
+    # The URL is covered by the signature, so a token cannot be re-pointed elsewhere
+    return signing.dumps(["click", email.id, url], salt=TOKEN_SALT, compress=True)
 
 
-def track_open(token: str):
+def parse_token(token: str):
+    """(kind, email_id, url) for a token signed by this server, else None."""
     try:
-        decoded = base64.urlsafe_b64decode(token.encode()).decode()
-        _, email_id, _ = decoded.split(":", 2)
-        email = Email.objects.get(id=int(email_id))
-        email.opens_count += 1
-        if not email.opened_at:
-            email.opened_at = timezone.now()
-        email.save(update_fields=["opens_count", "opened_at"])
-    except Exception:  # noqa: BLE001
-        pass
-    # return 1x1 transparent GIF
-    gif = base64.b64decode("R0lGODlhAQABAIABAP///wAAACwAAAAAAQABAAACAkQBADs=")
-    return HttpResponse(gif, content_type="image/gif")
+        kind, email_id, url = signing.loads(token, salt=TOKEN_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if kind not in ("open", "click") or not isinstance(email_id, int) or not isinstance(url, str):
+        return None
+    return kind, email_id, url
 
 
-def track_click(token: str):
+def record_event(kind: int, email_id: int, user_agent='', url='', at=None):
+    at = at or timezone.now()
+    ua_class = classify_user_agent(user_agent)
     try:
-        decoded = base64.urlsafe_b64decode(token.encode()).decode()
-        _, email_id, url, _ = decoded.split(":", 3)
-        email = Email.objects.get(id=int(email_id))
-        email.clicks_count += 1
-        if not email.clicked_at:
-            email.clicked_at = timezone.now()
-        email.save(update_fields=["clicks_count", "clicked_at"])
-        return HttpResponseRedirect(url)
-    except Exception:  # noqa: BLE001
+        _client().rpush(TRACKING_QUEUE_KEY, f"{kind}:{email_id}:{at.timestamp():.3f}:{ua_class}:{url}")
+    except redis.RedisError:
+        apply_events([(kind, email_id, at, ua_class, url)])
+
+
+def aggregate_events(events):
+    """{email_id: [opens, clicks, first_open, first_click]} from (kind, email_id, at, ...) events."""
+    totals = defaultdict(lambda: [0, 0, None, None])
+    for kind, email_id, at, *_ in events:
+        row = totals[email_id]
+        slot = 0 if kind == OPEN else 1
+        row[slot] += 1
+        if row[slot + 2] is None or at < row[slot + 2]:
+            row[slot + 2] = at
+    return totals
+
+
+def apply_events(events):
+    """Bump Email counters and append the events to the event store, in one transaction."""
+    with transaction.atomic():
+        for email_id, (opens, clicks, first_open, first_click) in aggregate_events(events).items():
+            changes = {}
+            if opens:
+                changes.update(opens_count=F('opens_count') + opens, opened_at=Coalesce('opened_at', Value(first_open)))
+            if clicks:
+                changes.update(clicks_count=F('clicks_count') + clicks, clicked_at=Coalesce('clicked_at', Value(first_click)))
+            Email.objects.filter(pk=email_id).update(**changes)
+        store_events(events)
+
+
+def _parse_event(raw):
+    kind, email_id, ts, ua_class, url = raw.decode().split(":", 4)
+    return int(kind), int(email_id), datetime.fromtimestamp(float(ts), tz=dt_timezone.utc), int(ua_class), url
+
+
+def flush_tracking_events():
+    """Apply everything buffered so far; returns the number of events applied."""
+    if not cache.add(FLUSH_LOCK_KEY, 1, timeout=10 * 60):
+        return 0
+    try:
+        client = _client()
+        # Swap the live list out atomically; hits arriving meanwhile start a new one
+        if not client.exists(FLUSHING_KEY):
+            try:
+                client.rename(TRACKING_QUEUE_KEY, FLUSHING_KEY)
+            except redis.ResponseError:  # nothing buffered
+                return 0
+        events, start = [], 0
+        while True:
+            page = client.lrange(FLUSHING_KEY, start, start + FLUSH_PAGE_SIZE - 1)
+            events.extend(_parse_event(raw) for raw in page)
+            if len(page) < FLUSH_PAGE_SIZE:
+                break
+            start += FLUSH_PAGE_SIZE
+        apply_events(events)
+        client.delete(FLUSHING_KEY)
+        return len(events)
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
+
+
+def track_open(token: str, user_agent=''):
+    parsed = parse_token(token)
+    if parsed and parsed[0] == "open":
+        record_event(OPEN, parsed[1], user_agent)
+    # return 1x1 transparent GIF
+    return HttpResponse(PIXEL_GIF, content_type="image/gif")
+
+
+def track_click(token: str, user_agent=''):
+    parsed = parse_token(token)
+    if not parsed or parsed[0] != "click":
         return HttpResponseRedirect("/")
+    record_event(CLICK, parsed[1], user_agent, url=parsed[2])
+    return HttpResponseRedirect(parsed[2])
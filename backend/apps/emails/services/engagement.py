@@ -0,0 +1,224 @@
+"""Engagement event store and reporting.
+
+Every tracked open and click becomes one EmailEngagementEvent row, written
+in bulk by the tracking flush (services.email_tracker). On PostgreSQL the
+table is range-partitioned by month so reports over recent weeks only scan
+recent partitions and old months can be detached or dropped whole.
+"""
+
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from apps.emails.models import EmailEngagementEvent, EmailLink
+
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = 2000
+TIME_TO_OPEN_BUCKETS = [
+    (timedelta(hours=1), '<1h'),
+    (timedelta(hours=6), '1-6h'),
+    (timedelta(hours=24), '6-24h'),
+    (timedelta(days=3), '1-3d'),
+    (timedelta(days=7), '3-7d'),
+    (None, '7d+'),
+]
+
+PROXY_MARKERS = ('googleimageproxy', 'yahoomailproxy', 'outlook-ios-android', 'ggpht.com')
+BOT_MARKERS = ('bot', 'crawler', 'spider', 'curl', 'python-requests', 'wget', 'headless')
+MOBILE_MARKERS = ('mobile', 'android', 'iphone', 'ipad')
+
+
+def classify_user_agent(user_agent):
+    ua = (user_agent or '').lower()
+    if not ua:
+        return EmailEngagementEvent.UA_UNKNOWN
+    if any(marker in ua for marker in PROXY_MARKERS):
+        return EmailEngagementEvent.UA_PROXY
+    if any(marker in ua for marker in BOT_MARKERS):
+        return EmailEngagementEvent.UA_BOT
+    if any(marker in ua for marker in MOBILE_MARKERS):
+        return EmailEngagementEvent.UA_MOBILE
+    return EmailEngagementEvent.UA_DESKTOP
+
+
+def url_hash(url):
+    """Signed 64-bit prefix of the URL's SHA-256, fits a bigint column."""
+    return int.from_bytes(hashlib.sha256(url.encode()).digest()[:8], 'big', signed=True)
+
+
+def store_events(events):
+    """Append (kind, email_id, at, ua_class, url) events; kind is EmailEngagementEvent.KIND_*."""
+    links = {}
+    rows = []
+    for kind, email_id, at, ua_class, url in events:
+        hashed = None
+        if url:
+            hashed = url_hash(url)
+            links[hashed] = url
+        rows.append(EmailEngagementEvent(email_id=email_id, kind=kind, url_hash=hashed, ua_class=ua_class, occurred_at=at))
+    if links:
+        EmailLink.objects.bulk_create([EmailLink(url_hash=h, url=u) for h, u in links.items()], ignore_conflicts=True)
+    EmailEngagementEvent.objects.bulk_create(rows, batch_size=INSERT_BATCH_SIZE)
+
+
+# Reporting --------------------------------------------------------------------
+
+def _rates(emails, events, key, label):
+    opened = dict(
+        events.filter(kind=EmailEngagementEvent.KIND_OPEN).values(f'email__{key}')
+        .annotate(n=Count('email_id', distinct=True)).values_list(f'email__{key}', 'n')
+    )
+    clicked = dict(
+        events.filter(kind=EmailEngagementEvent.KIND_CLICK).values(f'email__{key}')
+        .annotate(n=Count('email_id', distinct=True)).values_list(f'email__{key}', 'n')
+    )
+    rows = []
+    for row in emails.exclude(**{f'{key}__isnull': True}).values(key, label).annotate(sent=Count('id')).order_by('-sent'):
+        sent, group = row['sent'], row[key]
+        rows.append({
+            'id': group,
+            'name': row[label],
+            'sent': sent,
+            'opened': opened.get(group, 0),
+            'clicked': clicked.get(group, 0),
+            'open_rate': round(opened.get(group, 0) / sent, 4),
+            'click_rate': round(clicked.get(group, 0) / sent, 4),
+        })
+    return rows
+
+
+def time_to_open(events):
+    """Emails per delay bucket between sending and the first open."""
+    counts = dict.fromkeys((label for _, label in TIME_TO_OPEN_BUCKETS), 0)
+    firsts = (
+        events.filter(kind=EmailEngagementEvent.KIND_OPEN, email__sent_at__isnull=False)
+        .values('email_id').annotate(first=Min('occurred_at'), sent_at=Min('email__sent_at'))
+        .values_list('first', 'sent_at')
+    )
+    for first, sent_at in firsts.iterator():
+        delay = first - sent_at
+        counts[next(label for limit, label in TIME_TO_OPEN_BUCKETS if limit is None or delay < limit)] += 1
+    return [{'bucket': label, 'emails': counts[label]} for _, label in TIME_TO_OPEN_BUCKETS]
+
+
+def top_links(events, limit=10):
+    rows = list(
+        events.filter(kind=EmailEngagementEvent.KIND_CLICK, url_hash__isnull=False)
+        .values('url_hash').annotate(clicks=Count('id'), emails=Count('email_id', distinct=True))
+        .order_by('-clicks')[:limit]
+    )
+    urls = dict(EmailLink.objects.filter(url_hash__in=[r['url_hash'] for r in rows]).values_list('url_hash', 'url'))
+    return [{'url': urls.get(r['url_hash'], ''), 'clicks': r['clicks'], 'emails': r['emails']} for r in rows]
+
+
+def engagement_report(emails, since):
+    """Rates, time-to-open and top links for outbound ``emails`` sent since ``since``."""
+    emails = emails.filter(sent_at__gte=since)
+    # Bot hits are stored but not reported; proxy opens still count as opens
+    events = EmailEngagementEvent.objects.filter(occurred_at__gte=since, email__in=emails).exclude(ua_class=EmailEngagementEvent.UA_BOT)
+    return {
+        'templates': _rates(emails, events, 'template_id', 'template__name'),
+        'senders': _rates(emails, events, 'email_account_id', 'email_account__email'),
+        'time_to_open': time_to_open(events),
+        'top_links': top_links(events),
+    }
+
+
+# Monthly partitions (PostgreSQL) -------------------------------------------------
+
+def _month_starts(first, count):
+    month = first.replace(day=1)
+    for _ in range(count):
+        yield month
+        month = (month + timedelta(days=32)).replace(day=1)
+
+
+def _months_between(first, last):
+    return (last.year - first.year) * 12 + last.month - first.month + 1
+
+
+def _create_month_partition(cursor, table, start):
+    qn = connection.ops.quote_name
+    end = (start + timedelta(days=32)).replace(day=1)
+    name = f'{table}_{start:%Y%m}'
+    cursor.execute(
+        f'CREATE TABLE IF NOT EXISTS {qn(name)} PARTITION OF {qn(table)} '
+        f"FOR VALUES FROM ('{start.isoformat()} 00:00:00+00') TO ('{end.isoformat()} 00:00:00+00')"
+    )
+    return name
+
+
+def _convert_to_partitioned(cursor, table):
+    """Swap the plain table created by migrate for a partitioned one with the same columns."""
+    qn = connection.ops.quote_name
+    # A new sequence: the identity (or serial) sequence of ``id`` belongs to the
+    # old table, cannot be re-owned and is dropped with it
+    old, seq = f'{table}_unpartitioned', f'{table}_part_id_seq'
+    cursor.execute(f'ALTER TABLE {qn(table)} ALTER COLUMN id DROP IDENTITY IF EXISTS')
+    cursor.execute(f'ALTER TABLE {qn(table)} ALTER COLUMN id DROP DEFAULT')
+    cursor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old)}')
+    # Identity columns are not allowed on partitioned tables before PostgreSQL 17
+    cursor.execute(f'CREATE SEQUENCE IF NOT EXISTS {qn(seq)}')
+    cursor.execute(f"SELECT setval('{seq}', COALESCE((SELECT MAX(id) FROM {qn(old)}), 0) + 1, false)")
+    cursor.execute(f"""
+        CREATE TABLE {qn(table)} (
+            id bigint NOT NULL DEFAULT nextval('{seq}'),
+            email_id bigint NOT NULL,
+            kind smallint NOT NULL CHECK (kind >= 0),
+            url_hash bigint NULL,
+            ua_class smallint NOT NULL CHECK (ua_class >= 0),
+            occurred_at timestamp with time zone NOT NULL,
+            PRIMARY KEY (id, occurred_at)
+        ) PARTITION BY RANGE (occurred_at)
+    """)
+    cursor.execute(f'ALTER SEQUENCE {qn(seq)} OWNED BY {qn(table)}.id')
+    cursor.execute(f'CREATE TABLE {qn(table + "_default")} PARTITION OF {qn(table)} DEFAULT')
+    # Partitions for the months already stored, so the copied rows stay out of the default partition
+    cursor.execute(
+        f"SELECT (date_trunc('month', MIN(occurred_at) AT TIME ZONE 'UTC'))::date, "
+        f"(date_trunc('month', MAX(occurred_at) AT TIME ZONE 'UTC'))::date FROM {qn(old)}"
+    )
+    first, last = cursor.fetchone()
+    if first is not None:
+        for start in _month_starts(first, _months_between(first, last)):
+            _create_month_partition(cursor, table, start)
+    cursor.execute(
+        f'INSERT INTO {qn(table)} (id, email_id, kind, url_hash, ua_class, occurred_at) '
+        f'SELECT id, email_id, kind, url_hash, ua_class, occurred_at FROM {qn(old)}'
+    )
+    cursor.execute(f'DROP TABLE {qn(old)}')
+    for index in EmailEngagementEvent._meta.indexes:
+        columns = ', '.join(qn(EmailEngagementEvent._meta.get_field(f).column) for f in index.fields)
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {qn(index.name)} ON {qn(table)} ({columns})')
+
+
+def ensure_event_partitions(months_ahead=2):
+    """Create this month's and the next ``months_ahead`` partitions; returns the names created or checked."""
+    if connection.vendor != 'postgresql':
+        return []
+    qn = connection.ops.quote_name
+    table = EmailEngagementEvent._meta.db_table
+    names = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', [table])
+        row = cursor.fetchone()
+        if row is None:
+            return []  # not migrated yet
+        if row[0] == 'r':
+            _convert_to_partitioned(cursor, table)
+        for start in _month_starts(timezone.now().date(), months_ahead + 1):
+            name = f'{table}_{start:%Y%m}'
+            try:
+                with transaction.atomic():
+                    _create_month_partition(cursor, table, start)
+            except Exception as exc:  # noqa: BLE001
+                # e.g. rows for that month already sit in the default partition
+                logger.warning('Could not create partition %s: %s', name, exc)
+                continue
+            names.append(name)
+    return names
@@ -0,0 +1,133 @@
+"""IMAP IDLE push listener (``manage.py listen_emails``).
+
+One watcher thread per active IMAP account keeps a session open in IDLE and
+runs an incremental sync_folder on that same session as soon as the server
+reports new mail, so inbound mail shows up within seconds without a login
+per poll. Watchers refresh ``EmailAccount.idle_heartbeat_at`` and the
+periodic sync pool skips accounts with a fresh heartbeat; servers without
+the IDLE capability, and accounts whose watcher died, simply stay on polling.
+"""
+
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from apps.emails.models import EmailAccount
+from .email_receiver import connect, sync_folder
+from .sync_pool import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+IDLE_CHECK_SECONDS = 60  # wake-up interval while idling, also the heartbeat period
+IDLE_RENEW_SECONDS = 25 * 60  # RFC 2177: re-issue IDLE before the 29 minute server timeout
+NEW_MAIL_RESPONSES = (b'EXISTS', b'RECENT')
+
+
+def idle_candidates():
+    return EmailAccount.objects.filter(
+        is_active=True, sync_enabled=True,
+        provider__in=(EmailAccount.PROVIDER_IMAP, EmailAccount.PROVIDER_GMAIL),
+    ).exclude(imap_host='').exclude(imap_port__isnull=True)
+
+
+def has_new_mail(responses):
+    return any(len(response) > 1 and response[1] in NEW_MAIL_RESPONSES for response in responses)
+
+
+class IdleWatcher(threading.Thread):
+    """Keeps one account's INBOX in IDLE until stopped, reconnecting with backoff."""
+
+    def __init__(self, account_id, folder='INBOX'):
+        super().__init__(name=f'imap-idle-{account_id}', daemon=True)
+        self.account_id = account_id
+        self.folder = folder
+        self.supports_idle = True
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self):
+        failures = 0
+        while not self.stopped and self.supports_idle:
+            try:
+                self.watch()
+                failures = 0
+            except Exception as exc:  # noqa: BLE001
+                failures += 1
+                logger.warning('IDLE watcher for account %s failed (%s): %s', self.account_id, failures, exc)
+                self._stop_event.wait(backoff_delay(failures))
+            finally:
+                close_old_connections()
+
+    def watch(self):
+        account = EmailAccount.objects.filter(pk=self.account_id).first()
+        if account is None:
+            self.stop()
+            return
+        client = connect(account, timeout=IDLE_CHECK_SECONDS * 2)
+        try:
+            if not client.has_capability('IDLE'):
+                # Left to the periodic sync pool
+                self.supports_idle = False
+                return
+            self.sync(client, account)  # catch up on anything missed while disconnected
+            while not self.stopped:
+                client.idle()
+                started = time.monotonic()
+                new_mail = False
+                try:
+                    while not self.stopped and not new_mail and time.monotonic() - started < IDLE_RENEW_SECONDS:
+                        new_mail = has_new_mail(client.idle_check(timeout=IDLE_CHECK_SECONDS))
+                        self.heartbeat()
+                finally:
+                    client.idle_done()
+                if new_mail:
+                    self.sync(client, account)
+        finally:
+            # Back on polling: sync soon rather than at a next_sync_at from before the watch
+            EmailAccount.objects.filter(pk=self.account_id).update(idle_heartbeat_at=None, next_sync_at=timezone.now())
+            try:
+                client.logout()
+            except Exception:  # noqa: BLE001
+                pass
+
+    def sync(self, client, account):
+        count = sync_folder(client, account, self.folder)
+        EmailAccount.objects.filter(pk=self.account_id).update(last_sync=timezone.now(), idle_heartbeat_at=timezone.now())
+        if count:
+            logger.info('IDLE: synced %s new emails for account %s', count, self.account_id)
+
+    def heartbeat(self):
+        EmailAccount.objects.filter(pk=self.account_id).update(idle_heartbeat_at=timezone.now())
+        # Idle mailboxes should not each pin a database connection
+        close_old_connections()
+
+
+def run_idle_listener(refresh_seconds=60, max_accounts=None, stop_event=None):
+    """Start/stop watchers as accounts come and go until ``stop_event`` is set."""
+    stop_event = stop_event or threading.Event()
+    watchers = {}
+    try:
+        while not stop_event.is_set():
+            wanted = list(idle_candidates().order_by('id').values_list('id', flat=True)[:max_accounts])
+            for account_id in set(watchers) - set(wanted):
+                watchers.pop(account_id).stop()
+            for account_id in wanted:
+                watcher = watchers.get(account_id)
+                if watcher is None or (not watcher.is_alive() and watcher.supports_idle):
+                    watchers[account_id] = watcher = IdleWatcher(account_id)
+                    watcher.start()
+            close_old_connections()
+            stop_event.wait(refresh_seconds)
+    finally:
+        for watcher in watchers.values():
+            watcher.stop()
+    return watchers
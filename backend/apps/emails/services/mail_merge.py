@@ -0,0 +1,96 @@
+"""Mail merge: one EmailTemplate rendered for many CRM records.
+
+Recipients are leads, deals or customers of one company. Their template
+variables are loaded with a few batched queries per RECIPIENT_BATCH_SIZE
+ids (never one per recipient), the sender's variables once per merge, and
+every message is rendered from the same compiled template.
+"""
+
+from django.db.models import F
+
+from apps.authentication.models import CustomerCompany
+from apps.crm.models import Deal, Lead
+from apps.customers.models import Order
+from apps.emails.models import EmailTemplate
+from .template_renderer import compile_template
+
+RECIPIENT_LEAD, RECIPIENT_DEAL, RECIPIENT_CUSTOMER = 'lead', 'deal', 'customer'
+RECIPIENT_TYPES = (RECIPIENT_LEAD, RECIPIENT_DEAL, RECIPIENT_CUSTOMER)
+RECIPIENT_BATCH_SIZE = 500
+MAX_MERGE_RECIPIENTS = 1000
+
+
+def sender_context(user, company=None):
+    """Variables that are the same for every recipient."""
+    if company is None:
+        company_user = user.company_users.select_related('company').first()
+        company = company_user.company if company_user else None
+    return {
+        'customer_name': '',
+        'company_name': company.company_name if company else '',
+        'user_name': user.get_full_name() or user.username,
+        'lead_name': '',
+        'deal_title': '',
+        'order_number': '',
+    }
+
+
+def _full_name(first_name, last_name):
+    return f'{first_name or ""} {last_name or ""}'.strip()
+
+
+def _lead_rows(company_id, ids):
+    rows = Lead.objects.filter(company_id=company_id, id__in=ids).values_list('id', 'email', 'first_name', 'last_name')
+    for lead_id, email, first_name, last_name in rows:
+        yield lead_id, email, {'lead_name': _full_name(first_name, last_name)}
+
+
+def _deal_rows(company_id, ids):
+    rows = Deal.objects.filter(company_id=company_id, id__in=ids).values_list('id', 'contact_email', 'contact_name', 'title')
+    for deal_id, email, contact_name, title in rows:
+        yield deal_id, email, {'customer_name': contact_name, 'deal_title': title}
+
+
+def _customer_rows(company_id, ids):
+    latest_order = {}
+    orders = Order.objects.filter(company_id=company_id, customer_id__in=ids).order_by('customer_id', '-order_date')
+    for customer_id, order_number in orders.values_list('customer_id', 'order_number'):
+        latest_order.setdefault(customer_id, order_number)
+    rows = CustomerCompany.objects.filter(company_id=company_id, customer_id__in=ids).values_list(
+        'customer_id', 'customer__user__email', 'customer__user__first_name', 'customer__user__last_name'
+    )
+    for customer_id, email, first_name, last_name in rows:
+        yield customer_id, email, {'customer_name': _full_name(first_name, last_name), 'order_number': latest_order.get(customer_id, '')}
+
+
+ROW_LOADERS = {RECIPIENT_LEAD: _lead_rows, RECIPIENT_DEAL: _deal_rows, RECIPIENT_CUSTOMER: _customer_rows}
+
+
+def merge_contexts(company_id, recipient_type, ids, base):
+    """{record id: (email address, context)} for the records of ``company_id`` among ``ids``."""
+    load = ROW_LOADERS[recipient_type]
+    ids = list(dict.fromkeys(ids))
+    contexts = {}
+    for start in range(0, len(ids), RECIPIENT_BATCH_SIZE):
+        for record_id, email, context in load(company_id, ids[start:start + RECIPIENT_BATCH_SIZE]):
+            contexts[record_id] = (email, {**base, **context})
+    return contexts
+
+
+def render_merge(template, user, recipient_type, ids):
+    """Rendered messages in ``ids`` order, plus the ids that matched no record with an address."""
+    compiled = compile_template(template)
+    contexts = merge_contexts(template.company_id, recipient_type, ids, sender_context(user, template.company))
+    messages, missing = [], []
+    for record_id in dict.fromkeys(ids):
+        email, context = contexts.get(record_id, (None, None))
+        if not email:
+            missing.append(record_id)
+            continue
+        messages.append({'recipient_id': record_id, 'to': email, **compiled.render(context)})
+    return messages, missing
+
+
+def record_usage(template_id, count):
+    if count:
+        EmailTemplate.objects.filter(pk=template_id).update(usage_count=F('usage_count') + count)
@@ -0,0 +1,138 @@
+"""Denormalized inbox counters.
+
+EmailAccount.email_count / unread_count count the account's emails and
+EmailCategoryCounter counts its threads per category, so the account list
+and the category sidebar read a handful of rows instead of counting the
+mailbox. Every change to what they count goes through this module inside
+the same transaction as the change itself: sync and send (via
+``assign_thread`` and ``email_added``), mark-as-read, delete and
+recategorization. ``reconcile`` recomputes them from the emails and threads
+and is run periodically to repair any drift.
+
+Lock order, to stay clear of deadlocks: account row, thread, email, then
+category rows in (account, category) order. Sync and send take the account
+row first by bumping it before they touch the thread.
+"""
+
+import logging
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from apps.emails.models import Email, EmailAccount, EmailCategoryCounter, EmailThread
+
+logger = logging.getLogger(__name__)
+
+
+def bump_account(account_id, emails=0, unread=0):
+    if emails or unread:
+        EmailAccount.objects.filter(pk=account_id).update(email_count=F('email_count') + emails, unread_count=F('unread_count') + unread)
+
+
+def bump_category(account_id, category, threads=0, unread=0):
+    if not (threads or unread):
+        return
+    changes = {'thread_count': F('thread_count') + threads, 'unread_count': F('unread_count') + unread}
+    counters = EmailCategoryCounter.objects.filter(email_account_id=account_id, category=category)
+    if not counters.update(**changes):
+        EmailCategoryCounter.objects.bulk_create([EmailCategoryCounter(email_account_id=account_id, category=category)], ignore_conflicts=True)
+        counters.update(**changes)
+
+
+def email_added(account_id, unread, count=1):
+    bump_account(account_id, emails=count, unread=count if unread else 0)
+
+
+def threads_added(threads):
+    """Count newly created threads."""
+    groups = Counter((t.email_account_id, t.category, t.is_read) for t in threads)
+    for (account_id, category, is_read), n in groups.items():
+        bump_category(account_id, category, threads=n, unread=0 if is_read else n)
+
+
+def _lock_account(account_id):
+    list(EmailAccount.objects.select_for_update().filter(pk=account_id).values_list('pk', flat=True))
+
+
+def mark_thread_read(thread):
+    """Mark a thread and its emails read; returns how many emails were unread."""
+    with transaction.atomic():
+        _lock_account(thread.email_account_id)
+        thread = EmailThread.objects.select_for_update().get(pk=thread.pk)
+        read = thread.emails.filter(is_read=False).update(is_read=True)
+        bump_account(thread.email_account_id, unread=-read)
+        if not thread.is_read:
+            EmailThread.objects.filter(pk=thread.pk).update(is_read=True)
+            bump_category(thread.email_account_id, thread.category, unread=-1)
+    return read
+
+
+def email_deleted(email):
+    """Soft-delete an email; it stops counting as unread, and so does its thread once nothing in it is."""
+    with transaction.atomic():
+        _lock_account(email.email_account_id)
+        thread = EmailThread.objects.select_for_update().get(pk=email.thread_id)
+        email = Email.objects.select_for_update().get(pk=email.pk)
+        Email.objects.filter(pk=email.pk).update(status=Email.STATUS_FAILED, is_read=True)
+        if email.is_read:
+            return
+        bump_account(email.email_account_id, unread=-1)
+        if not thread.is_read and not thread.emails.filter(is_read=False).exists():
+            EmailThread.objects.filter(pk=thread.pk).update(is_read=True)
+            bump_category(thread.email_account_id, thread.category, unread=-1)
+
+
+def set_category(thread_ids, category, **changes):
+    """Move threads to ``category`` (plus any other field ``changes``), keeping the counters in step."""
+    with transaction.atomic():
+        rows = EmailThread.objects.select_for_update().filter(id__in=thread_ids).exclude(category=category)
+        deltas = {}
+        for account_id, old, is_read in rows.values_list('email_account_id', 'category', 'is_read'):
+            for key, sign in (((account_id, old), -1), ((account_id, category), 1)):
+                delta = deltas.setdefault(key, [0, 0])
+                delta[0] += sign
+                delta[1] += 0 if is_read else sign
+        EmailThread.objects.filter(id__in=thread_ids).update(category=category, **changes)
+        for (account_id, key_category), (threads, unread) in sorted(deltas.items()):
+            bump_category(account_id, key_category, threads=threads, unread=unread)
+
+
+def reconcile(account_ids=None):
+    """Recompute counters from emails and threads; returns the ids of accounts that had drifted."""
+    if account_ids is None:
+        account_ids = list(EmailAccount.objects.order_by('pk').values_list('pk', flat=True))
+    drifted = []
+    for account_id in account_ids:
+        with transaction.atomic():
+            # Writers bump the account row in their own transaction, so they wait for this one or it for them
+            account = EmailAccount.objects.select_for_update().filter(pk=account_id).only('email_count', 'unread_count').first()
+            if account is None:
+                continue
+            emails = Email.objects.filter(email_account_id=account_id).aggregate(
+                total=Count('id'), unread=Count('id', filter=Q(is_read=False))
+            )
+            threads = {
+                row['category']: (row['total'], row['unread'])
+                for row in EmailThread.objects.filter(email_account_id=account_id).values('category')
+                .annotate(total=Count('id'), unread=Count('id', filter=Q(is_read=False))).order_by()
+            }
+            stored = {c.category: c for c in EmailCategoryCounter.objects.filter(email_account_id=account_id)}
+            changed = (account.email_count, account.unread_count) != (emails['total'], emails['unread'])
+            if changed:
+                EmailAccount.objects.filter(pk=account_id).update(email_count=emails['total'], unread_count=emails['unread'])
+            for category in set(threads) | set(stored):
+                total, unread = threads.get(category, (0, 0))
+                counter = stored.get(category)
+                if counter is None:
+                    EmailCategoryCounter.objects.create(email_account_id=account_id, category=category, thread_count=total, unread_count=unread)
+                elif (counter.thread_count, counter.unread_count) != (total, unread):
+                    EmailCategoryCounter.objects.filter(pk=counter.pk).update(thread_count=total, unread_count=unread)
+                else:
+                    continue
+                changed = True
+            if changed:
+                drifted.append(account_id)
+    if drifted:
+        logger.info('Repaired inbox counters of %s email accounts', len(drifted))
+    return drifted
@@ -0,0 +1,38 @@
+"""Per-EmailAccount send throttling shared by all workers.
+
+Tokens are counted in the shared cache (Redis in production), one counter
+per account per window, so every worker draws from the same allowance. The
+cache offers an atomic incr but no compare-and-set, so the bucket refills in
+whole windows: ``rate`` sends per minute become ``burst`` sends every
+``window`` seconds.
+"""
+
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class SendRateLimiter:
+    def __init__(self, account):
+        rate = account.send_rate_per_minute or getattr(settings, 'EMAIL_SEND_RATE_PER_MINUTE', 60)
+        self.account_id = account.id
+        self.window = max(1, math.ceil(60 / rate))
+        self.burst = max(1, rate * self.window // 60)
+
+    def try_acquire(self):
+        """Take one token: 0 when the send may go ahead, else seconds until the next window."""
+        now = time.time()
+        window_start = int(now // self.window) * self.window
+        key = f'emails:send-rate:{self.account_id}:{window_start}'
+        cache.add(key, 0, timeout=self.window * 2)
+        try:
+            used = cache.incr(key)
+        except ValueError:
+            # Expired between add and incr: the window is over anyway
+            cache.add(key, 1, timeout=self.window * 2)
+            used = 1
+        if used <= self.burst:
+            return 0
+        return window_start + self.window - now
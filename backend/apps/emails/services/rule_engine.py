@@ -0,0 +1,137 @@
+"""Compiled EmailRule matching.
+
+All active rules of a company are compiled once into a CompiledRules: the
+keywords of every rule go into a single KeywordMatcher, so an email's text
+is lowercased and scanned once no matter how many rules or keywords there
+are, and each rule then only checks set membership and a few scalar
+conditions. Compiled rules are kept per process and rebuilt when the
+company's version key in the shared cache changes; the EmailRule signals
+bump it (apps.emails.signals).
+
+Rule conditions (all optional, all must hold):
+    keywords        any of these substrings in subject or body (case-insensitive)
+    sender_domain   domain or list of domains; subdomains match too
+    category        thread category or list of categories
+    has_attachment  true / false
+"""
+
+import re
+import threading
+import time
+from email.utils import parseaddr
+
+from django.core.cache import cache
+
+from apps.emails.models import Email, EmailRule
+
+RULES_VERSION_KEY = 'emails:rules-version:{company_id}'
+
+_compiled = {}  # company_id -> (version, CompiledRules)
+_lock = threading.Lock()
+
+
+def _as_list(value):
+    if value is None or value == '':
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+class KeywordMatcher:
+    """Finds which of a fixed set of keywords occur in a text, in one regex pass.
+
+    The keywords form one alternation inside a lookahead, tried at every
+    position, longest first; the shorter keywords that are prefixes of a hit
+    are added from a precomputed table, so overlapping keywords are all found.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = sorted({k.lower() for k in keywords if k}, key=len, reverse=True)
+        self._prefixes = {k: [other for other in self.keywords if k.startswith(other)] for k in self.keywords}
+        self._pattern = (
+            re.compile('(?=(' + '|'.join(re.escape(k) for k in self.keywords) + '))', re.DOTALL)
+            if self.keywords else None
+        )
+
+    def find(self, text):
+        if self._pattern is None or not text:
+            return set()
+        found = set()
+        for match in self._pattern.finditer(text.lower()):
+            found.update(self._prefixes[match.group(1)])
+        return found
+
+
+class CompiledRule:
+    __slots__ = ('id', 'trigger', 'keywords', 'sender_domains', 'categories', 'has_attachment', 'action', 'template_id')
+
+    def __init__(self, rule):
+        conditions = rule.conditions if isinstance(rule.conditions, dict) else {}
+        actions = rule.actions if isinstance(rule.actions, dict) else {}
+        self.id = rule.id
+        self.trigger = rule.trigger
+        self.keywords = frozenset(str(k).lower() for k in _as_list(conditions.get('keywords')) if k)
+        self.sender_domains = tuple(str(d).lower().lstrip('@') for d in _as_list(conditions.get('sender_domain')))
+        self.categories = frozenset(_as_list(conditions.get('category')))
+        has_attachment = conditions.get('has_attachment')
+        self.has_attachment = None if has_attachment is None else bool(has_attachment)
+        self.action = actions.get('action')
+        self.template_id = rule.template_id
+
+    def matches(self, found, sender_domain, category, has_attachment):
+        if self.keywords and self.keywords.isdisjoint(found):
+            return False
+        if self.sender_domains and not any(sender_domain == d or sender_domain.endswith('.' + d) for d in self.sender_domains):
+            return False
+        if self.categories and category not in self.categories:
+            return False
+        return self.has_attachment is None or self.has_attachment == has_attachment
+
+
+class CompiledRules:
+    def __init__(self, rules):
+        self.rules = [CompiledRule(rule) for rule in rules]
+        self.matcher = KeywordMatcher(k for rule in self.rules for k in rule.keywords)
+
+    def evaluate(self, email, trigger):
+        """Rules for ``trigger`` that match ``email``, in rule id order."""
+        candidates = [rule for rule in self.rules if rule.trigger == trigger]
+        if not candidates:
+            return []
+        found = self.matcher.find(f"{email.subject}\n{email.body_text}") if any(r.keywords for r in candidates) else set()
+        sender_domain = parseaddr(email.from_email)[1].rpartition('@')[2].lower()
+        category = email.thread.category
+        return [rule for rule in candidates if rule.matches(found, sender_domain, category, email.has_attachments)]
+
+
+def trigger_for(email):
+    return EmailRule.TRIGGER_EMAIL_RECEIVED if email.direction == Email.DIRECTION_INBOUND else EmailRule.TRIGGER_EMAIL_SENT
+
+
+def _rules_version(company_id):
+    key = RULES_VERSION_KEY.format(company_id=company_id)
+    try:
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, time.time_ns(), timeout=None)
+            version = cache.get(key)
+    except Exception:  # noqa: BLE001
+        return None  # cache down: never trust the local copy
+    return version
+
+
+def get_compiled_rules(company_id):
+    version = _rules_version(company_id)
+    cached = _compiled.get(company_id)
+    if cached is not None and version is not None and cached[0] == version:
+        return cached[1]
+    compiled = CompiledRules(EmailRule.objects.filter(company_id=company_id, is_active=True).order_by('id'))
+    with _lock:
+        _compiled[company_id] = (version, compiled)
+    return compiled
+
+
+def invalidate_rules(company_id):
+    try:
+        cache.set(RULES_VERSION_KEY.format(company_id=company_id), time.time_ns(), timeout=None)
+    except Exception:  # noqa: BLE001
+        pass
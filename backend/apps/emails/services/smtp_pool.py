@@ -0,0 +1,159 @@
+"""Per-process pool of authenticated SMTP connections.
+
+Connections are keyed by (host, port, username) and reused across sends, so
+the TCP connect, STARTTLS handshake and AUTH happen once per connection
+instead of once per email. A connection idle for a while is checked with
+NOOP before reuse, one idle past the server's likely timeout is replaced,
+and each connection is retired after ``max_messages`` sends. A send is
+retried once on another connection only when a reused connection turns out
+to be dead before DATA began; once the message may have reached the server,
+an error propagates rather than risk delivering it twice.
+"""
+
+import atexit
+import smtplib
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+# The connection is gone; resent only if the message was not handed over yet.
+# A timeout is not one of them: the server may still be accepting the message.
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError)
+
+
+class PooledConnection:
+    def __init__(self, key, smtp):
+        self.key = key
+        self.smtp = smtp
+        self.sent = 0
+        self.checkouts = 0
+        self.in_data = False  # DATA was started by the current send
+        self.last_used = time.monotonic()
+
+    def sendmail(self, from_addr, to_addrs, message):
+        """smtp.sendmail, noting in ``in_data`` whether the message was handed over."""
+        data = self.smtp.data
+
+        def tracked_data(msg):
+            self.in_data = True
+            return data(msg)
+
+        self.in_data = False
+        self.smtp.data = tracked_data
+        try:
+            return self.smtp.sendmail(from_addr, to_addrs, message)
+        finally:
+            del self.smtp.data
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:  # noqa: BLE001
+            try:
+                self.smtp.close()
+            except Exception:  # noqa: BLE001
+                pass
+
+
+class SMTPConnectionPool:
+    def __init__(self, max_messages=100, max_idle=2, idle_timeout=120, noop_after=15, timeout=30):
+        self.max_messages = max_messages  # sends before a connection is retired
+        self.max_idle = max_idle  # idle connections kept per key
+        self.idle_timeout = idle_timeout  # seconds; older idle connections are dropped, not probed
+        self.noop_after = noop_after  # seconds idle before a NOOP health check
+        self.timeout = timeout
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def sendmail(self, host, port, username, password, from_addr, to_addrs, message):
+        """Send one message over a pooled connection; ``password`` may be a callable, used on connect only."""
+        key = (host, int(port), username)
+        for attempt in range(2):
+            connection = self._checkout(key, password)
+            try:
+                result = connection.sendmail(from_addr, to_addrs, message)
+            except RECONNECT_ERRORS:
+                connection.close()
+                # Only a stale reused connection is safe to retry: nothing reached the server
+                if attempt or connection.checkouts < 2 or connection.in_data:
+                    raise
+                continue
+            except smtplib.SMTPResponseException as exc:
+                # Recipient/sender/data refusals leave the session usable; anything else may not
+                if isinstance(exc, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+                    self._checkin(connection)
+                else:
+                    connection.close()
+                raise
+            except smtplib.SMTPRecipientsRefused:
+                self._checkin(connection)
+                raise
+            except Exception:
+                connection.close()
+                raise
+            connection.sent += 1
+            self._checkin(connection)
+            return result
+
+    def _checkout(self, key, password):
+        while True:
+            with self._lock:
+                idle = self._idle[key]
+                connection = idle.pop() if idle else None
+            if connection is None:
+                connection = self._connect(key, password)
+                connection.checkouts += 1
+                return connection
+            idle_for = time.monotonic() - connection.last_used
+            if idle_for > self.idle_timeout:
+                connection.close()
+                continue
+            if idle_for > self.noop_after:
+                try:
+                    code, _ = connection.smtp.noop()
+                except Exception:  # noqa: BLE001
+                    code = None
+                if code != 250:
+                    connection.close()
+                    continue
+            connection.checkouts += 1
+            return connection
+
+    def _checkin(self, connection):
+        connection.last_used = time.monotonic()
+        if connection.sent >= self.max_messages:
+            connection.close()
+            return
+        with self._lock:
+            idle = self._idle[connection.key]
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _connect(self, key, password):
+        host, port, username = key
+        smtp = smtplib.SMTP(host, port, timeout=self.timeout)
+        try:
+            smtp.starttls()
+            smtp.login(username, password() if callable(password) else password)
+        except Exception:
+            smtp.close()
+            raise
+        return PooledConnection(key, smtp)
+
+    def close_all(self):
+        with self._lock:
+            connections = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for connection in connections:
+            connection.close()
+
+
+smtp_pool = SMTPConnectionPool(
+    max_messages=getattr(settings, 'EMAIL_SMTP_POOL_MAX_MESSAGES', 100),
+    idle_timeout=getattr(settings, 'EMAIL_SMTP_POOL_IDLE_TIMEOUT', 120),
+)
+atexit.register(smtp_pool.close_all)
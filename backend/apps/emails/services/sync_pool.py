@@ -0,0 +1,212 @@
+"""Concurrent IMAP sync of many accounts from one worker process.
+
+An asyncio loop schedules one job per due account under a global limit and a
+per-IMAP-host limit. imapclient and the ORM are blocking, so each job runs on
+an executor thread; the loop only waits, which is where a sync spends nearly
+all its time. Every run is recorded in EmailSyncLog with its latency. Each
+thread also holds a database connection until its job ends, so the global
+limit (EMAIL_SYNC_CONCURRENCY) is a database connection budget too.
+
+Each account carries its own schedule: ``next_sync_at`` (indexed), and the
+pool only takes accounts whose time has passed, oldest first, pushing their
+``next_sync_at`` out by a lease so an overlapping run cannot pick them too.
+After a sync the interval adapts to the arrival rate (about one new message
+per poll, between EMAIL_SYNC_MIN_INTERVAL and EMAIL_SYNC_MAX_INTERVAL), a
+failure reschedules with exponential backoff, and an account whose inbox is
+being viewed is polled every EMAIL_SYNC_ACTIVE_INTERVAL seconds.
+``queue_metrics`` reports how many accounts are due and how late they are.
+"""
+
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, Min, Q, Value
+from django.db.models.functions import Least
+from django.utils import timezone
+
+from apps.emails.models import EmailAccount, EmailSyncLog
+from .email_receiver import sync_account
+
+BACKOFF_BASE = 60  # seconds after the first failure, doubled per further failure
+BACKOFF_MAX = 6 * 60 * 60
+IDLE_HEARTBEAT_STALE = timedelta(minutes=3)  # see services.idle_listener
+ACTIVE_WINDOW = timedelta(minutes=15)  # an inbox view keeps the account on the active interval this long
+VIEW_WRITE_EVERY = timedelta(minutes=1)  # inbox_viewed_at is refreshed at most this often
+
+
+def _interval_bounds():
+    return getattr(settings, 'EMAIL_SYNC_MIN_INTERVAL', 60), getattr(settings, 'EMAIL_SYNC_MAX_INTERVAL', 3600)
+
+
+def _active_interval():
+    return getattr(settings, 'EMAIL_SYNC_ACTIVE_INTERVAL', 60)
+
+
+def polled_accounts():
+    return EmailAccount.objects.filter(
+        is_active=True, sync_enabled=True,
+        provider__in=(EmailAccount.PROVIDER_IMAP, EmailAccount.PROVIDER_GMAIL),
+    ).exclude(imap_host='')
+
+
+def due_accounts(now=None):
+    now = now or timezone.now()
+    return polled_accounts().filter(next_sync_at__lte=now).exclude(
+        idle_heartbeat_at__gte=now - IDLE_HEARTBEAT_STALE,
+    ).order_by('next_sync_at')
+
+
+def backoff_delay(failures):
+    return min(BACKOFF_BASE * 2 ** max(failures - 1, 0), BACKOFF_MAX)
+
+
+def next_interval(interval, synced, elapsed):
+    """Seconds until the next poll, aiming at about one new message per poll.
+
+    ``elapsed`` is the time the ``synced`` messages arrived in. Mail halves
+    the distance to that target; an empty poll backs off by half again.
+    """
+    low, high = _interval_bounds()
+    if synced:
+        interval = (interval + elapsed / synced) / 2
+    else:
+        interval *= 1.5
+    return int(min(max(interval, low), high))
+
+
+def schedule_delay(account, interval, now):
+    if account.inbox_viewed_at and account.inbox_viewed_at >= now - ACTIVE_WINDOW:
+        return min(interval, _active_interval())
+    return interval
+
+
+def inbox_viewed(user, now=None):
+    """Poll ``user``'s accounts on the active interval for a while; called from the inbox view."""
+    now = now or timezone.now()
+    soon = now + timedelta(seconds=_active_interval())
+    # Throttled, and accounts in failure backoff keep their retry time
+    return EmailAccount.objects.filter(user=user).filter(
+        Q(inbox_viewed_at__isnull=True) | Q(inbox_viewed_at__lt=now - VIEW_WRITE_EVERY),
+    ).exclude(sync_retry_at__gt=now).update(inbox_viewed_at=now, next_sync_at=Least(F('next_sync_at'), Value(soon)))
+
+
+def claim_due_accounts(limit=None, lease=None, now=None):
+    """Take up to ``limit`` due accounts, oldest first, and push them out by ``lease`` seconds while they sync."""
+    now = now or timezone.now()
+    limit = limit or getattr(settings, 'EMAIL_SYNC_DISPATCH_LIMIT', 1000)
+    lease = lease or getattr(settings, 'EMAIL_SYNC_TIMEOUT', 120) * 3
+    with transaction.atomic():
+        accounts = list(due_accounts(now).select_for_update(skip_locked=True).values_list('id', 'imap_host')[:limit])
+        EmailAccount.objects.filter(id__in=[account_id for account_id, _ in accounts]).update(
+            next_sync_at=now + timedelta(seconds=lease),
+        )
+    return accounts
+
+
+def queue_metrics(now=None):
+    """Scheduler health: accounts due now, how overdue the oldest is, and accounts in backoff or on IDLE."""
+    now = now or timezone.now()
+    due = due_accounts(now).order_by().aggregate(depth=Count('id'), oldest=Min('next_sync_at'))
+    polled = polled_accounts().aggregate(
+        scheduled=Count('id'),
+        backing_off=Count('id', filter=Q(sync_retry_at__gt=now)),
+        idle=Count('id', filter=Q(idle_heartbeat_at__gte=now - IDLE_HEARTBEAT_STALE)),
+    )
+    return {
+        'queue_depth': due['depth'],
+        'lag_seconds': int((now - due['oldest']).total_seconds()) if due['oldest'] else 0,
+        **polled,
+    }
+
+
+def sync_account_logged(account_id, timeout=None):
+    """Sync one account and record the run; returns (emails synced, error message or None)."""
+    account = EmailAccount.objects.filter(pk=account_id).first()
+    if account is None:
+        return 0, None
+    log = EmailSyncLog.objects.create(email_account=account)
+    started = time.monotonic()
+    previous_sync = account.last_sync
+    try:
+        count = sync_account(account, timeout=timeout)
+    except Exception as exc:  # noqa: BLE001
+        failures = account.sync_failures + 1
+        retry_at = timezone.now() + timedelta(seconds=backoff_delay(failures))
+        EmailAccount.objects.filter(pk=account_id).update(
+            sync_failures=F('sync_failures') + 1, sync_retry_at=retry_at, next_sync_at=retry_at,
+        )
+        _finish_log(log, started, EmailSyncLog.STATUS_FAILED, error=f'{type(exc).__name__}: {exc}', error_count=failures)
+        return 0, log.error_message
+    now = timezone.now()
+    elapsed = (now - previous_sync).total_seconds() if previous_sync else account.sync_interval
+    interval = next_interval(account.sync_interval, count, elapsed)
+    EmailAccount.objects.filter(pk=account_id).update(
+        sync_failures=0, sync_retry_at=None, sync_interval=interval,
+        next_sync_at=now + timedelta(seconds=schedule_delay(account, interval, now)),
+    )
+    _finish_log(log, started, EmailSyncLog.STATUS_COMPLETED, emails_synced=count)
+    return count, None
+
+
+def _pooled_job(account_id, timeout):
+    try:
+        return sync_account_logged(account_id, timeout)
+    except Exception as exc:  # noqa: BLE001
+        return 0, f'{type(exc).__name__}: {exc}'
+    finally:
+        # Executor threads hold their own DB connections: drop them if stale
+        close_old_connections()
+
+
+def _finish_log(log, started, status, emails_synced=0, error=None, error_count=0):
+    log.status = status
+    log.emails_synced = emails_synced
+    log.error_message = error
+    log.error_count = error_count
+    log.sync_completed_at = timezone.now()
+    log.latency_ms = int((time.monotonic() - started) * 1000)
+    log.save(update_fields=['status', 'emails_synced', 'error_message', 'error_count', 'sync_completed_at', 'latency_ms'])
+
+
+def run_sync_pool(accounts=None, concurrency=None, per_host=None, timeout=None):
+    """Sync ``accounts`` (default: the due accounts, claimed) concurrently; returns a summary dict."""
+    concurrency = concurrency or getattr(settings, 'EMAIL_SYNC_CONCURRENCY', 16)
+    per_host = per_host or getattr(settings, 'EMAIL_SYNC_PER_HOST', 4)
+    timeout = timeout or getattr(settings, 'EMAIL_SYNC_TIMEOUT', 120)
+    accounts = claim_due_accounts(lease=timeout * 3) if accounts is None else list(accounts.values_list('id', 'imap_host'))
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='imap-sync')
+    try:
+        return asyncio.run(_run(accounts, executor, concurrency, per_host, timeout))
+    finally:
+        executor.shutdown(wait=False)
+
+
+async def _run(accounts, executor, concurrency, per_host, timeout):
+    limit = asyncio.Semaphore(concurrency)
+    hosts = defaultdict(lambda: asyncio.Semaphore(per_host))
+    summary = {'accounts': len(accounts), 'emails_synced': 0, 'failed': 0, 'timed_out': 0}
+
+    async def sync_one(account_id, host):
+        async with hosts[host.lower()], limit:
+            loop = asyncio.get_running_loop()
+            job = loop.run_in_executor(executor, _pooled_job, account_id, timeout)
+            # Sockets time out after ``timeout`` per operation, so a session
+            # ends eventually. One that overruns is counted, but keeps its host
+            # and global slots until its thread returns: a thread cannot be
+            # cancelled, and freeing the slot would open another session to
+            # the same host alongside it.
+            done, _ = await asyncio.wait({job}, timeout=timeout * 3)
+            if not done:
+                summary['timed_out'] += 1
+            count, error = await job
+            summary['emails_synced'] += count
+            if error:
+                summary['failed'] += 1
+
+    await asyncio.gather(*(sync_one(account_id, host) for account_id, host in accounts))
+    return summary
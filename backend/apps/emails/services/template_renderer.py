@@ -1,21 +1,72 @@
+"""EmailTemplate rendering.
+
+A template's subject and bodies are split once into literal text and
+``{variable}`` slots (``compile_template``); rendering a context is then a
+list fill and a join, with no regex work per recipient. Compiled templates
+are kept per process, keyed by template id and ``updated_at``, so an edited
+template is recompiled on its next use.
+"""
+
 import re
+import threading
+from collections import OrderedDict
+
 from apps.emails.models import EmailTemplate
 
 VARIABLE_PATTERN = re.compile(r'\{([a-zA-Z0-9_]+)\}')
+CACHE_SIZE = 512
+
+_compiled = OrderedDict()  # template id -> (updated_at, CompiledTemplate)
+_lock = threading.Lock()
+
+
+class CompiledText:
+    __slots__ = ('segments', 'variables')
+
+    def __init__(self, text):
+        # Even positions are literal text, odd positions variable names
+        self.segments = VARIABLE_PATTERN.split(text or '')
+        self.variables = self.segments[1::2]
+
+    def render(self, context):
+        if not self.variables:
+            return self.segments[0]
+        parts = list(self.segments)
+        parts[1::2] = ['' if context.get(name) is None else str(context[name]) for name in self.variables]
+        return ''.join(parts)
+
+
+class CompiledTemplate:
+    def __init__(self, template):
+        self.subject = CompiledText(template.subject)
+        self.body_html = CompiledText(template.body_html)
+        self.body_text = CompiledText(template.body_text)
+
+    def render(self, context):
+        return {
+            'subject': self.subject.render(context),
+            'body_html': self.body_html.render(context),
+            'body_text': self.body_text.render(context),
+        }
+
+    def render_many(self, contexts):
+        return [self.render(context) for context in contexts]
+
+
+def compile_template(template: EmailTemplate):
+    key = template.updated_at
+    cached = _compiled.get(template.pk)
+    if cached is not None and key is not None and cached[0] == key:
+        return cached[1]
+    compiled = CompiledTemplate(template)
+    if template.pk is not None:
+        with _lock:
+            _compiled[template.pk] = (key, compiled)
+            _compiled.move_to_end(template.pk)
+            while len(_compiled) > CACHE_SIZE:
+                _compiled.popitem(last=False)
+    return compiled
 
 
 def render_template(template: EmailTemplate, context: dict):
-    def _replace(text: str):
-        def repl(match):
-            key = match.group(1)
-            return str(context.get(key, ''))
-        return VARIABLE_PATTERN.sub(repl, text)
-
-    subject = _replace(template.subject)
-    body_html = _replace(template.body_html)
-    body_text = _replace(template.body_text or '')
-    return {
-        'subject': subject,
-        'body_html': body_html,
-        'body_text': body_text,
-    }
+    return compile_template(template).render(context)
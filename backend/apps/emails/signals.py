@@ -0,0 +1,16 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import EmailRule
+from .services.rule_engine import invalidate_rules
+
+
+@receiver(post_save, sender=EmailRule)
+@receiver(post_delete, sender=EmailRule)
+def invalidate_compiled_rules(sender, instance, **kwargs):
+    # Again on commit, so a worker compiling during the open transaction
+    # cannot keep the pre-commit rules under the new version.
+    company_id = instance.company_id
+    invalidate_rules(company_id)
+    transaction.on_commit(lambda: invalidate_rules(company_id))
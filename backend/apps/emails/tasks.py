@@ -1,9 +1,19 @@
 from celery import shared_task
+from django.conf import settings
 from celery.utils.log import get_task_logger
-from apps.emails.models import Email, EmailAccount, EmailRule
-from apps.emails.services.email_sender import send_email
-from apps.emails.services.email_receiver import sync_emails
+from django.utils import timezone
+from apps.emails.models import Email, EmailAccount, EmailCampaign, EmailTemplate
+from apps.emails.services.campaigns import chunk_ranges, prepare_recipients, send_chunk, send_queued
+from apps.emails.services.email_sender import deliver_email, send_email
+from apps.emails.services.sync_pool import queue_metrics, run_sync_pool, sync_account_logged
 from apps.emails.services.email_categorizer import categorize_email
+from apps.emails.services.email_tracker import flush_tracking_events
+from apps.emails.services.engagement import ensure_event_partitions
+from apps.emails.services.rule_engine import get_compiled_rules, trigger_for
+from apps.emails.services.ai_classifier import classify_pending
+from apps.emails.services.attachment_store import prefetch_pending
+from apps.emails.services.mail_merge import record_usage, render_merge
+from apps.emails.services.mailbox_counters import reconcile
 
 
 logger = get_task_logger(__name__)
@@ -11,9 +21,12 @@ logger = get_task_logger(__name__)
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 10})
 def send_email_task(self, email_id: int):
-    email = Email.objects.get(id=email_id)
+    email = Email.objects.select_related('email_account').get(id=email_id)
+    if email.status == Email.STATUS_SENT:
+        return
     try:
-        send_email(email.to_emails, email.subject, email.body_html, email.body_text, from_account=email.email_account, reply_to_email=email.reply_to)
+        # SMTP sends reuse the worker's pooled connections (services.smtp_pool)
+        deliver_email(email)
     except Exception as exc:  # noqa: BLE001
         logger.warning("Send failed for email %s: %s", email_id, exc)
         raise
@@ -21,33 +34,121 @@ def send_email_task(self, email_id: int):
 
 @shared_task
 def sync_email_account_task(email_account_id: int):
-    account = EmailAccount.objects.get(id=email_account_id)
-    return sync_emails(account)
+    count, _ = sync_account_logged(email_account_id, timeout=getattr(settings, 'EMAIL_SYNC_TIMEOUT', 120))
+    return count
 
 
 @shared_task
 def sync_all_accounts_task():
-    for account in EmailAccount.objects.filter(is_active=True, sync_enabled=True):
-        sync_email_account_task.delay(account.id)
-    return True
+    # The due accounts are synced concurrently inside this one task (see services.sync_pool)
+    metrics = queue_metrics()
+    logger.info('Email sync queue: %(queue_depth)s due, oldest %(lag_seconds)ss late', metrics)
+    return {**run_sync_pool(), **metrics}
+
+
+@shared_task
+def flush_tracking_events_task():
+    return flush_tracking_events()
+
+
+@shared_task
+def ai_categorize_emails_task():
+    if not getattr(settings, 'AI_EMAIL_SORTING_ENABLED', False):
+        return 0
+    return classify_pending()
+
+
+@shared_task
+def prefetch_attachments_task():
+    return prefetch_pending()
+
+
+@shared_task
+def reconcile_mailbox_counters_task():
+    return len(reconcile())
+
+
+@shared_task
+def ensure_event_partitions_task():
+    return ensure_event_partitions()
+
+
+@shared_task
+def start_campaign_task(campaign_id: int):
+    campaign = EmailCampaign.objects.filter(pk=campaign_id, status=EmailCampaign.STATUS_QUEUED).first()
+    if campaign is None:
+        return 0
+    try:
+        total = prepare_recipients(campaign)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Audience resolution failed for campaign %s: %s", campaign_id, exc)
+        EmailCampaign.objects.filter(pk=campaign_id).update(status=EmailCampaign.STATUS_FAILED, error_message=str(exc))
+        return 0
+    now = timezone.now()
+    EmailCampaign.objects.filter(pk=campaign_id).update(
+        status=EmailCampaign.STATUS_SENDING if total else EmailCampaign.STATUS_COMPLETED,
+        total_recipients=total, started_at=now, completed_at=None if total else now,
+    )
+    for start_id, end_id in chunk_ranges(campaign):
+        send_campaign_chunk_task.delay(campaign_id, start_id, end_id)
+    return total
+
+
+@shared_task(bind=True, max_retries=None)
+def send_campaign_chunk_task(self, campaign_id: int, start_id: int, end_id: int):
+    campaign = EmailCampaign.objects.select_related('company', 'created_by', 'template', 'email_account').get(pk=campaign_id)
+    wait = send_chunk(campaign, start_id, end_id)
+    if wait:
+        # Throttled: resume the rest of the chunk when the account's next window opens
+        raise self.retry(countdown=wait)
+
+
+@shared_task
+def send_mail_merge_task(template_id: int, email_account_id: int, recipient_type: str, ids: list):
+    """Render the merge for ``ids`` and store the messages, then send them under the account's rate limit."""
+    template = EmailTemplate.objects.select_related('company').get(pk=template_id)
+    account = EmailAccount.objects.select_related('user').get(pk=email_account_id)
+    # Rendering from the compiled template is cheap; the broker only carries ids
+    messages, _ = render_merge(template, account.user, recipient_type, ids)
+    email_ids = [
+        send_email(
+            to=[message['to']],
+            subject=message['subject'],
+            body_html=message['body_html'],
+            body_text=message['body_text'],
+            from_account=account,
+            deliver=False,
+            template=template,
+        ).id
+        for message in messages
+    ]
+    # One counter update for the whole merge
+    record_usage(template.id, len(email_ids))
+    send_queued_emails_task.delay(account.id, email_ids)
+    return len(email_ids)
+
+
+@shared_task(bind=True, max_retries=None)
+def send_queued_emails_task(self, email_account_id: int, email_ids: list):
+    account = EmailAccount.objects.get(pk=email_account_id)
+    wait = send_queued(account, email_ids)
+    if wait:
+        # Throttled: the rest goes out when the account's next window opens
+        raise self.retry(countdown=wait)
 
 
 @shared_task
 def process_email_rules_task(email_id: int):
-    email = Email.objects.get(id=email_id)
+    email = Email.objects.select_related('thread', 'email_account__company').get(id=email_id)
     categorize_email(email)
-    rules = EmailRule.objects.filter(company=email.email_account.company, is_active=True)
+    # One pass over the text evaluates every rule (services.rule_engine)
+    matched = get_compiled_rules(email.email_account.company_id).evaluate(email, trigger_for(email))
     applied = 0
-    for rule in rules:
-        # Simple keyword condition matching in subject/body
-        keywords = rule.conditions.get('keywords', []) if isinstance(rule.conditions, dict) else []
-        if keywords and not any(k.lower() in (email.subject.lower() + email.body_text.lower()) for k in keywords):
-            continue
-        action = rule.actions.get('action') if isinstance(rule.actions, dict) else None
-        if action == 'send_template' and rule.template_id:
+    for rule in matched:
+        if rule.action == 'send_template' and rule.template_id:
             try:
                 from apps.emails.services.email_sender import send_email
-                template = rule.template
+                template = EmailTemplate.objects.get(pk=rule.template_id)
                 context = {'company_name': email.email_account.company.company_name}
                 from apps.emails.services.template_renderer import render_template
                 rendered = render_template(template, context)
@@ -57,6 +158,7 @@ def process_email_rules_task(email_id: int):
                     body_html=rendered['body_html'],
                     body_text=rendered['body_text'],
                     from_account=email.email_account,
+                    template=template,
                 )
                 applied += 1
             except Exception:  # noqa: BLE001
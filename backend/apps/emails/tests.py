@@ -1,8 +1,47 @@
-from django.test import TestCase
+import base64
+import smtplib
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from email import message_from_bytes
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
 from apps.authentication.models import Company, CompanyUser
-from apps.emails.models import EmailAccount
+from apps.crm.models import Lead
+from apps.emails.models import (
+    EmailAccount, Email, EmailThread, EmailFolderState, EmailSyncLog, EmailTemplate, EmailCampaign, EmailEngagementEvent,
+    EmailRule, EmailAttachment, CampaignRecipient,
+)
+from apps.emails.services.email_receiver import sync_emails
+from apps.emails.services.email_search import refresh_email_search
+from apps.emails.services.sync_pool import claim_due_accounts, due_accounts, queue_metrics, run_sync_pool, sync_account_logged
+from apps.emails.services.idle_listener import IdleWatcher
+from apps.emails.services.smtp_pool import SMTPConnectionPool
+from apps.emails.services.email_sender import send_email
+from apps.emails.services.rate_limit import SendRateLimiter
+from apps.emails.services.rule_engine import KeywordMatcher, get_compiled_rules
+from apps.emails.services.ai_classifier import MAX_ATTEMPTS, OpenAIBackend, StubBackend, classify_pending
+from apps.emails.services.attachment_store import prefetch_pending
+from apps.emails.services.email_parser import parse_email_message, sanitize_html
+from apps.emails.services.campaigns import prepare_recipients, send_chunk, send_queued
+from apps.emails.services.mail_merge import render_merge
+from apps.emails.services.mailbox_counters import reconcile
+from apps.emails.services.template_renderer import render_template
+from apps.emails.management.commands.benchmark_email_parser import FIXTURES_DIR
+from apps.emails.services.engagement import ensure_event_partitions, store_events
+from apps.emails.services.email_tracker import generate_click_token, generate_open_token, flush_tracking_events
+from apps.emails.tasks import send_email_task, send_mail_merge_task
 
 
 User = get_user_model()
@@ -110,7 +149,962 @@ class EmailSearchCategoriesTests(TestCase):
         res = self.client.get('/api/emails/search/?q=Beta')
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(res.json()), 1)
+
+    def test_search_operators_and_snippets(self):
+        Email.objects.filter(subject='Gamma Report').update(body_text='Quarterly numbers <attached> for review', has_attachments=True)
+        # update() skips the write paths that keep search_vector current
+        refresh_email_search(list(Email.objects.filter(subject='Gamma Report').values_list('id', flat=True)))
+        res = self.client.get('/api/emails/search/', {'q': 'numbers has:attachment'}).json()
+        self.assertEqual([r['subject'] for r in res], ['Gamma Report'])
+        self.assertIn('<mark>numbers</mark> &lt;attached&gt;', res[0]['snippet'])
+        self.assertEqual(len(self.client.get('/api/emails/search/', {'q': 'from:searcher@'}).json()), 3)
+        self.assertEqual(self.client.get('/api/emails/search/', {'q': 'from:nobody Beta'}).json(), [])
+        self.assertEqual(self.client.get('/api/emails/search/', {'q': 'category:primary has:attachment'}).json()[0]['subject'], 'Gamma Report')
+
     def test_categories(self):
         res = self.client.get('/api/emails/categories/')
         self.assertEqual(res.status_code, 200)
         self.assertIn('categories', res.json())
+
+
+class FakeIMAPClient:
+    """In-memory IMAP server for one folder: {uid: raw message}."""
+
+    def __init__(self, messages, uidvalidity=1):
+        self.messages = dict(messages)
+        self.uidvalidity = uidvalidity
+        self.fetched = []
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def login(self, *args):
+        pass
+
+    def logout(self):
+        pass
+
+    def select_folder(self, folder, readonly=False):
+        return {b'UIDVALIDITY': self.uidvalidity, b'UIDNEXT': max(self.messages, default=0) + 1}
+
+    def search(self, criteria):
+        low = int(criteria[1].split(':')[0])
+        uids = [uid for uid in self.messages if uid >= low]
+        return uids or [max(self.messages)]
+
+    def fetch(self, uids, data):
+        self.fetched.append((data[0], list(uids)))
+        if data[0].startswith('BODY.PEEK[HEADER.FIELDS'):
+            return {uid: {b'BODY[HEADER.FIELDS (MESSAGE-ID)]': self.messages[uid].split(b'\r\n')[0] + b'\r\n\r\n'} for uid in uids}
+        if data[0] == 'BODY.PEEK[]':
+            return {uid: {b'BODY[]': self.messages[uid]} for uid in uids if uid in self.messages}
+        response = {}
+        for uid in uids:
+            if uid not in self.messages:
+                continue
+            msg = message_from_bytes(self.messages[uid])
+            items = {}
+            for item in data:
+                if item == 'BODYSTRUCTURE':
+                    items[b'BODYSTRUCTURE'] = bodystructure(msg)
+                elif item == 'BODY.PEEK[HEADER]':
+                    items[b'BODY[HEADER]'] = self.messages[uid].split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+                else:
+                    section, _, partial = item[len('BODY.PEEK['):].partition(']')
+                    part = msg
+                    for number in section.split('.'):
+                        part = part.get_payload(int(number) - 1) if part.is_multipart() else part
+                    payload = part.get_payload().encode()
+                    if partial:
+                        offset, length = map(int, partial.strip('<>').split('.'))
+                        items[f'BODY[{section}]<{offset}>'.encode()] = payload[offset:offset + length]
+                    else:
+                        items[f'BODY[{section}]'.encode()] = payload
+            response[uid] = items
+        return response
+
+
+def bodystructure(part):
+    """The BODYSTRUCTURE imapclient would return for an email.message part."""
+    if part.is_multipart():
+        return ([bodystructure(child) for child in part.get_payload()], part.get_content_subtype().upper().encode())
+    params = tuple(value.encode() for key, val in (part.get_params() or [])[1:] for value in (key.upper(), val))
+    payload = part.get_payload().encode()
+    disposition = None
+    if part.get_content_disposition():
+        disposition = (part.get_content_disposition().upper().encode(), (b'FILENAME', part.get_filename().encode()))
+    basic = [part.get_content_maintype().upper().encode(), part.get_content_subtype().upper().encode(), params or None,
+             None, None, (part['Content-Transfer-Encoding'] or '7bit').upper().encode(), len(payload)]
+    if part.get_content_maintype() == 'text':
+        return tuple(basic + [payload.count(b'\n'), None, disposition, None])
+    return tuple(basic + [None, disposition, None])
+
+
+def raw_message(n):
+    return f"Message-ID: <m{n}@example.com>\r\nFrom: s{n}@example.com\r\nTo: me@example.com\r\nSubject: Hello {n}\r\n\r\nBody {n}\r\n".encode()
+
+
+class ImapTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='imap', email='imap@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='ImapCo', created_by=self.user)
+        self.account = EmailAccount.objects.create(user=self.user, company=self.company, email='imap@example.com', provider='imap',
+                                                   imap_host='imap.test', imap_port=993, username='imap@example.com', password='x')
+
+    def sync(self, server, limit=20):
+        with mock.patch('apps.emails.services.email_receiver.imapclient.IMAPClient', server):
+            return sync_emails(self.account, limit=limit)
+
+
+class ImapSyncTests(ImapTestCase):
+
+    def test_incremental_sync_fetches_only_new_uids(self):
+        server = FakeIMAPClient({uid: raw_message(uid) for uid in range(1, 6)})
+        self.assertEqual(self.sync(server, limit=3), 3)
+        self.assertEqual(EmailFolderState.objects.get(email_account=self.account).last_uid, 5)
+
+        server.fetched.clear()
+        self.assertEqual(self.sync(server), 0)
+        self.assertEqual(server.fetched, [])
+
+        server.messages[6] = raw_message(6)
+        server.messages[7] = raw_message(3)  # copy of an already stored message
+        self.assertEqual(self.sync(server), 1)
+        self.assertEqual(server.fetched, [('BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]', [6, 7]), ('BODYSTRUCTURE', [6]), ('BODY.PEEK[1]', [6])])
+        self.assertEqual(Email.objects.count(), 4)
+
+    def test_uidvalidity_change_resets_checkpoint_without_duplicates(self):
+        self.sync(FakeIMAPClient({1: raw_message(1), 2: raw_message(2)}))
+        renumbered = FakeIMAPClient({10: raw_message(1), 11: raw_message(2), 12: raw_message(3)}, uidvalidity=2)
+        self.assertEqual(self.sync(renumbered), 1)
+        state = EmailFolderState.objects.get(email_account=self.account)
+        self.assertEqual((state.uidvalidity, state.last_uid), (2, 12))
+        self.assertEqual(Email.objects.count(), 3)
+
+    def test_same_message_is_stored_for_each_account(self):
+        other = EmailAccount.objects.create(user=self.user, company=self.company, email='sales@example.com', provider='imap',
+                                            imap_host='imap.test', imap_port=993, username='sales@example.com', password='x')
+        server = FakeIMAPClient({1: raw_message(1)})
+        self.assertEqual(self.sync(server), 1)
+        with mock.patch('apps.emails.services.email_receiver.imapclient.IMAPClient', server):
+            self.assertEqual(sync_emails(other), 1)
+        self.assertEqual(sorted(Email.objects.values_list('email_account_id', flat=True)), [self.account.id, other.id])
+
+    def test_failed_message_is_retried_on_next_sync(self):
+        from apps.emails.services import email_receiver
+        store = email_receiver._store_structured
+
+        def flaky(account, message_id, *args):
+            if message_id == '<m2@example.com>':
+                raise OSError('database went away')
+            return store(account, message_id, *args)
+
+        server = FakeIMAPClient({uid: raw_message(uid) for uid in range(1, 4)})
+        with mock.patch.object(email_receiver, '_store_structured', side_effect=flaky):
+            self.assertEqual(self.sync(server), 2)
+        state = EmailFolderState.objects.get(email_account=self.account)
+        self.assertEqual((state.last_uid, state.failed_uids), (3, {'2': 1}))
+
+        self.assertEqual(self.sync(server), 1)
+        state.refresh_from_db()
+        self.assertEqual(state.failed_uids, {})
+        self.assertEqual(Email.objects.count(), 3)
+
+    def test_message_fetched_without_body_is_retried(self):
+        server = FakeIMAPClient({uid: raw_message(uid) for uid in range(1, 4)})
+        fetch, body_missing = server.fetch, [True]
+
+        def fetch_without_body(uids, data):
+            response = fetch(uids, data)
+            if data == ['BODYSTRUCTURE', 'BODY.PEEK[HEADER]']:
+                response.pop(2, None)  # no usable structure: UID 2 is fetched whole
+            elif data == ['BODY.PEEK[]'] and body_missing[0]:
+                response.pop(2, None)
+            return response
+
+        server.fetch = fetch_without_body
+        self.assertEqual(self.sync(server), 2)
+        state = EmailFolderState.objects.get(email_account=self.account)
+        self.assertEqual((state.last_uid, state.failed_uids), (3, {'2': 1}))
+        body_missing[0] = False
+        self.assertEqual(self.sync(server), 1)
+        self.assertEqual(Email.objects.count(), 3)
+
+
+
+def message_with_attachment(n, data=b'%PDF-1.4 quarterly numbers'):
+    msg = MIMEMultipart()
+    msg['From'] = 'billing@example.com'
+    msg['To'] = 'imap@example.com'
+    msg['Subject'] = f'Invoice {n}'
+    msg.attach(MIMEText('Invoice attached', 'plain'))
+    pdf = MIMEApplication(data, 'pdf')
+    pdf.add_header('Content-Disposition', 'attachment', filename='invoice.pdf')
+    msg.attach(pdf)
+    # Message-ID first: FakeIMAPClient answers header fetches with the first line
+    return f'Message-ID: <a{n}@example.com>\r\n'.encode() + msg.as_bytes().replace(b'\n', b'\r\n')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class AttachmentTests(ImapTestCase):
+
+    def test_attachments_are_fetched_lazily_and_stored_once(self):
+        server = FakeIMAPClient({1: message_with_attachment(1), 2: message_with_attachment(2)})
+        self.assertEqual(self.sync(server), 2)
+        # Only structure and the text part were fetched during sync
+        self.assertEqual([item for item, _ in server.fetched], ['BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]', 'BODYSTRUCTURE', 'BODY.PEEK[1]'])
+        email = Email.objects.get(message_id='<a1@example.com>')
+        self.assertEqual(email.body_text, 'Invoice attached')
+        self.assertTrue(email.has_attachments)
+        attachment = email.attachments.get()
+        self.assertEqual((attachment.file_name, attachment.file_type, attachment.imap_section), ('invoice.pdf', 'application/pdf', '2'))
+        self.assertFalse(attachment.is_downloaded)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch('apps.emails.services.email_receiver.imapclient.IMAPClient', server), \
+                mock.patch('apps.emails.services.attachment_store.FETCH_RANGE_SIZE', 10):
+            res = client.get(f'/api/emails/attachments/{attachment.id}/')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(b''.join(res.streaming_content), b'%PDF-1.4 quarterly numbers')
+            # The section arrives in partial fetches, never whole
+            ranges = [item for item, _ in server.fetched if item.startswith('BODY.PEEK[2]')]
+            self.assertEqual(ranges[:2], ['BODY.PEEK[2]<0.10>', 'BODY.PEEK[2]<10.10>'])
+            self.assertNotIn('BODY.PEEK[2]', ranges)
+            self.assertEqual(prefetch_pending(), 1)
+        first, second = EmailAttachment.objects.order_by('id')
+        self.assertEqual(first.sha256, second.sha256)
+        self.assertEqual(first.file_path.name, second.file_path.name)
+        self.assertEqual(first.file_size, len(b'%PDF-1.4 quarterly numbers'))
+
+    def test_missing_message_is_gone_and_not_retried(self):
+        server = FakeIMAPClient({1: message_with_attachment(1)})
+        self.sync(server)
+        attachment = EmailAttachment.objects.get()
+        del server.messages[1]
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch('apps.emails.services.email_receiver.imapclient.IMAPClient', server):
+            self.assertEqual(client.get(f'/api/emails/attachments/{attachment.id}/').status_code, 410)
+            self.assertEqual(prefetch_pending(), 0)
+        self.assertIsNone(EmailAttachment.objects.get().imap_uid)
+
+
+class EmailParserTests(TestCase):
+    def fixture(self, name):
+        return parse_email_message((FIXTURES_DIR / name).read_bytes())
+
+    def test_html_is_sanitized_in_one_pass(self):
+        html, text = sanitize_html(
+            '<div onclick="x()"><p>Hi &amp; welcome</p><script>alert(1)</script><a href="javascript:go()">x</a><br>Bye</div>',
+            extract_text=True,
+        )
+        self.assertEqual(html, '<div><p>Hi &amp; welcome</p><a>x</a><br>Bye</div>')
+        self.assertEqual(text, 'Hi & welcome\nx\nBye')
+        # Only allowed schemes survive, however the scheme is disguised
+        html, _ = sanitize_html(
+            '<a href="java&#9;script:alert(1)">a</a><a href="data:text/html,x">b</a><img src="cid:logo">'
+            '<a href="https://example.com/x:y">c</a><a href="/inbox">d</a><img srcset="a.png 1x, javascript:x 2x">'
+        )
+        self.assertEqual(html, '<a>a</a><a>b</a><img src="cid:logo"><a href="https://example.com/x:y">c</a><a href="/inbox">d</a><img>')
+
+        parsed = self.fixture('html_only_base64.eml')
+        self.assertNotIn('<script', parsed['body_html'])
+        self.assertTrue(parsed['body_text'].startswith('Webinar: Scaling your kennel business\nJoin us on June 19'))
+        self.assertEqual(self.fixture('latin1_quoted_printable.eml')['headers']['From'], 'Hélène Dubois <helene.dubois@courriel.example>')
+        self.assertIn('26 août', self.fixture('latin1_quoted_printable.eml')['body_text'])
+        self.assertEqual([a['content_type'] for a in self.fixture('forward_rfc822.eml')['attachments']], ['message/rfc822'])
+
+    @override_settings(EMAIL_PARSE_MAX_BODY_BYTES=1000)
+    def test_text_parts_are_capped(self):
+        parsed = self.fixture('newsletter_alternative.eml')
+        self.assertLessEqual(len(parsed['body_text'].encode()), 1000)
+        self.assertLessEqual(len(parsed['body_html'].encode()), 1100)
+        self.assertEqual(len(self.fixture('invoice_pdf_attachment.eml')['attachments'][0]['data']), 49168)
+
+class ThreadingTests(ImapTestCase):
+    def message(self, n, subject, headers=''):
+        return (f"Message-ID: <t{n}@example.com>\r\nFrom: s@example.com\r\nTo: imap@example.com\r\n{headers}"
+                f"Subject: {subject}\r\nDate: Mon, 0{n} Jun 2026 10:00:00 +0000\r\n\r\nBody\r\n").encode()
+
+    def test_messages_join_their_conversation(self):
+        server = FakeIMAPClient({
+            1: self.message(1, 'Quote'),
+            2: self.message(2, 'Re: Quote', 'In-Reply-To: <t1@example.com>\r\n'),
+            3: self.message(3, 'RE: Quote', 'In-Reply-To: <missing@example.com>\r\nReferences: <t1@example.com> <missing@example.com>\r\n'),
+            4: self.message(4, 'Fwd: re: quote'),
+            5: self.message(5, 'Quote'),
+        })
+        self.assertEqual(self.sync(server), 5)
+        threads = list(EmailThread.objects.order_by('id'))
+        self.assertEqual([t.message_count for t in threads], [4, 1])
+        self.assertEqual(threads[0].emails.count(), 4)
+        self.assertEqual(threads[0].last_message_at.day, 4)
+
+        # A reply sent from the app carries the thread headers and joins it too
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        EmailAccount.objects.filter(pk=self.account.pk).update(smtp_host='smtp.test', smtp_port=587)
+        original = Email.objects.get(message_id='<t3@example.com>')
+        res = self.client.post(f'/api/emails/emails/{original.id}/reply/', {'to_emails': ['s@example.com'], 'body_html': '<p>Ok</p>'}, format='json')
+        self.assertEqual(res.status_code, 201)
+        reply = Email.objects.get(pk=res.json()['id'])
+        self.assertEqual(reply.thread_id, threads[0].id)
+        self.assertEqual(reply.references, '<t1@example.com> <missing@example.com> <t3@example.com>')
+        threads[0].refresh_from_db()
+        self.assertEqual(threads[0].message_count, threads[0].emails.count())
+
+
+
+class MailboxCounterTests(ImapTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def counts(self):
+        self.account.refresh_from_db()
+        categories = self.client.get('/api/emails/categories/').json()['categories']
+        return self.account.email_count, self.account.unread_count, categories
+
+    def test_counters_follow_sync_read_delete_and_reconcile(self):
+        self.assertEqual(self.sync(FakeIMAPClient({uid: raw_message(uid) for uid in range(1, 4)})), 3)
+        self.assertEqual(self.counts(), (3, 3, [{'category': 'primary', 'count': 3, 'unread': 3}]))
+        self.assertEqual(self.client.get('/api/emails/accounts/').json()[0]['unread_count'], 3)
+
+        first, second = Email.objects.order_by('id')[:2]
+        self.client.post(f'/api/emails/threads/{first.thread_id}/mark-read/')
+        self.client.post(f'/api/emails/threads/{first.thread_id}/mark-read/')
+        self.assertEqual(self.client.delete(f'/api/emails/emails/{second.id}/').status_code, 204)
+        self.assertEqual(self.counts(), (3, 1, [{'category': 'primary', 'count': 3, 'unread': 1}]))
+
+        # The sidebar reads the counter rows instead of counting threads
+        with self.assertNumQueries(1):
+            self.client.get('/api/emails/categories/')
+
+        EmailThread.objects.filter(pk=first.thread_id).update(category=EmailThread.CATEGORY_LEAD, is_read=False)
+        EmailAccount.objects.filter(pk=self.account.pk).update(unread_count=7)
+        self.assertEqual(reconcile(), [self.account.id])
+        self.assertEqual(reconcile(), [])
+        email_count, unread, categories = self.counts()
+        self.assertEqual((email_count, unread), (3, 1))
+        self.assertEqual(sorted(categories, key=lambda c: c['category']), [
+            {'category': 'lead', 'count': 1, 'unread': 1}, {'category': 'primary', 'count': 2, 'unread': 1},
+        ])
+
+
+class SyncPoolTests(ImapTestCase):
+    def test_failures_are_logged_and_backed_off(self):
+        broken = EmailAccount.objects.create(user=self.user, company=self.company, email='broken@example.com', provider='imap',
+                                             imap_host='down.test', imap_port=993, username='broken@example.com', password='x')
+        server = FakeIMAPClient({1: raw_message(1)})
+
+        def connect(host, **kwargs):
+            if host == 'down.test':
+                raise ConnectionRefusedError('refused')
+            return server
+
+        with mock.patch('apps.emails.services.email_receiver.imapclient.IMAPClient', connect):
+            self.assertEqual(sync_account_logged(self.account.id), (1, None))
+            count, error = sync_account_logged(broken.id)
+        self.assertEqual(count, 0)
+        self.assertIn('refused', error)
+        broken.refresh_from_db()
+        self.assertEqual(broken.sync_failures, 1)
+        self.assertEqual(broken.next_sync_at, broken.sync_retry_at)
+        self.assertEqual(list(due_accounts()), [])
+        self.assertEqual(list(due_accounts(timezone.now() + timedelta(hours=1))), [broken, self.account])
+        log = EmailSyncLog.objects.get(email_account=broken)
+        self.assertEqual((log.status, log.error_count), ('failed', 1))
+        log = EmailSyncLog.objects.get(email_account=self.account)
+        self.assertEqual((log.status, log.emails_synced), ('completed', 1))
+        self.assertIsNotNone(log.latency_ms)
+
+    def test_interval_adapts_to_mail_and_inbox_views(self):
+        server = FakeIMAPClient({uid: raw_message(uid) for uid in range(1, 3)})
+        EmailAccount.objects.filter(pk=self.account.pk).update(last_sync=timezone.now() - timedelta(minutes=10))
+        with mock.patch('apps.emails.services.email_receiver.imapclient.IMAPClient', server):
+            sync_account_logged(self.account.id)
+            self.account.refresh_from_db()
+            self.assertEqual(self.account.sync_interval, 300)  # 2 messages in 10 minutes
+            sync_account_logged(self.account.id)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.sync_interval, 450)  # nothing new: back off
+        self.assertEqual(run_sync_pool(), {'accounts': 0, 'emails_synced': 0, 'failed': 0, 'timed_out': 0})
+
+        # Opening the inbox pulls the next poll in to the active interval
+        client = APIClient()
+        client.force_authenticate(self.user)
+        client.get('/api/emails/inbox/')
+        self.account.refresh_from_db()
+        self.assertLessEqual(self.account.next_sync_at, timezone.now() + timedelta(seconds=60))
+        metrics = queue_metrics(timezone.now() + timedelta(seconds=90))
+        self.assertEqual((metrics['queue_depth'], metrics['scheduled']), (1, 1))
+        self.assertGreaterEqual(metrics['lag_seconds'], 30)
+
+        # A claimed account is leased, so an overlapping run does not take it again
+        later = timezone.now() + timedelta(seconds=90)
+        self.assertEqual(claim_due_accounts(now=later), [(self.account.id, 'imap.test')])
+        self.assertEqual(claim_due_accounts(now=later), [])
+
+    def test_pool_limits_sessions_per_host(self):
+        for n in range(5):
+            EmailAccount.objects.create(user=self.user, company=self.company, email=f'a{n}@example.com', provider='imap',
+                                        imap_host='IMAP.test' if n % 2 else 'imap.test', imap_port=993, username='u', password='x')
+        running, peak, lock = [0], [0], threading.Lock()
+
+        def job(account_id, timeout):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return 2, None
+
+        with mock.patch('apps.emails.services.sync_pool._pooled_job', job):
+            summary = run_sync_pool(per_host=2)
+        self.assertEqual(summary, {'accounts': 6, 'emails_synced': 12, 'failed': 0, 'timed_out': 0})
+        self.assertEqual(peak[0], 2)
+
+        # A session past its deadline keeps its host slot until the thread returns
+        running[0] = peak[0] = 0
+        with mock.patch('apps.emails.services.sync_pool._pooled_job', job):
+            summary = run_sync_pool(EmailAccount.objects.filter(imap_host='imap.test')[:2], per_host=1, timeout=0.01)
+        self.assertEqual(summary, {'accounts': 2, 'emails_synced': 4, 'failed': 0, 'timed_out': 2})
+        self.assertEqual(peak[0], 1)
+
+
+class IdleIMAPClient(FakeIMAPClient):
+    """Delivers ``pending`` messages one IDLE round at a time, then stops the watcher."""
+
+    def __init__(self, messages, pending, watcher=None):
+        super().__init__(messages)
+        self.pending = list(pending)
+        self.watcher = watcher
+
+    def has_capability(self, name):
+        return True
+
+    def idle(self):
+        pass
+
+    def idle_done(self):
+        return None, []
+
+    def idle_check(self, timeout=None):
+        if not self.pending:
+            self.watcher.stop()
+            return []
+        uid = max(self.messages) + 1
+        self.messages[uid] = self.pending.pop(0)
+        return [(uid, b'EXISTS')]
+
+
+class IdleListenerTests(ImapTestCase):
+    def setUp(self):
+        super().setUp()
+        # IdleWatcher.heartbeat() would otherwise close the connection holding the test transaction
+        patcher = mock.patch('apps.emails.services.idle_listener.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_new_mail_is_synced_on_the_idle_session(self):
+        watcher = IdleWatcher(self.account.id)
+        server = IdleIMAPClient({1: raw_message(1)}, [raw_message(2), raw_message(3)], watcher)
+        with mock.patch('apps.emails.services.email_receiver.imapclient.IMAPClient', server):
+            watcher.watch()
+        self.assertEqual(Email.objects.count(), 3)
+        self.assertEqual(EmailFolderState.objects.get(email_account=self.account).last_uid, 3)
+
+    def test_servers_without_idle_stay_on_polling(self):
+        watcher = IdleWatcher(self.account.id)
+        server = IdleIMAPClient({1: raw_message(1)}, [], watcher)
+        server.has_capability = lambda name: False
+        with mock.patch('apps.emails.services.email_receiver.imapclient.IMAPClient', server):
+            watcher.watch()
+        self.assertFalse(watcher.supports_idle)
+        self.assertEqual(list(due_accounts()), [self.account])
+
+
+class RecordingSMTP:
+    connections = []
+
+    def __init__(self, host, port, timeout=None):
+        self.sent = []
+        self.drop_next = False  # before DATA: the message never reached the server
+        self.drop_in_data = False
+        self.closed = False
+        RecordingSMTP.connections.append(self)
+
+    def starttls(self):
+        pass
+
+    def login(self, username, password):
+        self.password = password
+
+    def noop(self):
+        return (250, b'OK')
+
+    def sendmail(self, from_addr, to_addrs, message):
+        if self.drop_next:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.data(message)
+        return {}
+
+    def data(self, message):
+        if self.drop_in_data:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.sent.append(message)
+        return 250, b'OK'
+
+    def quit(self):
+        self.closed = True
+
+    close = quit
+
+
+class SMTPPoolTests(TestCase):
+    def setUp(self):
+        RecordingSMTP.connections = []
+        patcher = mock.patch('apps.emails.services.smtp_pool.smtplib.SMTP', RecordingSMTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, pool, n, username='u'):
+        for i in range(n):
+            pool.sendmail('smtp.test', 587, username, lambda: 'secret', 'a@example.com', ['b@example.com'], f'message {i}')
+
+    def test_connections_are_reused_and_retired(self):
+        pool = SMTPConnectionPool(max_messages=3)
+        self.send(pool, 4)
+        self.send(pool, 1, username='other')
+        first, second, other = RecordingSMTP.connections
+        self.assertEqual((len(first.sent), len(second.sent), len(other.sent)), (3, 1, 1))
+        self.assertTrue(first.closed)
+        self.assertEqual(first.password, 'secret')
+        pool.close_all()
+        self.assertTrue(second.closed and other.closed)
+
+    def test_dropped_connection_is_replaced(self):
+        pool = SMTPConnectionPool(noop_after=0)
+        self.send(pool, 1)
+        RecordingSMTP.connections[0].noop = lambda: (421, b'closing')
+        self.send(pool, 1)
+        RecordingSMTP.connections[1].drop_next = True
+        self.send(pool, 1)
+        self.assertEqual([len(c.sent) for c in RecordingSMTP.connections], [1, 1, 1])
+
+    def test_drop_after_data_started_is_not_resent(self):
+        pool = SMTPConnectionPool()
+        self.send(pool, 1)
+        RecordingSMTP.connections[0].drop_in_data = True
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.send(pool, 1)
+        self.assertEqual(len(RecordingSMTP.connections), 1)
+
+        # A fresh connection failing is not the stale case either
+        class DroppingSMTP(RecordingSMTP):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.drop_next = True
+
+        with mock.patch('apps.emails.services.smtp_pool.smtplib.SMTP', DroppingSMTP):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                self.send(pool, 1)
+        self.assertEqual(len(RecordingSMTP.connections), 2)
+
+    def test_queued_email_is_sent_by_the_task_once(self):
+        user = User.objects.create_user(username='pool', email='pool@example.com', password='pass123', account_type='company')
+        company = Company.objects.create(company_name='PoolCo', created_by=user)
+        account = EmailAccount.objects.create(user=user, company=company, email='pool@example.com', provider='smtp',
+                                              smtp_host='smtp.pool.test', smtp_port=587, username='pool@example.com', password='x')
+        email = send_email(['r@example.com'], 'Hi', '<p>Hi</p>', '', from_account=account, deliver=False)
+        self.assertEqual(email.status, Email.STATUS_QUEUED)
+        send_email_task.apply(args=[email.id])
+        send_email_task.apply(args=[email.id])
+        email.refresh_from_db()
+        self.assertEqual(email.status, Email.STATUS_SENT)
+        self.assertEqual(sum(len(c.sent) for c in RecordingSMTP.connections), 1)
+
+
+class CampaignTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='bulk', email='bulk@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='BulkCo', created_by=self.user)
+        CompanyUser.objects.create(user=self.user, company=self.company, role='ceo')
+        self.account = EmailAccount.objects.create(user=self.user, company=self.company, email='bulk@example.com', provider='smtp',
+                                                   smtp_host='smtp.bulk.test', smtp_port=587, username='bulk@example.com', password='x',
+                                                   send_rate_per_minute=6000)
+        self.template = EmailTemplate.objects.create(company=self.company, created_by=self.user, name='Promo',
+                                                     subject='Hi {lead_name}', body_html='<p>{company_name}</p>')
+        for i, email in enumerate(['one@example.com', 'two@example.com', 'ONE@example.com', 'bad@example.com', '']):
+            Lead.objects.create(company=self.company, created_by=self.user, first_name=f'L{i}', last_name='X', email=email, lead_source='website')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_campaign_sends_in_chunks_and_records_failures(self):
+        def transmit(email):
+            if email.to_emails == ['bad@example.com']:
+                raise smtplib.SMTPRecipientsRefused({'bad@example.com': (550, b'No such user')})
+
+        res = self.client.post('/api/emails/campaigns/', {
+            'name': 'Launch', 'template': self.template.id, 'email_account': self.account.id, 'audience': 'leads',
+        }, format='json')
+        self.assertEqual(res.status_code, 201)
+        campaign_id = res.json()['id']
+        with self.settings(EMAIL_CAMPAIGN_CHUNK_SIZE=2), mock.patch('apps.emails.services.campaigns.transmit_email', side_effect=transmit):
+            res = self.client.post(f'/api/emails/campaigns/{campaign_id}/send/')
+        self.assertEqual(res.status_code, 202)
+
+        progress = self.client.get(f'/api/emails/campaigns/{campaign_id}/').json()
+        self.assertEqual(progress['status'], EmailCampaign.STATUS_COMPLETED)
+        self.assertEqual((progress['total_recipients'], progress['sent_count'], progress['failed_count']), (3, 2, 1))
+        sent = Email.objects.filter(status=Email.STATUS_SENT)
+        self.assertEqual(sorted(e.subject for e in sent), ['Hi L0 X', 'Hi L1 X'])
+        self.assertEqual(EmailThread.objects.filter(company=self.company).count(), 3)
+
+        failed = self.client.get(f'/api/emails/campaigns/{campaign_id}/failed/').json()['results']
+        self.assertEqual([r['email_address'] for r in failed], ['bad@example.com'])
+        self.assertIn('SMTPRecipientsRefused', failed[0]['error'])
+        self.assertEqual(self.client.post(f'/api/emails/campaigns/{campaign_id}/send/').status_code, 409)
+
+    def test_each_recipient_is_claimed_and_recorded_as_it_is_sent(self):
+        res = self.client.post('/api/emails/campaigns/', {
+            'name': 'Crash', 'template': self.template.id, 'email_account': self.account.id, 'audience': 'leads',
+        }, format='json')
+        campaign = EmailCampaign.objects.select_related('company', 'created_by', 'template', 'email_account').get(pk=res.json()['id'])
+        campaign.status = EmailCampaign.STATUS_SENDING
+        campaign.save()
+        prepare_recipients(campaign)
+        first, second, third = campaign.recipients.order_by('id')
+        # Held by another copy of the chunk task
+        CampaignRecipient.objects.filter(pk=third.pk).update(status=CampaignRecipient.STATUS_SENDING)
+
+        class WorkerLost(BaseException):
+            pass
+
+        with mock.patch('apps.emails.services.campaigns.transmit_email', side_effect=[None, WorkerLost()]) as transmit:
+            with self.assertRaises(WorkerLost):
+                send_chunk(campaign, first.id, third.id)
+        statuses = dict(campaign.recipients.values_list('id', 'status'))
+        self.assertEqual(statuses[first.id], CampaignRecipient.STATUS_SENT)
+        self.assertEqual(statuses[second.id], CampaignRecipient.STATUS_SENDING)
+        self.assertEqual(EmailCampaign.objects.get(pk=campaign.pk).sent_count, 1)
+
+        # The redelivered task finds nobody left to send
+        with mock.patch('apps.emails.services.campaigns.transmit_email') as transmit:
+            self.assertEqual(send_chunk(campaign, first.id, third.id), 0)
+        self.assertEqual(transmit.call_count, 0)
+        self.assertEqual(Email.objects.filter(status=Email.STATUS_SENT).count(), 1)
+
+    def test_rate_limiter_shares_a_window_budget(self):
+        self.account.send_rate_per_minute = 2
+        limiter = SendRateLimiter(self.account)
+        self.assertEqual((limiter.window, limiter.burst), (30, 1))
+        with mock.patch('apps.emails.services.rate_limit.time') as clock:
+            clock.time.return_value = 1000.0
+            self.assertEqual(limiter.try_acquire(), 0)
+            self.assertEqual(SendRateLimiter(self.account).try_acquire(), 20.0)
+
+
+
+class MailMergeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='merge', email='merge@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='MergeCo', created_by=self.user)
+        CompanyUser.objects.create(user=self.user, company=self.company, role='ceo')
+        self.account = EmailAccount.objects.create(user=self.user, company=self.company, email='merge@example.com', provider='smtp',
+                                                   smtp_host='smtp.merge.test', smtp_port=587, username='merge@example.com', password='x')
+        self.template = EmailTemplate.objects.create(company=self.company, created_by=self.user, name='Hello', subject='Hi {lead_name}',
+                                                     body_html='<p>{lead_name}, meet {company_name} {unknown}</p>', body_text='{user_name}')
+        self.leads = [
+            Lead.objects.create(company=self.company, created_by=self.user, first_name=name, last_name='Doe', email=email, lead_source='website')
+            for name, email in [('Ann', 'ann@example.com'), ('Bob', 'bob@example.com'), ('Cy', '')]
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_compiled_template_is_refreshed_after_edit(self):
+        self.assertEqual(render_template(self.template, {'lead_name': 'Ann'})['subject'], 'Hi Ann')
+        self.template.subject = 'Hello {lead_name}!'
+        self.template.save()
+        self.assertEqual(render_template(self.template, {'lead_name': None})['subject'], 'Hello !')
+
+    def test_merge_renders_in_batched_queries_and_sends(self):
+        ids = [lead.id for lead in self.leads] + [999999]
+        template = EmailTemplate.objects.select_related('company').get(pk=self.template.pk)
+        with self.assertNumQueries(1):
+            messages, missing = render_merge(template, self.user, 'lead', ids)
+        self.assertEqual([m['to'] for m in messages], ['ann@example.com', 'bob@example.com'])
+        self.assertEqual(messages[1]['body_html'], '<p>Bob Doe, meet MergeCo </p>')
+        self.assertEqual(missing, [self.leads[2].id, 999999])
+
+        res = self.client.post(f'/api/emails/templates/{self.template.id}/merge/', {'recipient_type': 'lead', 'ids': ids}, format='json')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['messages'][0]['subject'], 'Hi Ann Doe')
+
+        with mock.patch('apps.emails.tasks.send_queued_emails_task.delay') as delay, \
+                mock.patch('apps.emails.views.send_mail_merge_task.delay', side_effect=send_mail_merge_task) as merge:
+            res = self.client.post(f'/api/emails/templates/{self.template.id}/merge/',
+                                   {'recipient_type': 'lead', 'ids': ids, 'send': True}, format='json')
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.json()['queued'], 2)
+        # Only ids go through the broker; the worker renders
+        self.assertEqual(merge.call_args.args, (self.template.id, self.account.id, 'lead', [self.leads[0].id, self.leads[1].id]))
+        self.assertEqual(delay.call_count, 1)
+        account_id, email_ids = delay.call_args.args
+        queued = Email.objects.filter(template=self.template, status=Email.STATUS_QUEUED).order_by('id')
+        self.assertEqual([email.subject for email in queued], ['Hi Ann Doe', 'Hi Bob Doe'])
+        self.template.refresh_from_db()
+        self.assertEqual(self.template.usage_count, 2)
+
+        # Sends share the account's rate limit with campaigns: the throttled rest waits for the next window
+        account = EmailAccount.objects.get(pk=account_id)
+        with mock.patch('apps.emails.services.campaigns.SendRateLimiter.try_acquire', side_effect=[0, 30]), \
+                mock.patch('apps.emails.services.campaigns.transmit_email') as transmit:
+            self.assertEqual(send_queued(account, email_ids), 30)
+        self.assertEqual(transmit.call_count, 1)
+        self.assertEqual(Email.objects.get(pk=email_ids[0]).status, Email.STATUS_SENT)
+        self.assertEqual(Email.objects.get(pk=email_ids[1]).status, Email.STATUS_QUEUED)
+
+        # A send is recorded before the next one starts, so a worker lost mid-loop resends nothing
+        Email.objects.filter(pk=email_ids[0]).update(status=Email.STATUS_QUEUED)
+        with mock.patch('apps.emails.services.campaigns.transmit_email', side_effect=[None, SystemExit()]):
+            with self.assertRaises(SystemExit):
+                send_queued(account, email_ids)
+        self.assertEqual(Email.objects.get(pk=email_ids[0]).status, Email.STATUS_SENT)
+
+class FakeRedis:
+    """The list commands the tracking buffer uses."""
+
+    def __init__(self):
+        self.lists = {}
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value.encode())
+
+    def exists(self, key):
+        return int(key in self.lists)
+
+    def rename(self, src, dst):
+        import redis
+        if src not in self.lists:
+            raise redis.ResponseError('no such key')
+        self.lists[dst] = self.lists.pop(src)
+
+    def lrange(self, key, start, end):
+        return self.lists.get(key, [])[start:end + 1]
+
+    def delete(self, key):
+        self.lists.pop(key, None)
+
+
+class TrackingBufferTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.redis = FakeRedis()
+        patcher = mock.patch('apps.emails.services.email_tracker._client', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username='track', email='track@example.com', password='pass123', account_type='company')
+        company = Company.objects.create(company_name='TrackCo', created_by=self.user)
+        self.account = EmailAccount.objects.create(user=self.user, company=company, email='track@example.com', provider='smtp', username='track@example.com', password='x')
+        self.template = EmailTemplate.objects.create(company=company, created_by=self.user, name='Welcome', subject='Hi', body_html='<p>Hi</p>')
+        self.email = send_email(['r@example.com'], 'Hi', '<p>Hi</p>', '', from_account=self.account, deliver=False, template=self.template)
+
+    def test_hits_are_buffered_then_flushed_with_f_updates(self):
+        client = APIClient()
+        open_token = generate_open_token(self.email)
+        click_token = generate_click_token(self.email, 'https://example.com/a?b=1')
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                self.assertEqual(client.get(f'/api/emails/track/open/{open_token}/')['Content-Type'], 'image/gif')
+            res = client.get(f'/api/emails/track/click/{click_token}/')
+        self.assertEqual(res['Location'], 'https://example.com/a?b=1')
+        client.get('/api/emails/track/open/bm90LWEtdG9rZW4=/')
+        # Tokens are signed: neither the old plaintext format nor a re-pointed payload is accepted
+        legacy = base64.urlsafe_b64encode(f'click:{self.email.id}:https://evil.example/:{settings.SECRET_KEY[:8]}'.encode()).decode()
+        payload = generate_click_token(self.email, 'https://evil.example/').rsplit(':', 1)[0]
+        for forged in (legacy, f"{payload}:{click_token.rsplit(':', 1)[1]}"):
+            self.assertEqual(client.get(f'/api/emails/track/click/{forged}/')['Location'], '/')
+
+        self.assertEqual(flush_tracking_events(), 4)
+        self.assertEqual(flush_tracking_events(), 0)
+        self.email.refresh_from_db()
+        self.assertEqual((self.email.opens_count, self.email.clicks_count), (3, 1))
+        first_open = self.email.opened_at
+        self.assertIsNotNone(first_open)
+        self.assertIsNotNone(self.email.clicked_at)
+
+        client.get(f'/api/emails/track/open/{open_token}/')
+        flush_tracking_events()
+        self.email.refresh_from_db()
+        self.assertEqual((self.email.opens_count, self.email.opened_at), (4, first_open))
+
+    def test_events_are_stored_and_reported(self):
+        other = send_email(['s@example.com'], 'Hi', '<p>Hi</p>', '', from_account=self.account, deliver=False, template=self.template)
+        Email.objects.filter(pk__in=[self.email.pk, other.pk]).update(status=Email.STATUS_SENT, sent_at=timezone.now() - timedelta(hours=2))
+        client = APIClient()
+        iphone = 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) Mobile/15E148'
+        client.get(f'/api/emails/track/open/{generate_open_token(self.email)}/', HTTP_USER_AGENT=iphone)
+        client.get(f'/api/emails/track/open/{generate_open_token(self.email)}/', HTTP_USER_AGENT='Googlebot/2.1')
+        for _ in range(2):
+            client.get(f'/api/emails/track/click/{generate_click_token(self.email, "https://example.com/pricing")}/', HTTP_USER_AGENT=iphone)
+        flush_tracking_events()
+        self.assertEqual(
+            sorted(EmailEngagementEvent.objects.values_list('kind', 'ua_class')),
+            [(1, EmailEngagementEvent.UA_MOBILE), (1, EmailEngagementEvent.UA_BOT), (2, EmailEngagementEvent.UA_MOBILE), (2, EmailEngagementEvent.UA_MOBILE)],
+        )
+
+        client.force_authenticate(self.user)
+        report = client.get('/api/emails/analytics/', {'days': 7}).json()
+        self.assertEqual(report['templates'], [{
+            'id': self.template.id, 'name': 'Welcome', 'sent': 2, 'opened': 1, 'clicked': 1, 'open_rate': 0.5, 'click_rate': 0.5,
+        }])
+        self.assertEqual(report['senders'][0]['name'], 'track@example.com')
+        self.assertEqual({row['bucket']: row['emails'] for row in report['time_to_open']}['1-6h'], 1)
+        self.assertEqual(report['top_links'], [{'url': 'https://example.com/pricing', 'clicks': 2, 'emails': 1}])
+        self.assertEqual(client.get('/api/emails/analytics/', {'template': self.template.id}).json()['templates'][0]['sent'], 2)
+        for param in ('campaign', 'template'):
+            self.assertEqual(client.get('/api/emails/analytics/', {param: 'abc'}).status_code, 400)
+
+    @skipUnless(connection.vendor == 'postgresql', 'table partitioning needs PostgreSQL')
+    def test_event_table_is_converted_to_monthly_partitions(self):
+        table = EmailEngagementEvent._meta.db_table
+        earlier = timezone.now() - timedelta(days=75)
+        store_events([
+            (EmailEngagementEvent.KIND_OPEN, self.email.id, earlier, EmailEngagementEvent.UA_DESKTOP, None),
+            (EmailEngagementEvent.KIND_CLICK, self.email.id, timezone.now(), EmailEngagementEvent.UA_DESKTOP, 'https://example.com/'),
+        ])
+        names = ensure_event_partitions()
+        self.assertEqual(names[0], f'{table}_{timezone.now():%Y%m}')
+        self.assertEqual(len(names), 3)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', [table])
+            self.assertEqual(cursor.fetchone()[0], 'p')
+            # Existing rows went to their month's partition, not the default one
+            cursor.execute(f'SELECT COUNT(*) FROM {table}_default')
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute(f'SELECT COUNT(*) FROM {table}_{earlier:%Y%m}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+        store_events([(EmailEngagementEvent.KIND_OPEN, self.email.id, timezone.now(), EmailEngagementEvent.UA_MOBILE, None)])
+        self.assertEqual(EmailEngagementEvent.objects.count(), 3)
+        self.assertEqual(len(set(EmailEngagementEvent.objects.values_list('id', flat=True))), 3)
+        self.assertEqual(ensure_event_partitions(), names)
+
+
+class RuleEngineTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='rules', email='rules@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='RuleCo', created_by=self.user)
+        self.account = EmailAccount.objects.create(user=self.user, company=self.company, email='rules@example.com', provider='smtp', username='rules@example.com', password='x')
+
+    def rule(self, name, **conditions):
+        return EmailRule.objects.create(company=self.company, created_by=self.user, name=name, trigger=EmailRule.TRIGGER_EMAIL_RECEIVED, conditions=conditions)
+
+    def inbound(self, subject, body, sender='Jane <jane@mail.acme.com>', attachments=False):
+        thread = EmailThread.objects.create(company=self.company, email_account=self.account, subject=subject, last_message_at=timezone.now())
+        return Email.objects.create(thread=thread, email_account=self.account, message_id=f'<{subject}@test>', from_email=sender,
+                                    subject=subject, body_text=body, direction=Email.DIRECTION_INBOUND, has_attachments=attachments)
+
+    def test_overlapping_keywords_are_all_found(self):
+        matcher = KeywordMatcher(['refund', 'Refund Request', 'request', 'quest'])
+        self.assertEqual(matcher.find('Please REFUND REQUEST now'), {'refund', 'refund request', 'request', 'quest'})
+        self.assertEqual(matcher.find('nothing here'), set())
+
+    def test_rules_evaluate_in_one_pass_and_recompile_on_change(self):
+        refund = self.rule('Refunds', keywords=['refund'])
+        acme = self.rule('Acme files', sender_domain='acme.com', has_attachment=True)
+        self.rule('Complaints', category=['complaint'], keywords=['angry'])
+        email = self.inbound('Refund please', 'Attached invoice', attachments=True)
+
+        compiled = get_compiled_rules(self.company.id)
+        self.assertEqual([r.id for r in compiled.evaluate(email, EmailRule.TRIGGER_EMAIL_RECEIVED)], [refund.id, acme.id])
+        self.assertEqual(compiled.evaluate(email, EmailRule.TRIGGER_EMAIL_SENT), [])
+        with self.assertNumQueries(0):
+            self.assertIs(get_compiled_rules(self.company.id), compiled)
+
+        acme.conditions = {'sender_domain': 'other.com'}
+        acme.save()
+        recompiled = get_compiled_rules(self.company.id)
+        self.assertIsNot(recompiled, compiled)
+        self.assertEqual([r.id for r in recompiled.evaluate(email, EmailRule.TRIGGER_EMAIL_RECEIVED)], [refund.id])
+
+
+class AIClassifierTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='ai', email='ai@example.com', password='pass123', account_type='company')
+        self.company = Company.objects.create(company_name='AICo', created_by=self.user)
+        self.account = EmailAccount.objects.create(user=self.user, company=self.company, email='ai@example.com', provider='smtp', username='ai@example.com', password='x')
+
+    def inbound(self, n, subject, body):
+        thread = EmailThread.objects.create(company=self.company, email_account=self.account, subject=subject, last_message_at=timezone.now())
+        return Email.objects.create(thread=thread, email_account=self.account, message_id=f'<ai-{n}@test>', from_email='x@news.test',
+                                    subject=subject, body_text=body, direction=Email.DIRECTION_INBOUND)
+
+    def test_batches_cache_repeats_and_stays_pending_when_circuit_opens(self):
+        backend = mock.Mock(wraps=StubBackend())
+        for n in range(3):
+            self.inbound(n, 'Weekly deals', f'Issue {n}: 20% off. Unsubscribe at https://news.test/u/{n}')
+        self.inbound(3, 'Need a quote', 'We are interested in pricing')
+        self.assertEqual(classify_pending(batch_size=10, backend=backend), 4)
+        self.assertEqual(backend.classify.call_count, 1)
+        self.assertEqual(len(backend.classify.call_args[0][0]), 2)  # the three newsletters share one content hash
+        self.assertEqual(
+            sorted(EmailThread.objects.filter(company=self.company).values_list('category', flat=True)),
+            ['lead', 'promotions', 'promotions', 'promotions'],
+        )
+
+        self.inbound(4, 'Weekly deals', 'Issue 9: 20% off. Unsubscribe at https://news.test/u/9')
+        self.assertEqual(classify_pending(backend=backend), 1)
+        self.assertEqual(backend.classify.call_count, 1)  # served from cache
+
+        broken = mock.Mock()
+        broken.classify.side_effect = TimeoutError('model timeout')
+        for n in range(5, 12):
+            self.inbound(n, f'Subject {n}', f'Body {n} text {"x" * n}')
+        self.assertEqual(classify_pending(batch_size=1, backend=broken), 0)
+        self.assertEqual(broken.classify.call_count, 5)  # breaker opened after 5 failures
+        self.assertEqual(Email.objects.filter(ai_categorized_at__isnull=True).count(), 7)
+
+    def test_poison_email_does_not_block_its_batch(self):
+        def classify(emails):
+            if any('poison' in email.subject for email in emails):
+                raise ValueError('unparseable model output')
+            return StubBackend().classify(emails)
+
+        backend = mock.Mock()
+        backend.classify.side_effect = classify
+        poison = self.inbound(0, 'poison', 'First in the queue')
+        self.inbound(1, 'Need a quote', 'We are interested in pricing')
+        self.inbound(2, 'Weekly deals', '20% off. Unsubscribe')
+        for run in range(MAX_ATTEMPTS):
+            self.assertEqual(classify_pending(batch_size=3, backend=backend), 2 if run == 0 else 0)
+            poison.refresh_from_db()
+            self.assertEqual(poison.ai_categorized_at is None, run < MAX_ATTEMPTS - 1)
+        self.assertFalse(Email.objects.filter(ai_categorized_at__isnull=True).exists())
+
+    def test_missing_or_empty_answers_are_retried_not_cached(self):
+        quote = self.inbound(0, 'Need a quote', 'We are interested in pricing')
+        self.inbound(1, 'Weekly deals', '20% off. Unsubscribe')
+        backend = mock.Mock()
+        # Batch: the model answers only the second email; then the first alone gets an unusable answer
+        backend.classify.side_effect = [[{}, {'category': 'Promotional'}], [{'category': 'nonsense'}], [{'category': 'Lead'}]]
+        self.assertEqual(classify_pending(batch_size=2, backend=backend), 1)
+        quote.refresh_from_db()
+        self.assertIsNone(quote.ai_categorized_at)
+        self.assertEqual(classify_pending(batch_size=2, backend=backend), 1)
+        self.assertEqual(EmailThread.objects.get(pk=quote.thread_id).category, 'lead')
+
+    def test_openai_ids_are_coerced(self):
+        backend = OpenAIBackend.__new__(OpenAIBackend)
+        backend.client = mock.Mock()
+        content = '{"results": [{"id": "1", "category": "Lead"}, {"id": "x"}, {"category": "Other"}]}'
+        backend.client.chat.completions.create.return_value.choices = [mock.Mock(message=mock.Mock(content=content))]
+        emails = [self.inbound(n, f'S{n}', 'b') for n in range(2)]
+        self.assertEqual(backend.classify(emails), [None, {'id': '1', 'category': 'Lead'}])
@@ -1,11 +1,13 @@
 from django.urls import path
 from .views import (
     EmailAccountListCreateView, EmailAccountDetailView, GmailConnectView, GmailCallbackView,
-    SyncEmailAccountView, SetDefaultAccountView, SendEmailView, EmailInboxView,
+    SyncEmailAccountView, SyncQueueMetricsView, SetDefaultAccountView, SendEmailView, EmailInboxView,
     EmailThreadDetailView, MarkAsReadView, MarkAsStarredView, DeleteEmailView,
     EmailOpenTrackingView, EmailLinkClickView, SuggestReplyView, ReplyEmailView,
     EmailSearchView, EmailCategoriesView,
-    EmailTemplateListCreateView, EmailTemplateDetailView, TemplatePreviewView, DuplicateTemplateView
+    EmailTemplateListCreateView, EmailTemplateDetailView, TemplatePreviewView, DuplicateTemplateView, TemplateMergeView,
+    EmailCampaignListCreateView, EmailCampaignDetailView, SendCampaignView, CampaignFailedRecipientsView,
+    EmailAnalyticsView, AttachmentDownloadView
 )
 
 urlpatterns = [
@@ -14,6 +16,7 @@ urlpatterns = [
     path('connect-gmail/', GmailConnectView.as_view()),
     path('gmail-callback/', GmailCallbackView.as_view()),
     path('accounts/<int:pk>/sync/', SyncEmailAccountView.as_view()),
+    path('sync/metrics/', SyncQueueMetricsView.as_view()),
     path('accounts/<int:pk>/set-default/', SetDefaultAccountView.as_view()),
     path('send/', SendEmailView.as_view()),
     path('inbox/', EmailInboxView.as_view()),
@@ -25,11 +28,19 @@ urlpatterns = [
     path('track/click/<str:token>/', EmailLinkClickView.as_view()),
     path('emails/<int:pk>/suggest-reply/', SuggestReplyView.as_view()),
     path('emails/<int:pk>/reply/', ReplyEmailView.as_view()),
+    path('attachments/<int:pk>/', AttachmentDownloadView.as_view()),
     path('search/', EmailSearchView.as_view()),
     path('categories/', EmailCategoriesView.as_view()),
     # Templates
     path('templates/', EmailTemplateListCreateView.as_view()),
     path('templates/<int:pk>/', EmailTemplateDetailView.as_view()),
     path('templates/<int:pk>/duplicate/', DuplicateTemplateView.as_view()),
+    path('templates/<int:pk>/merge/', TemplateMergeView.as_view()),
     path('templates/preview/', TemplatePreviewView.as_view()),
+    # Campaigns
+    path('campaigns/', EmailCampaignListCreateView.as_view()),
+    path('campaigns/<int:pk>/', EmailCampaignDetailView.as_view()),
+    path('campaigns/<int:pk>/send/', SendCampaignView.as_view()),
+    path('campaigns/<int:pk>/failed/', CampaignFailedRecipientsView.as_view()),
+    path('analytics/', EmailAnalyticsView.as_view()),
 ]
@@ -2,17 +2,29 @@ from rest_framework import generics, permissions, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
+from django.db.models import Q, Sum
+from django.utils import timezone
+from datetime import timedelta
 from django.conf import settings
-from apps.emails.models import EmailAccount, Email, EmailThread, EmailTemplate, EmailRule
+from apps.emails.models import EmailAccount, Email, EmailAttachment, EmailCategoryCounter, EmailThread, EmailTemplate, EmailRule, EmailCampaign, CampaignRecipient
 from apps.emails.serializers import (
     EmailAccountSerializer, CreateEmailAccountSerializer, GmailOAuthSerializer,
     SendEmailSerializer, EmailThreadListSerializer, EmailThreadDetailSerializer, EmailSerializer,
-    EmailTemplateSerializer, CreateTemplateSerializer, TemplatePreviewSerializer
+    EmailTemplateSerializer, CreateTemplateSerializer, TemplatePreviewSerializer, MailMergeSerializer,
+    EmailCampaignSerializer, CreateCampaignSerializer, CampaignRecipientSerializer, EmailSearchResultSerializer
 )
 from apps.emails.services.email_sender import send_email
 from apps.emails.services.email_tracker import generate_open_token, generate_click_token, track_open, track_click
-from apps.emails.tasks import sync_email_account_task, send_email_task
-from django.http import HttpResponse
+from apps.emails.tasks import sync_email_account_task, send_email_task, start_campaign_task, send_mail_merge_task
+from django.http import FileResponse, HttpResponse
+from apps.core.pagination import KeysetPagination
+from apps.authentication.tenant import get_tenant_context
+from apps.emails.services.engagement import engagement_report
+from apps.emails.services.email_search import DEFAULT_LIMIT, MAX_LIMIT, search_threads
+from apps.emails.services.attachment_store import AttachmentUnavailable, download_attachment
+from apps.emails.services.mail_merge import render_merge
+from apps.emails.services.mailbox_counters import email_deleted, mark_thread_read
+from apps.emails.services.sync_pool import inbox_viewed, queue_metrics
 
 
 class EmailAccountListCreateView(generics.ListCreateAPIView):
@@ -103,6 +115,12 @@ class SyncEmailAccountView(APIView):
         return Response({'status': 'queued'})
 
 
+class SyncQueueMetricsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+    def get(self, request):
+        return Response(queue_metrics())
+
+
 class SetDefaultAccountView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     def post(self, request, pk):
@@ -128,10 +146,16 @@ class SendEmailView(generics.CreateAPIView):
 class EmailInboxView(generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = EmailThreadListSerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return EmailThread.objects.filter(email_account__user=self.request.user).order_by('-last_message_at')
 
+    def list(self, request, *args, **kwargs):
+        # Someone is reading: poll their accounts on the short interval for a while
+        inbox_viewed(request.user)
+        return super().list(request, *args, **kwargs)
+
 
 class EmailThreadDetailView(generics.RetrieveAPIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -139,16 +163,14 @@ class EmailThreadDetailView(generics.RetrieveAPIView):
     queryset = EmailThread.objects.all()
 
     def get_queryset(self):
-        return EmailThread.objects.filter(email_account__user=self.request.user)
+        return EmailThread.objects.filter(email_account__user=self.request.user).prefetch_related('emails__attachments')
 
 
 class MarkAsReadView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     def post(self, request, pk):
         thread = get_object_or_404(EmailThread, pk=pk, email_account__user=request.user)
-        thread.is_read = True
-        thread.save(update_fields=['is_read'])
-        thread.emails.update(is_read=True)
+        mark_thread_read(thread)
         return Response({'status': 'ok'})
 
 
@@ -165,17 +187,36 @@ class DeleteEmailView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     def delete(self, request, pk):
         email = get_object_or_404(Email, pk=pk, email_account__user=request.user)
-        email.status = Email.STATUS_FAILED  # soft delete placeholder
-        email.save(update_fields=['status'])
+        email_deleted(email)  # soft delete placeholder
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class AttachmentDownloadView(APIView):
+    """Serve an attachment, fetching it from the mail server first if it was not downloaded yet."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk):
+        attachment = get_object_or_404(
+            EmailAttachment.objects.select_related('email__email_account'), pk=pk, email__email_account__user=request.user
+        )
+        try:
+            download_attachment(attachment)
+        except AttachmentUnavailable as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_410_GONE)
+        except Exception:  # noqa: BLE001
+            return Response({'detail': 'Could not fetch the attachment from the mail server'}, status=status.HTTP_502_BAD_GATEWAY)
+        return FileResponse(
+            attachment.file_path.open('rb'), as_attachment=True, filename=attachment.file_name,
+            content_type=attachment.file_type or 'application/octet-stream',
+        )
+
+
 class EmailOpenTrackingView(APIView):
     authentication_classes = []
     permission_classes = []
     def get(self, request, token):
         from apps.emails.services.email_tracker import track_open
-        return track_open(token)
+        return track_open(token, request.META.get('HTTP_USER_AGENT', ''))
 
 
 class EmailLinkClickView(APIView):
@@ -183,7 +224,7 @@ class EmailLinkClickView(APIView):
     permission_classes = []
     def get(self, request, token):
         from apps.emails.services.email_tracker import track_click
-        return track_click(token)
+        return track_click(token, request.META.get('HTTP_USER_AGENT', ''))
 
 
 class SuggestReplyView(APIView):
@@ -212,31 +253,26 @@ class ReplyEmailView(generics.CreateAPIView):
         return Response(EmailSerializer(email).data, status=status.HTTP_201_CREATED)
 
 
-class EmailSearchView(generics.ListAPIView):
+class EmailSearchView(APIView):
+    """Ranked threads for ``q``; supports from:, has:attachment and category: operators."""
     permission_classes = [permissions.IsAuthenticated]
-    serializer_class = EmailThreadListSerializer
 
-    def get_queryset(self):
-        q = self.request.query_params.get('q', '').strip()
-        base = EmailThread.objects.filter(email_account__user=self.request.user)
-        if not q:
-            return base.none()
-        # Filter threads whose subject or any email body contains q
-        thread_ids = Email.objects.filter(
-            email_account__user=self.request.user,
-            ).filter(
-                models.Q(subject__icontains=q) |
-                models.Q(body_text__icontains=q) |
-                models.Q(body_html__icontains=q)
-            ).values_list('thread_id', flat=True)
-        return base.filter(models.Q(subject__icontains=q) | models.Q(id__in=thread_ids)).order_by('-last_message_at')
+    def get(self, request):
+        q = request.query_params.get('q', '').strip()
+        try:
+            limit = min(max(int(request.query_params.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+        except ValueError:
+            return Response({'detail': 'limit must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        threads = search_threads(request.user, q, limit) if q else []
+        return Response(EmailSearchResultSerializer(threads, many=True).data)
 
 
 class EmailCategoriesView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     def get(self, request):
-        qs = EmailThread.objects.filter(email_account__user=request.user)
-        data = qs.values('category').annotate(count=models.Count('id')).order_by('-count')
+        # Read from the per-category counters rather than counting threads
+        qs = EmailCategoryCounter.objects.filter(email_account__user=request.user)
+        data = qs.values('category').annotate(count=Sum('thread_count'), unread=Sum('unread_count')).filter(count__gt=0).order_by('-count')
         return Response({'categories': list(data)})
 
 
@@ -294,3 +330,109 @@ class DuplicateTemplateView(APIView):
             category=tmpl.category,
         )
         return Response(EmailTemplateSerializer(new_tmpl).data, status=status.HTTP_201_CREATED)
+
+
+class TemplateMergeView(APIView):
+    """Render a template for many leads, deals or customers; with ``send`` the messages are queued instead."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        template = get_object_or_404(EmailTemplate.objects.select_related('company'), pk=pk, created_by=request.user)
+        serializer = MailMergeSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        messages, missing = render_merge(template, request.user, data['recipient_type'], data['ids'])
+        if not data['send']:
+            return Response({'messages': messages, 'missing': missing})
+        account = data.get('email_account') or (
+            EmailAccount.objects.filter(user=request.user, is_default=True).first() or EmailAccount.objects.filter(user=request.user).first()
+        )
+        if account is None:
+            return Response({'detail': 'No email account to send from.'}, status=status.HTTP_400_BAD_REQUEST)
+        if messages:
+            # Only ids go through the broker; the task renders the messages again
+            ids = [message['recipient_id'] for message in messages]
+            send_mail_merge_task.delay(template.id, account.id, data['recipient_type'], ids)
+        return Response({'queued': len(messages), 'missing': missing}, status=status.HTTP_202_ACCEPTED)
+
+
+class EmailCampaignListCreateView(generics.ListCreateAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+    queryset = EmailCampaign.objects.all()
+
+    def get_queryset(self):
+        return EmailCampaign.objects.filter(created_by=self.request.user).order_by('-created_at')
+
+    def get_serializer_class(self):
+        if self.request.method == 'POST':
+            return CreateCampaignSerializer
+        return EmailCampaignSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        campaign = serializer.save()
+        return Response(EmailCampaignSerializer(campaign).data, status=status.HTTP_201_CREATED)
+
+
+class EmailCampaignDetailView(generics.RetrieveAPIView):
+    """Campaign with its progress counters."""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = EmailCampaignSerializer
+    queryset = EmailCampaign.objects.all()
+
+    def get_queryset(self):
+        return EmailCampaign.objects.filter(created_by=self.request.user)
+
+
+class SendCampaignView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        campaign = get_object_or_404(EmailCampaign, pk=pk, created_by=request.user)
+        queued = EmailCampaign.objects.filter(pk=pk, status=EmailCampaign.STATUS_DRAFT).update(status=EmailCampaign.STATUS_QUEUED)
+        if not queued:
+            return Response({'detail': f'Campaign is already {campaign.status}.'}, status=status.HTTP_409_CONFLICT)
+        start_campaign_task.delay(campaign.id)
+        campaign.refresh_from_db()
+        return Response(EmailCampaignSerializer(campaign).data, status=status.HTTP_202_ACCEPTED)
+
+
+class CampaignFailedRecipientsView(generics.ListAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = CampaignRecipientSerializer
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        campaign = get_object_or_404(EmailCampaign, pk=self.kwargs['pk'], created_by=self.request.user)
+        return campaign.recipients.filter(status=CampaignRecipient.STATUS_FAILED)
+
+
+class EmailAnalyticsView(APIView):
+    """Open/click rates per template and sender, time-to-open and top links.
+
+    Covers the user's own outbound mail plus, for members with
+    can_view_reports, all of their companies' mail. Optional filters:
+    days (default 30), company_id, campaign, template.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        try:
+            days = min(max(int(request.query_params.get('days', 30)), 1), 365)
+        except ValueError:
+            return Response({'detail': 'days must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        filters = {}
+        for param, lookup in (('campaign', 'campaign_recipients__campaign_id'), ('template', 'template_id')):
+            if request.query_params.get(param):
+                try:
+                    filters[lookup] = int(request.query_params[param])
+                except ValueError:
+                    return Response({'detail': f'{param} must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        tenant = get_tenant_context(request)
+        companies = [c for c in tenant.scope(request.query_params.get('company_id')) if tenant.has_flag('can_view_reports', c)]
+        emails = Email.objects.filter(direction=Email.DIRECTION_OUTBOUND).filter(
+            Q(email_account__user=request.user) | Q(email_account__company_id__in=companies)
+        ).filter(**filters)
+        since = timezone.now() - timedelta(days=days)
+        return Response({'days': days, **engagement_report(emails, since)})
@@ -140,7 +140,7 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'apps.authentication.authentication.TenantClaimsJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.AllowAny',
@@ -174,6 +174,10 @@ SIMPLE_JWT = {
     'TOKEN_TYPE_CLAIM': 'token_type',
 }
 
+# Embed account type and company memberships in access tokens so read
+# endpoints can authorize without loading User/CompanyUser rows.
+JWT_TENANT_CLAIMS = config('JWT_TENANT_CLAIMS', default=False, cast=bool)
+
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',
     'http://localhost:5173',  # Vite default
@@ -206,7 +210,19 @@ CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 minutes
 
+# Shared cache (same Redis as Celery) - used for tenant membership caching
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'puppycrm',
+    }
+}
+TENANT_MEMBERSHIP_CACHE_TIMEOUT = config('TENANT_MEMBERSHIP_CACHE_TIMEOUT', default=15 * 60, cast=int)
+
 AI_EMAIL_SORTING_ENABLED = config('AI_EMAIL_SORTING_ENABLED', default=False, cast=bool)
+AI_EMAIL_BACKEND = config('AI_EMAIL_BACKEND', default='openai')  # 'openai' or 'stub' (local, deterministic)
+AI_EMAIL_BATCH_SIZE = config('AI_EMAIL_BATCH_SIZE', default=10, cast=int)  # emails per model request
 OPENAI_API_KEY = config('OPENAI_API_KEY', default='')
 
 EMAIL_ENCRYPTION_KEY = config('EMAIL_ENCRYPTION_KEY', default='')  # Fernet key for encrypting email passwords/tokens
@@ -215,6 +231,28 @@ GMAIL_CLIENT_ID = config('GMAIL_CLIENT_ID', default='')
 GMAIL_CLIENT_SECRET = config('GMAIL_CLIENT_SECRET', default='')
 GMAIL_REDIRECT_URI = config('GMAIL_REDIRECT_URI', default='http://localhost:3000/auth/google/callback')
 
+# IMAP sync pool (apps.emails.services.sync_pool)
+# Each sync thread holds its own database connection for its whole IMAP session,
+# so a sync run can use this many connections on top of the web and Celery workers;
+# keep it well under the database's max_connections (PostgreSQL default: 100).
+EMAIL_SYNC_CONCURRENCY = config('EMAIL_SYNC_CONCURRENCY', default=16, cast=int)
+EMAIL_SYNC_PER_HOST = config('EMAIL_SYNC_PER_HOST', default=4, cast=int)  # simultaneous sessions per IMAP server
+EMAIL_SYNC_TIMEOUT = config('EMAIL_SYNC_TIMEOUT', default=120, cast=int)  # seconds per socket operation
+EMAIL_SYNC_MIN_INTERVAL = config('EMAIL_SYNC_MIN_INTERVAL', default=60, cast=int)  # seconds; busiest mailboxes
+EMAIL_SYNC_MAX_INTERVAL = config('EMAIL_SYNC_MAX_INTERVAL', default=60 * 60, cast=int)  # seconds; dormant mailboxes
+EMAIL_SYNC_ACTIVE_INTERVAL = config('EMAIL_SYNC_ACTIVE_INTERVAL', default=60, cast=int)  # seconds, while the inbox is being viewed
+EMAIL_SYNC_DISPATCH_LIMIT = config('EMAIL_SYNC_DISPATCH_LIMIT', default=1000, cast=int)  # due accounts taken per scheduler tick
+EMAIL_PARSE_MAX_BODY_BYTES = config('EMAIL_PARSE_MAX_BODY_BYTES', default=2 * 1024 * 1024, cast=int)  # per text/html part; the rest is dropped
+EMAIL_ATTACHMENT_PREFETCH_MAX_BYTES = config('EMAIL_ATTACHMENT_PREFETCH_MAX_BYTES', default=5 * 1024 * 1024, cast=int)  # larger attachments download on demand only
+
+# Pooled outbound SMTP connections per worker (apps.emails.services.smtp_pool)
+EMAIL_SMTP_POOL_MAX_MESSAGES = config('EMAIL_SMTP_POOL_MAX_MESSAGES', default=100, cast=int)  # sends before reconnecting
+EMAIL_SMTP_POOL_IDLE_TIMEOUT = config('EMAIL_SMTP_POOL_IDLE_TIMEOUT', default=120, cast=int)  # seconds an idle connection is kept
+
+# Bulk campaigns (apps.emails.services.campaigns)
+EMAIL_SEND_RATE_PER_MINUTE = config('EMAIL_SEND_RATE_PER_MINUTE', default=60, cast=int)  # per account unless the account sets its own
+EMAIL_CAMPAIGN_CHUNK_SIZE = config('EMAIL_CAMPAIGN_CHUNK_SIZE', default=200, cast=int)  # recipients per send task
+
 <<<<<<< HEAD
 # Twilio Settings (Phase 7.2 - Call System)
 TWILIO_ACCOUNT_SID = config('TWILIO_ACCOUNT_SID', default='')
@@ -235,7 +273,31 @@ from celery.schedules import crontab  # noqa: E402
 CELERY_BEAT_SCHEDULE = {
     'sync-all-email-accounts': {
         'task': 'apps.emails.tasks.sync_all_accounts_task',
-        'schedule': 300.0,  # every 5 minutes
+        'schedule': 30.0,  # only syncs accounts whose next_sync_at has passed
+    },
+    'flush-email-tracking': {
+        'task': 'apps.emails.tasks.flush_tracking_events_task',
+        'schedule': 30.0,  # buffered opens/clicks reach Email counters within 30s
+    },
+    'prefetch-email-attachments': {
+        'task': 'apps.emails.tasks.prefetch_attachments_task',
+        'schedule': 300.0,  # small attachments only; see EMAIL_ATTACHMENT_PREFETCH_MAX_BYTES
+    },
+    'ai-categorize-emails': {
+        'task': 'apps.emails.tasks.ai_categorize_emails_task',
+        'schedule': 60.0,  # no-op unless AI_EMAIL_SORTING_ENABLED
+    },
+    'reconcile-mailbox-counters': {
+        'task': 'apps.emails.tasks.reconcile_mailbox_counters_task',
+        'schedule': 60 * 60.0,  # hourly; repairs drift in the denormalized unread counters
+    },
+    'ensure-engagement-partitions': {
+        'task': 'apps.emails.tasks.ensure_event_partitions_task',
+        'schedule': 24 * 60 * 60.0,  # daily; keeps two future months of partitions
+    },
+    'rebuild-crm-rollups': {
+        'task': 'apps.crm.tasks.rebuild_all_rollups_task',
+        'schedule': 24 * 60 * 60.0,  # daily
     },
 }
 